@@ -0,0 +1,57 @@
+"""
+比较VectorStore精确查找与IVF近似查找（int8和float16编码）的recall@k、单个查询的QPS和延迟。
+使用聚成簇的随机数据模拟embedding的分布，维度默认与text-embedding-3-small相同。
+
+运行：python benchmarks/bench_ann.py [向量数] [维度]
+"""
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from wee_agent.vectors import VectorStore
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+DIMENSION = int(sys.argv[2]) if len(sys.argv) > 2 else 1536
+QUERIES = 200
+K = 10
+
+
+def clustered(rng, count: int, centers) -> np.ndarray:
+    labels = rng.integers(0, len(centers), count)
+    return centers[labels] + rng.standard_normal((count, centers.shape[1]), dtype=np.float32)
+
+
+def measure(store, queries, **kwargs) -> tuple:
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append(store.search_batch(query, k=K, **kwargs)[0][0])
+    elapsed = time.perf_counter() - start
+    return np.array(results), QUERIES / elapsed, elapsed / QUERIES * 1e3
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    centers = 0.7 * rng.standard_normal((1000, DIMENSION), dtype=np.float32)  # 簇之间有重叠
+    with tempfile.TemporaryDirectory() as directory:
+        store = VectorStore(directory, dimension=DIMENSION)
+        for offset in range(0, COUNT, 50000):
+            store.add(clustered(rng, min(50000, COUNT - offset), centers))
+        # 查询是已有的向量加上噪声，最近邻有意义
+        queries = store._arrays["vectors"][rng.integers(0, COUNT, QUERIES)] \
+            + 0.02 * rng.standard_normal((QUERIES, DIMENSION), dtype=np.float32)
+        exact, qps, latency = measure(store, queries, exact=True)
+        print(f"{'mode':>16} {'recall@10':>10} {'QPS':>9} {'ms/query':>9}")
+        print(f"{'exact':>16} {1.0:>10.3f} {qps:>9.1f} {latency:>9.2f}")
+        for quantization in ("int8", "float16"):
+            start = time.perf_counter()
+            store.build_index(quantization=quantization)
+            built = time.perf_counter() - start
+            for nprobe in (4, 16, 64):
+                found, qps, latency = measure(store, queries, nprobe=nprobe)
+                recall = np.mean([len(set(a) & set(e)) / K for a, e in zip(found, exact)])
+                print(f"{quantization + '/' + str(nprobe):>16} {recall:>10.3f} {qps:>9.1f} {latency:>9.2f}")
+            print(f"{'':>16} build {built:.1f}s, nlist={store.index.nlist}")
+        store.close()
@@ -0,0 +1,57 @@
+"""
+比较长时间运行的代理在不同保留策略下历史消息占用的内存：
+retention=None：保留全部历史消息（默认行为）；
+retention=0：被裁剪出消息窗口的消息会被批量释放。
+
+运行：python benchmarks/bench_history_memory.py
+"""
+import os
+import time
+import tracemalloc
+
+from types import SimpleNamespace
+
+from openai.types.chat.chat_completion import ChatCompletion
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+
+from wee_agent import WeeAgent  # noqa: E402
+
+
+class EchoClient:
+    """每次都返回同一条回复的客户端，只用于驱动对话"""
+
+    def __init__(self):
+        self.base_url = "http://bench"
+        reply = ChatCompletion(
+            id="bench", object="chat.completion", created=0, model="bench",
+            choices=[{"index": 0, "finish_reason": "stop",
+                      "message": {"role": "assistant",
+                                  "content": "answer " * 40}}],
+            usage={"prompt_tokens": 100, "completion_tokens": 40,
+                   "total_tokens": 140})
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            create=lambda **kwargs: reply))
+
+
+def run(turns: int, retention) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    agent = WeeAgent(max_round=10, history_retention=retention)
+    agent.open_ai_client = EchoClient()
+    for i in range(turns):
+        agent(f"question {i} " * 20)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(agent.history_messages), current / 2 ** 20, peak / 2 ** 20, elapsed
+
+
+if __name__ == "__main__":
+    print(f"{'turns':>6} {'retention':>9} {'kept':>6} {'current(MB)':>12} "
+          f"{'peak(MB)':>9} {'time(s)':>8}")
+    for turns in (1000, 10000):
+        for retention in (None, 0):
+            kept, current, peak, elapsed = run(turns, retention)
+            print(f"{turns:>6} {str(retention):>9} {kept:>6} {current:>12.2f} "
+                  f"{peak:>9.2f} {elapsed:>8.2f}")
@@ -0,0 +1,46 @@
+"""
+比较每轮对话构造请求参数的开销：
+legacy：completion.messages = _create_messages() 后再 completion.model_dump()，每次都要重新校验和序列化全部历史消息；
+fast：_build_payload()，使用压入消息时缓存的序列化结果。
+
+运行：python benchmarks/bench_request_builder.py
+"""
+import os
+import time
+
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+
+from wee_agent import WeeAgent  # noqa: E402
+
+
+def make_agent(rounds: int) -> WeeAgent:
+    agent = WeeAgent(max_round=0)
+    for i in range(rounds):
+        agent.user_input(f"question {i} " * 20)
+        agent._assistant_input(ChatCompletionMessage(
+            role="assistant", content=f"answer {i} " * 40))
+    return agent
+
+
+def legacy(agent: WeeAgent) -> dict:
+    agent.completion.messages = agent._create_messages()
+    return agent.completion.model_dump(exclude_defaults=True,
+                                       exclude_none=True)
+
+
+def timed(fn, agent: WeeAgent, repeat: int = 20) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(agent)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+if __name__ == "__main__":
+    print(f"{'history':>8} {'legacy(ms)':>11} {'fast(ms)':>9}")
+    for rounds in (5, 50, 500, 2500):
+        agent = make_agent(rounds)
+        fast = timed(lambda a: a._build_payload(), agent)
+        slow = timed(legacy, agent)
+        print(f"{rounds * 2:>8} {slow:>11.3f} {fast:>9.3f}")
@@ -0,0 +1,53 @@
+"""
+比较恢复一个长会话的耗时：从会话存储中只读取消息窗口，与重新压入全部历史消息（重放）。
+
+运行：python benchmarks/bench_session_store.py
+"""
+import os
+import tempfile
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+
+from wee_agent import WeeAgent  # noqa: E402
+from wee_agent.models import Completion  # noqa: E402
+from wee_agent.store import JsonlSessionStore, SqliteSessionStore  # noqa: E402
+
+TURNS = 5000
+WINDOW = 20  # 消息窗口中的消息数
+
+
+def fill(store) -> float:
+    start = time.perf_counter()
+    for i in range(TURNS):
+        for offset, role in enumerate(("user", "assistant")):
+            store.append("long", 2 * i + offset,
+                         {"role": role, "content": f"{role} message {i} " * 20},
+                         60, {"head": 2 * TURNS - WINDOW})
+    store.flush()
+    return time.perf_counter() - start
+
+
+def replay() -> float:
+    agent = WeeAgent(max_round=WINDOW // 2)
+    start = time.perf_counter()
+    for i in range(TURNS):
+        agent._push_message(Completion.UserMessage(role="user", content=f"user message {i} " * 20))
+        agent._push_message(Completion.UserMessage(role="user", content=f"assistant message {i} " * 20))
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'store':>8} {'write ms':>9} {'resume ms':>10}")
+        for name, store in (("jsonl", JsonlSessionStore(directory)),
+                            ("sqlite", SqliteSessionStore(os.path.join(directory, "s.sqlite")))):
+            written = fill(store)
+            agent = WeeAgent(session_store=store)
+            start = time.perf_counter()
+            session = agent.new_session(session_id="long")
+            resumed = time.perf_counter() - start
+            assert len(session.history.messages) == WINDOW
+            print(f"{name:>8} {written * 1e3:>9.1f} {resumed * 1e3:>10.2f}")
+            store.close()
+        print(f"{'replay':>8} {'':>9} {replay() * 1e3:>10.2f}")
@@ -0,0 +1,35 @@
+"""
+比较为每个用户创建完整的WeeAgent与用AgentRuntime创建轻量会话的开销：
+每个会话的创建耗时和内存占用。
+
+运行：python benchmarks/bench_sessions.py
+"""
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+
+from wee_agent import WeeAgent  # noqa: E402
+from wee_agent.session import AgentRuntime  # noqa: E402
+
+
+def measure(create, count: int) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    keep = [create(i) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    return elapsed / count * 1e6, memory / count / 1024
+
+
+if __name__ == "__main__":
+    runtime = AgentRuntime(WeeAgent())
+    print(f"{'mode':>8} {'count':>6} {'us/session':>11} {'KB/session':>11}")
+    for mode, create, count in (
+            ("agent", lambda i: WeeAgent(), 200),
+            ("session", lambda i: runtime.session(str(i)), 20000)):
+        per_call, per_memory = measure(create, count)
+        print(f"{mode:>8} {count:>6} {per_call:>11.1f} {per_memory:>11.1f}")
@@ -0,0 +1,61 @@
+"""
+比较代理状态快照的三种编码方式每1000条消息的大小和编解码耗时：
+WeeAgent.snapshot()/restore()的二进制格式、pickle以及pydantic逐条序列化为json。
+
+运行：python benchmarks/bench_snapshot.py
+"""
+import json
+import os
+import pickle
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+
+from wee_agent import WeeAgent  # noqa: E402
+from wee_agent.models import Completion  # noqa: E402
+from wee_agent.wee_agent import _message_from_payload  # noqa: E402
+
+MESSAGES = 1000
+REPEAT = 5
+
+
+def build_agent() -> WeeAgent:
+    agent = WeeAgent(name="bench", max_round=0)
+    for i in range(MESSAGES // 2):
+        agent._push_message(Completion.UserMessage(
+            role="user", content=f"question {i}: how should we shard sessions? " * 4))
+        agent._push_message(Completion.AssistantMessage(
+            role="assistant", content=f"answer {i}: by session id across workers. " * 8,
+            tool_calls=None))
+    return agent
+
+
+def timed(function) -> tuple:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = function()
+    return result, (time.perf_counter() - start) / REPEAT * 1e3
+
+
+def pydantic_encode(agent: WeeAgent) -> bytes:
+    return json.dumps([message.model_dump_json() for message in agent.history_messages]).encode()
+
+
+def pydantic_decode(data: bytes) -> list:
+    return [_message_from_payload(json.loads(text)) for text in json.loads(data)]
+
+
+if __name__ == "__main__":
+    agent = build_agent()
+    template = WeeAgent(name="bench")
+    print(f"{'format':>12} {'KB':>8} {'encode ms':>10} {'decode ms':>10}")
+    for name, encode, decode in (
+            ("snapshot", lambda: agent.snapshot(),
+             lambda data: WeeAgent.restore(data, template=template)),
+            ("snapshot-raw", lambda: agent.snapshot(compress=False),
+             lambda data: WeeAgent.restore(data, template=template)),
+            ("pickle", lambda: pickle.dumps(agent.history), pickle.loads),
+            ("pydantic", lambda: pydantic_encode(agent), pydantic_decode)):
+        data, encoded = timed(encode)
+        _, decoded = timed(lambda: decode(data))
+        print(f"{name:>12} {len(data) / 1024:>8.1f} {encoded:>10.2f} {decoded:>10.2f}")
@@ -0,0 +1,59 @@
+"""
+比较StreamAccumulator与utils.merge合并stream trunk的开销。
+StreamAccumulator每个trunk的开销固定，merge的开销随已合并内容的长度增长。
+
+运行：python benchmarks/bench_stream_accumulator.py
+"""
+import time
+
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+from wee_agent.stream import StreamAccumulator
+from wee_agent.utils import merge
+
+
+def make_chunks(n: int) -> list:
+    return [ChatCompletionChunk(
+        id="chatcmpl-bench", object="chat.completion.chunk", created=0,
+        model="gpt-4o",
+        choices=[{"index": 0, "delta": {"content": "token "},
+                  "finish_reason": None}])
+        for _ in range(n)]
+
+
+def per_chunk_cost(fn, chunks: list, window: int = 1000) -> list:
+    """返回每window个trunk的平均处理时间（微秒）"""
+    costs = []
+    start = time.perf_counter()
+    for i, chunk in enumerate(chunks, start=1):
+        fn(chunk)
+        if i % window == 0:
+            now = time.perf_counter()
+            costs.append((now - start) / window * 1e6)
+            start = now
+    return costs
+
+
+def bench_accumulator(chunks: list) -> list:
+    accumulator = StreamAccumulator()
+    costs = per_chunk_cost(accumulator.add, chunks)
+    accumulator.build()
+    return costs
+
+
+def bench_merge(chunks: list) -> list:
+    state = {"response": chunks[0].model_copy()}
+
+    def add(chunk):
+        state["response"] = merge(state["response"], chunk)
+
+    return per_chunk_cost(add, chunks[1:])
+
+
+if __name__ == "__main__":
+    chunks = make_chunks(10000)
+    for name, bench in (("StreamAccumulator", bench_accumulator),
+                        ("merge", bench_merge)):
+        costs = bench(chunks)
+        print(f"{name:>18}: 每个trunk耗时(us) 按每1000个trunk统计: "
+              + " ".join(f"{c:.1f}" for c in costs))
@@ -0,0 +1,46 @@
+"""
+测量VectorStore的写入速度、重新打开的耗时和精确查找的QPS。
+重新打开只映射文件，耗时与向量数无关。
+
+运行：python benchmarks/bench_vectors.py [向量数] [维度]
+"""
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from wee_agent.vectors import VectorStore
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+DIMENSION = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+BATCH = 50000
+QUERIES = 64
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        store = VectorStore(directory, dimension=DIMENSION)
+        start = time.perf_counter()
+        for offset in range(0, COUNT, BATCH):
+            rows = min(BATCH, COUNT - offset)
+            store.add(rng.standard_normal((rows, DIMENSION), dtype=np.float32),
+                      [{"text": str(i)} for i in range(offset, offset + rows)])
+        store.close()
+        added = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = VectorStore(directory)
+        opened = time.perf_counter() - start
+
+        queries = rng.standard_normal((QUERIES, DIMENSION), dtype=np.float32)
+        start = time.perf_counter()
+        for query in queries:
+            store.search_batch(query, k=10)
+        single = QUERIES / (time.perf_counter() - start)
+        start = time.perf_counter()
+        store.search_batch(queries, k=10)
+        batched = QUERIES / (time.perf_counter() - start)
+        print(f"{COUNT} x {DIMENSION}: add {COUNT / added:,.0f} vectors/s, reopen {opened * 1e3:.2f} ms, "
+              f"search {single:,.1f} QPS, batched search {batched:,.1f} QPS")
+        store.close()
@@ -20,6 +20,10 @@ setup(
         'tiktoken == 0.7.0',
         'genson==1.2.2'
     ],
+    extras_require={
+        'vector': ['numpy'],  # 语义缓存等需要向量计算的功能
+        'http2': ['h2'],  # 共享连接池使用HTTP/2
+    },
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: MIT License',
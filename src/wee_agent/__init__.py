@@ -1 +1 @@
-from wee_agent.wee_agent import WeeAgent, set_tool
+from wee_agent.wee_agent import WeeAgent, AsyncWeeAgent, set_tool
@@ -0,0 +1,206 @@
+"""
+本模块实现了VectorStore的近似最近邻索引（IVF），向量数达到百万级别时精确查找太慢，也需要太多内存带宽。
+1. 用球面k-means把归一化后的向量分成nlist个簇（倒排表），每个向量属于与它最相似的簇中心；
+2. 每个向量按簇的顺序保存一份标量量化后的编码：int8（每维按全局的最大绝对值缩放）或float16，
+   只有float32的1/4或1/2大小，同一个簇的编码连续存放；
+3. 查找时先找出与查询最相似的nprobe个簇，用编码计算这些簇中向量的近似相似度，
+   再从float32向量中读取最好的若干个候选，按完整精度重新排序。
+
+索引文件使用.npy格式，打开时内存映射，不需要读入内存。需要安装numpy：pip install wee_agent[vector]
+"""
+import logging
+import os
+from typing import Dict
+
+try:
+    import numpy as np
+except ImportError:  # numpy是可选依赖，只有VectorStore需要
+    np = None
+
+__all__ = ["IvfIndex"]
+
+_QUANTIZATIONS = ("int8", "float16")
+_FILES = ("centroids", "offsets", "rows", "codes", "scale")
+_CHUNK = 128  # 计算近似相似度时每次转换的编码行数
+
+
+def _assign(vectors, centroids, block_size: int):
+    # 每个向量最相似的簇中心，分块计算，限制临时矩阵的大小
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def _kmeans(sample, nlist: int, iterations: int, rng, block_size: int):
+    # 球面k-means：簇中心是簇中向量的均值再归一化，空的簇重新随机选择一个向量
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(sample, centroids, block_size)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[np.argsort(labels, kind="stable")],
+                                       starts[~empty], axis=0)
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms == 0, 1, norms)
+    return centroids.astype(np.float32)
+
+
+class IvfIndex:
+    """
+    倒排表索引，只保存向量所在的行号，不保存向量本身；建立索引之后追加的行不在索引中。
+    """
+
+    def __init__(self, centroids, offsets, rows, codes, scale, *, quantization: str):
+        """
+        初始化方法，一般使用build()或load()创建
+        :param centroids: float32[nlist, dimension]，归一化后的簇中心
+        :param offsets: int64[nlist + 1]，第i个簇的向量在rows和codes中的范围为offsets[i]:offsets[i+1]
+        :param rows: int64[count]，按簇排列的行号
+        :param codes: int8或float16[count, dimension]，按簇排列的量化编码
+        :param scale: float32[dimension]，int8编码每一维的缩放比例
+        :param quantization: int8或float16
+        """
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.codes = codes
+        self.scale = scale
+        self.quantization = quantization
+
+    @property
+    def nlist(self) -> int:
+        """簇的数量"""
+        return len(self.centroids)
+
+    @property
+    def count(self) -> int:
+        """索引中的行数，即建立索引时的行数"""
+        return len(self.rows)
+
+    @classmethod
+    def build(cls, vectors, *, nlist: int = None, quantization: str = "int8",
+              sample: int = None, iterations: int = 10, block_size: int = 65536,
+              seed: int = 0, prefix: str = None) -> "IvfIndex":
+        """
+        建立索引
+        :param vectors: 归一化后的float32向量，可以是内存映射数组
+        :param nlist: 簇的数量，默认为向量数的平方根
+        :param quantization: 编码的类型，int8或float16
+        :param sample: 训练簇中心使用的向量数，默认为每个簇64个
+        :param iterations: k-means的迭代次数
+        :param block_size: 每次参与矩阵乘法的行数
+        :param seed: 随机数种子
+        :param prefix: 不为None时保存为prefix.<名称>.npy，编码直接写入内存映射文件，不需要在内存中保存全部编码
+        :return: 索引
+        """
+        if quantization not in _QUANTIZATIONS:
+            raise ValueError(f"quantization must be one of {_QUANTIZATIONS}, but got {quantization}")
+        count = len(vectors)
+        nlist = max(1, min(count, nlist or int(np.sqrt(count))))
+        rng = np.random.default_rng(seed)
+        size = max(1, min(count, sample or nlist * 64))
+        nlist = min(nlist, size)  # 簇中心从训练向量中选择，不能多于训练向量
+        picked = np.sort(rng.choice(count, size, replace=False))
+        centroids = _kmeans(np.asarray(vectors[picked], dtype=np.float32), nlist,
+                            iterations, rng, block_size)
+
+        labels = _assign(vectors, centroids, block_size)
+        order = np.argsort(labels, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=offsets[1:])
+        scale = np.ones(vectors.shape[1], dtype=np.float32)
+        if quantization == "int8":
+            peak = np.zeros(vectors.shape[1], dtype=np.float32)
+            for start in range(0, count, block_size):
+                np.maximum(peak, np.abs(vectors[start:start + block_size]).max(axis=0), out=peak)
+            scale = np.where(peak == 0, 1, peak / 127).astype(np.float32)
+        if prefix is None:
+            codes = np.empty(vectors.shape, dtype=quantization)
+        else:
+            codes = np.lib.format.open_memmap(f"{prefix}.codes.npy", mode="w+",
+                                              dtype=quantization, shape=vectors.shape)
+        for start in range(0, count, block_size):
+            block = np.asarray(vectors[order[start:start + block_size]], dtype=np.float32)
+            if quantization == "int8":
+                block = np.clip(np.rint(block / scale), -127, 127)
+            codes[start:start + len(block)] = block
+        logging.info(f"建立IVF索引：{count}条向量，{nlist}个簇，{quantization}编码")
+        index = cls(centroids, offsets, order.astype(np.int64), codes, scale,
+                    quantization=quantization)
+        if prefix is not None:
+            index.save(prefix)
+        return index
+
+    def candidates(self, query, nprobe: int, number: int):
+        """
+        用量化编码找出近似最相似的行
+        :param query: 归一化后的float32查询向量
+        :param nprobe: 查找的簇的数量
+        :param number: 返回的候选数量
+        :return: 行号，不按相似度排序
+        """
+        nprobe = min(nprobe, self.nlist)
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        starts, stops = self.offsets[probed], self.offsets[probed + 1]
+        rows = np.concatenate([self.rows[start:stop] for start, stop in zip(starts, stops)])
+        if len(rows) <= number:
+            return rows
+        # 每次把_CHUNK行编码转换为float32再用BLAS计算，转换的结果留在cache中，也不需要为全部候选分配内存
+        query = query * self.scale
+        buffer = np.empty((_CHUNK, self.codes.shape[1]), dtype=np.float32)
+        scores = np.empty(len(rows), dtype=np.float32)
+        position = 0
+        for start, stop in zip(starts, stops):
+            for chunk in range(start, stop, _CHUNK):
+                size = min(_CHUNK, stop - chunk)
+                buffer[:size] = self.codes[chunk:chunk + size]
+                scores[position:position + size] = buffer[:size] @ query
+                position += size
+        return rows[np.argpartition(-scores, number - 1)[:number]]
+
+    def save(self, prefix: str) -> None:
+        """
+        保存为prefix.<名称>.npy
+        :param prefix: 文件路径的前缀
+        :return: 无
+        """
+        for name in _FILES:
+            array = getattr(self, name)
+            if isinstance(array, np.memmap) and array.filename == os.path.abspath(
+                    f"{prefix}.{name}.npy"):
+                array.flush()  # build()已经写入了同一个文件
+            else:
+                np.save(f"{prefix}.{name}.npy", array)
+
+    @classmethod
+    def load(cls, prefix: str, *, quantization: str) -> "IvfIndex":
+        """
+        内存映射save()保存的索引
+        :param prefix: 文件路径的前缀
+        :param quantization: 编码的类型
+        :return: 索引
+        """
+        arrays: Dict[str, "np.ndarray"] = {
+            name: np.load(f"{prefix}.{name}.npy", mmap_mode="r") for name in _FILES}
+        # 簇中心和缩放比例很小，每次查找都会用到，读入内存
+        arrays["centroids"] = np.array(arrays["centroids"])
+        arrays["scale"] = np.array(arrays["scale"])
+        return cls(**arrays, quantization=quantization)
+
+    @staticmethod
+    def remove(prefix: str) -> None:
+        """
+        删除save()保存的文件
+        :param prefix: 文件路径的前缀
+        :return: 无
+        """
+        for name in _FILES:
+            try:
+                os.remove(f"{prefix}.{name}.npy")
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,169 @@
+"""
+本模块用于在多个提供相同模型的服务地址之间分配请求，例如水平扩展的多个vLLM或Ollama服务。
+EndpointPool为每个请求选择一个服务地址：
+1. least_outstanding：选择正在进行的请求最少的服务；latency：选择平均延迟（指数加权移动平均）乘以排队请求数最小的服务，
+   还没有延迟数据的服务按池中的平均延迟估计，每失败一次估计值增加一倍；
+2. 被动健康检查：使用代理重试策略中每个服务地址的熔断器，连续失败的服务在冷却期间不会被选择，
+   请求失败时立刻换到另一个服务重试（failover）；
+3. 会话粘滞：sticky为True时，同一个会话的请求按会话id做rendezvous哈希，总是发往同一个服务，
+   以便命中该服务上对话前缀的KV缓存。该服务不可用时换到下一个服务，恢复后重新回到原来的服务。
+
+    pool = EndpointPool(["http://10.0.0.1:8000/v1", "http://10.0.0.2:8000/v1"], strategy="latency")
+    agent = WeeAgent(model="qwen2", content_length=32768, endpoints=pool)
+"""
+import hashlib
+import random
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+__all__ = ["EndpointPool"]
+
+STRATEGIES = ("least_outstanding", "latency")
+
+
+class _Endpoint:
+    __slots__ = ("base_url", "outstanding", "requests", "failures", "latency")
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.outstanding = 0  # 正在进行的请求数
+        self.requests = 0  # 发往该服务的请求数
+        self.failures = 0  # 失败的请求数
+        self.latency: Optional[float] = None  # 成功请求延迟的指数加权移动平均（秒）
+
+
+class EndpointPool:
+    """
+    服务地址池。线程安全，多个代理和会话可以共享同一个池，以便按全部请求的负载分配。
+    """
+
+    def __init__(self,
+                 base_urls: Sequence[str],
+                 *,
+                 strategy: str = "least_outstanding",
+                 sticky: bool = True,
+                 latency_decay: float = 0.3):
+        """
+        初始化方法
+        :param base_urls: 服务地址列表，这些服务应提供相同的模型
+        :param strategy: 分配策略，least_outstanding或latency
+        :param sticky: 是否让同一个会话的请求总是发往同一个服务
+        :param latency_decay: 延迟移动平均中最新一次请求的权重
+        """
+        if not base_urls:
+            raise ValueError("至少需要一个服务地址！")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"strategy must be one of {STRATEGIES}, but got {strategy}")
+        self.strategy = strategy
+        self.sticky = sticky
+        self.latency_decay = latency_decay
+        self._endpoints: Dict[str, _Endpoint] = {
+            url: _Endpoint(url) for url in dict.fromkeys(base_urls)}
+        self._lock = threading.Lock()
+
+    @property
+    def base_urls(self) -> List[str]:
+        return list(self._endpoints)
+
+    def _candidates(self, exclude: Iterable[str],
+                    healthy: Optional[Callable[[str], bool]]) -> List[_Endpoint]:
+        # 优先选择健康且本次调用中没有失败过的服务，都不满足时逐步放宽条件
+        endpoints = list(self._endpoints.values())
+        excluded = set(exclude)
+        alive = endpoints if healthy is None else \
+            [endpoint for endpoint in endpoints if healthy(endpoint.base_url)]
+        for group in (
+                [endpoint for endpoint in alive if endpoint.base_url not in excluded],
+                alive,
+                endpoints):
+            if group:
+                return group
+        return endpoints
+
+    def _mean_latency(self) -> Optional[float]:
+        samples = [endpoint.latency for endpoint in self._endpoints.values()
+                   if endpoint.latency is not None]
+        return sum(samples) / len(samples) if samples else None
+
+    def _score(self, endpoint: _Endpoint, mean: Optional[float]) -> float:
+        if self.strategy == "latency":
+            latency = endpoint.latency
+            if latency is None:
+                # 失败的请求不记录延迟，没有延迟数据的服务按平均延迟估计并按失败次数加罚，
+                # 否则一直失败的服务永远没有延迟数据，会一直被优先选择
+                latency = (mean if mean is not None else 1.0) * (1 + endpoint.failures)
+            return latency * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    @staticmethod
+    def _weight(key: str, base_url: str) -> bytes:
+        return hashlib.blake2b(f"{key}|{base_url}".encode(),
+                               digest_size=8).digest()
+
+    def has_alternative(self, exclude: Iterable[str],
+                        healthy: Callable[[str], bool] = None) -> bool:
+        """
+        是否还有不在exclude中的健康服务，用于决定失败后是立刻换一个服务重试，还是等待后重试
+        :param exclude: 本次调用中已经失败的服务地址
+        :param healthy: 判断服务地址是否健康的函数
+        :return: 是否有可以立刻尝试的服务
+        """
+        excluded = set(exclude)
+        return any(url not in excluded and (healthy is None or healthy(url))
+                   for url in self._endpoints)
+
+    def acquire(self,
+                affinity: str = None,
+                exclude: Iterable[str] = (),
+                healthy: Callable[[str], bool] = None) -> str:
+        """
+        为一个请求选择服务地址，并记为正在进行。请求结束后必须调用release()。
+        :param affinity: 会话id，sticky为True时同一个会话总是选择同一个服务
+        :param exclude: 本次调用中已经失败的服务地址，尽量不再选择
+        :param healthy: 判断服务地址是否健康的函数
+        :return: 服务地址
+        """
+        with self._lock:
+            candidates = self._candidates(exclude, healthy)
+            if self.sticky and affinity is not None:
+                endpoint = max(candidates,
+                               key=lambda e: self._weight(affinity, e.base_url))
+            else:
+                mean = self._mean_latency()
+                scores = [self._score(e, mean) for e in candidates]
+                best = min(scores)
+                endpoint = random.choice(
+                    [e for e, score in zip(candidates, scores) if score == best])
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint.base_url
+
+    def release(self, base_url: str, latency: float = None) -> None:
+        """
+        请求结束
+        :param base_url: acquire()返回的服务地址
+        :param latency: 成功请求的延迟（秒），请求失败时为None
+        :return: 无
+        """
+        with self._lock:
+            endpoint = self._endpoints[base_url]
+            endpoint.outstanding -= 1
+            if latency is None:
+                endpoint.failures += 1
+            elif endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += self.latency_decay * (latency - endpoint.latency)
+
+    def stats(self) -> List[Dict[str, object]]:
+        """
+        返回每个服务的统计信息
+        :return: 服务地址、正在进行的请求数、请求数、失败数和平均延迟
+        """
+        with self._lock:
+            return [{"base_url": endpoint.base_url,
+                     "outstanding": endpoint.outstanding,
+                     "requests": endpoint.requests,
+                     "failures": endpoint.failures,
+                     "latency": endpoint.latency}
+                    for endpoint in self._endpoints.values()]
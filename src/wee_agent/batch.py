@@ -0,0 +1,196 @@
+"""
+本模块用于用同一个代理处理大量输入。
+1. ResultLog是WeeAgent.map()使用的结果文件：每完成一个输入就追加一行json，中断后用同一个文件重新运行时，
+   已经成功的输入会被跳过；
+2. OpenAI Batch API：write_batch_requests()把每个输入的请求写成Batch API的JSONL请求文件，
+   submit_batch()上传并创建批处理任务，download_batch_results()在任务完成后下载结果文件，
+   read_batch_results()把结果文件转换成与map()相同的结果列表。批处理的价格更低，但不能执行tool调用。
+
+    path = "requests.jsonl"
+    write_batch_requests(agent, questions, path)
+    batch_id = submit_batch(agent.open_ai_client, path)
+    ...
+    if download_batch_results(agent.open_ai_client, batch_id, "results.jsonl"):
+        results = read_batch_results("results.jsonl", questions)
+"""
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+from wee_agent.models import MapResult
+
+__all__ = ["ResultLog", "write_batch_requests", "submit_batch",
+           "download_batch_results", "read_batch_results"]
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+_STREAM_KEYS = ("stream", "stream_options")  # 批处理不支持stream
+
+
+class ResultLog:
+    """
+    map()的结果记录，可选地保存到JSONL文件中。线程安全。
+    """
+
+    def __init__(self,
+                 inputs: Sequence[str],
+                 path: str = None,
+                 progress: Callable[[int, int], None] = None):
+        """
+        初始化方法。如果文件已经存在，读取其中成功的结果，输入内容与当前输入不同的记录会被忽略。
+        :param inputs: 全部输入
+        :param path: 结果文件路径，为None时不保存
+        :param progress: 每完成一个输入调用一次progress(已完成数, 总数)
+        """
+        self.inputs = inputs
+        self.results: List[Optional[MapResult]] = [None] * len(inputs)
+        self.progress = progress
+        self.done = 0
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            if os.path.exists(path):
+                self._load(path)
+            self._file = open(path, "a", encoding="utf-8")
+
+    def _load(self, path: str) -> None:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    result = MapResult.model_validate_json(line)
+                except ValueError:  # 中断时最后一行可能没有写完
+                    continue
+                if result.error is None and result.index < len(self.inputs) \
+                        and self.inputs[result.index] == result.input:
+                    self.results[result.index] = result
+        self.done = sum(result is not None for result in self.results)
+        logging.info(f"从{path}中恢复了{self.done}个已完成的结果")
+
+    def pending(self) -> List[int]:
+        """还没有成功结果的输入的位置"""
+        return [index for index, result in enumerate(self.results)
+                if result is None]
+
+    def record(self, result: MapResult) -> None:
+        """
+        记录一个结果，写入文件并报告进度
+        :param result: 结果
+        :return: 无
+        """
+        with self._lock:
+            self.results[result.index] = result
+            self.done += 1
+            if self._file is not None:
+                self._file.write(result.model_dump_json() + "\n")
+                self._file.flush()
+            if self.progress is not None:
+                self.progress(self.done, len(self.inputs))
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def write_batch_requests(agent, inputs: Sequence[str], path: str) -> int:
+    """
+    把每个输入的请求写成Batch API的JSONL请求文件。每个输入使用一个独立的会话，
+    请求参数与agent(input)第一次调用api时相同，custom_id为输入的位置。
+    :param agent: WeeAgent代理
+    :param inputs: 全部输入
+    :param path: 请求文件路径
+    :return: 写入的请求数
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for index, text in enumerate(inputs):
+            session = agent.new_session()
+            session.user_input(text)
+            session._prepare_messages()
+            body = session._build_payload()
+            for key in _STREAM_KEYS:
+                body.pop(key, None)
+            f.write(json.dumps({"custom_id": str(index), "method": "POST",
+                                "url": BATCH_ENDPOINT, "body": body},
+                               ensure_ascii=False) + "\n")
+    logging.info(f"写入了{len(inputs)}个批处理请求到{path}")
+    return len(inputs)
+
+
+def submit_batch(client, path: str, metadata: Dict[str, str] = None) -> str:
+    """
+    上传请求文件并创建批处理任务
+    :param client: OpenAI客户端，例如agent.open_ai_client
+    :param path: write_batch_requests()生成的请求文件
+    :param metadata: 任务的附加信息
+    :return: 批处理任务的id
+    """
+    with open(path, "rb") as f:
+        file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(input_file_id=file.id,
+                                  endpoint=BATCH_ENDPOINT,
+                                  completion_window="24h",
+                                  **({"metadata": metadata} if metadata else {}))
+    logging.info(f"创建了批处理任务{batch.id}")
+    return batch.id
+
+
+def download_batch_results(client, batch_id: str, path: str) -> bool:
+    """
+    批处理任务完成后下载结果文件
+    :param client: OpenAI客户端
+    :param batch_id: submit_batch()返回的任务id
+    :param path: 结果文件的保存路径
+    :return: 是否已经完成并下载，任务还在进行时返回False
+    :raises RuntimeError: 任务失败、过期或被取消
+    """
+    batch = client.batches.retrieve(batch_id)
+    if batch.status in ("failed", "expired", "cancelled"):
+        raise RuntimeError(f"批处理任务{batch_id}的状态为{batch.status}：{batch.errors}")
+    if batch.status != "completed":
+        logging.info(f"批处理任务{batch_id}的状态为{batch.status}：{batch.request_counts}")
+        return False
+    with open(path, "wb") as f:
+        if batch.output_file_id:
+            f.write(client.files.content(batch.output_file_id).content)
+        if batch.error_file_id:  # 失败的请求保存在单独的文件中
+            f.write(client.files.content(batch.error_file_id).content)
+    return True
+
+
+def _batch_result(line: dict, inputs: Sequence[str]) -> MapResult:
+    index = int(line["custom_id"])
+    result = MapResult(index=index, input=inputs[index])
+    response = line.get("response") or {}
+    if line.get("error"):
+        result.error = f"{line['error'].get('code')}: {line['error'].get('message')}"
+    elif response.get("status_code") != 200:
+        body = response.get("body") or {}
+        result.error = f"{response.get('status_code')}: {body.get('error', body)}"
+    else:
+        choice = response["body"]["choices"][0]
+        if choice.get("finish_reason") == "tool_calls":
+            result.error = "tool_calls: 批处理模式不能执行tool调用"
+        else:
+            result.output = choice["message"].get("content") or ""
+    return result
+
+
+def read_batch_results(path: str, inputs: Sequence[str]) -> List[MapResult]:
+    """
+    读取Batch API的结果文件
+    :param path: 结果文件路径
+    :param inputs: 生成请求文件时的全部输入
+    :return: 按输入顺序排列的结果，结果文件中没有的输入的error为"missing"
+    """
+    results: List[Optional[MapResult]] = [None] * len(inputs)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                result = _batch_result(json.loads(line), inputs)
+                results[result.index] = result
+    return [result if result is not None
+            else MapResult(index=index, input=inputs[index], error="missing")
+            for index, result in enumerate(results)]
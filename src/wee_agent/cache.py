@@ -0,0 +1,367 @@
+"""
+本模块用于缓存llm的回复。
+CompletionCache以请求参数的规范化哈希值为键，对完全相同的请求直接返回之前的回复。
+缓存分为两层：进程内有容量上限的LRU内存缓存，以及可选的SQLite文件缓存，多个进程可以共享同一个文件。
+只有在回复确定的情况下（例如temperature=0并固定seed）缓存才有意义，因此需要显式开启：
+
+    cache = CompletionCache(path="completions.sqlite", ttl=3600)
+    agent = WeeAgent(response_cache=cache)
+
+SemanticCache则按语义查找：用户的问题与之前某个问题的向量相似度超过阈值时，直接返回之前的回答。
+适用于问答类的代理，需要安装numpy：pip install wee_agent[vector]
+
+    agent = WeeAgent(semantic_cache=SemanticCache(threshold=0.92))
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, \
+    Tuple
+
+from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+from wee_agent.stream import StreamAccumulator
+
+try:
+    import numpy as np
+except ImportError:  # numpy是可选依赖，只有SemanticCache需要
+    np = None
+
+__all__ = ["CompletionCache", "completion_cache_key", "SemanticCache",
+           "prompt_fingerprint"]
+
+# 不影响回复内容的请求参数，不参与计算缓存键。stream和非stream模式的请求共享缓存
+_IGNORED_KEYS = ("stream", "stream_options")
+
+
+def completion_cache_key(payload: dict) -> str:
+    """
+    计算请求参数的缓存键。参数按键排序后序列化为json，再计算sha256。
+    :param payload: 发送给chat.completions.create的参数
+    :return: 缓存键
+    """
+    canonical = {key: value for key, value in payload.items()
+                 if key not in _IGNORED_KEYS}
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False,
+                      separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    两层的回复缓存：LRU内存缓存和可选的SQLite文件缓存。线程安全。
+    """
+
+    def __init__(self,
+                 *,
+                 max_entries: int = 1024,
+                 path: str = None,
+                 max_disk_entries: int = 100000,
+                 ttl: float = None):
+        """
+        初始化方法
+        :param max_entries: 内存缓存的最大条数，超过后淘汰最久未使用的条目
+        :param path: SQLite文件路径，为None时只使用内存缓存
+        :param max_disk_entries: 文件缓存的最大条数，超过后淘汰最久未使用的条目
+        :param ttl: 缓存的有效期（秒），为None时永不过期
+        """
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.path = path
+
+        self._memory: OrderedDict[str, Tuple[float, ChatCompletion]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0  # 文件缓存的写入次数，每写入一定次数检查一次容量
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=30,
+                                       check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires REAL, accessed REAL NOT NULL)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS completions_accessed "
+                "ON completions (accessed)")
+            logging.info(f"使用文件缓存：{path}")
+
+    def _expires(self) -> float:
+        return time.time() + self.ttl if self.ttl else float("inf")
+
+    def get(self, key: str) -> Optional[ChatCompletion]:
+        """
+        查找缓存，先查内存，再查文件。文件中找到的结果会放入内存。
+        :param key: completion_cache_key()计算的缓存键
+        :return: 缓存的回复，没有找到或已过期时返回None
+        """
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                expires, response = item
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return response
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires FROM completions WHERE key = ?",
+                    (key,)).fetchone()
+                if row is not None:
+                    value, expires = row
+                    expires = float("inf") if expires is None else expires
+                    if expires > now:
+                        self._db.execute(
+                            "UPDATE completions SET accessed = ? WHERE key = ?",
+                            (now, key))
+                        response = ChatCompletion.model_validate_json(value)
+                        self._remember(key, expires, response)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return response
+                    self._db.execute("DELETE FROM completions WHERE key = ?",
+                                     (key,))
+
+            self.misses += 1
+            return None
+
+    def _remember(self, key: str, expires: float,
+                  response: ChatCompletion) -> None:
+        # 放入内存缓存，超过容量时淘汰最久未使用的条目。调用者需持有锁
+        self._memory[key] = (expires, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def set(self, key: str, response: ChatCompletion) -> None:
+        """
+        写入缓存
+        :param key: completion_cache_key()计算的缓存键
+        :param response: 完整的回复
+        :return: 无
+        """
+        expires = self._expires()
+        with self._lock:
+            self._remember(key, expires, response)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, value, expires, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, response.model_dump_json(),
+                 None if expires == float("inf") else expires, time.time()))
+            self._writes += 1
+            if self._writes % 64 == 0:
+                self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        # 删除过期的条目，以及超出容量的最久未使用的条目。调用者需持有锁
+        self._db.execute("DELETE FROM completions WHERE expires < ?",
+                         (time.time(),))
+        count = self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        if count > self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY accessed LIMIT ?)",
+                (count - self.max_disk_entries,))
+            self.evictions += count - self.max_disk_entries
+
+    def record_stream(self, key: str,
+                      chunks: Iterator[ChatCompletionChunk]
+                      ) -> Iterator[ChatCompletionChunk]:
+        """
+        原样产生stream模式下的trunk，全部产生完毕后将合并的回复写入缓存。
+        :param key: 缓存键
+        :param chunks: api返回的trunk
+        :return: trunk生成器
+        """
+        accumulator = StreamAccumulator()
+        for chunk in chunks:
+            accumulator.add(chunk)
+            yield chunk
+        self.set(key, accumulator.build())
+
+    async def arecord_stream(self, key: str,
+                             chunks: AsyncIterator[ChatCompletionChunk]
+                             ) -> AsyncIterator[ChatCompletionChunk]:
+        """
+        record_stream的异步版本
+        :param key: 缓存键
+        :param chunks: api返回的trunk
+        :return: trunk异步生成器
+        """
+        accumulator = StreamAccumulator()
+        async for chunk in chunks:
+            accumulator.add(chunk)
+            yield chunk
+        self.set(key, accumulator.build())
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回缓存的统计信息
+        :return: 命中次数、未命中次数、内存和文件分别的命中次数、淘汰的条目数和内存中的条目数
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+            }
+
+    def clear(self) -> None:
+        """清空内存和文件中的缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM completions")
+
+    def close(self) -> None:
+        """关闭文件缓存的数据库连接"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def prompt_fingerprint(prompt: str) -> str:
+    """
+    计算系统提示词的指纹，SemanticCache只在提示词相同的对话之间共享回答。
+    :param prompt: 系统提示词
+    :return: 指纹
+    """
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+class _VectorBlock:
+    """一个提示词指纹下的全部问题向量，按行存放在float32矩阵中，写满后覆盖最早的条目"""
+    __slots__ = ("vectors", "answers", "size", "cursor")
+
+    def __init__(self, dimension: int, capacity: int):
+        self.vectors = np.zeros((min(capacity, 64), dimension), dtype=np.float32)
+        self.answers: List[Optional[str]] = [None] * len(self.vectors)
+        self.size = 0
+        self.cursor = 0
+
+    def add(self, vector, answer: str, capacity: int) -> None:
+        if self.cursor == len(self.vectors) and len(self.vectors) < capacity:
+            # 容量翻倍，直到达到上限
+            grown = min(capacity, len(self.vectors) * 2)
+            vectors = np.zeros((grown, self.vectors.shape[1]), dtype=np.float32)
+            vectors[:len(self.vectors)] = self.vectors
+            self.vectors = vectors
+            self.answers.extend([None] * (grown - len(self.answers)))
+        self.cursor %= len(self.vectors)
+        self.vectors[self.cursor] = vector
+        self.answers[self.cursor] = answer
+        self.cursor += 1
+        self.size = min(self.size + 1, len(self.vectors))
+
+
+class SemanticCache:
+    """
+    语义回答缓存。将用户问题的向量归一化后存入进程内的float32矩阵，
+    查找时用一次矩阵乘法计算与所有已缓存问题的余弦相似度，取最相似的一条。
+    只比较问题本身，不考虑更早的对话历史，适合常见问题类的代理。线程安全。
+    """
+
+    def __init__(self,
+                 *,
+                 threshold: float = 0.95,
+                 max_entries: int = 10000,
+                 embedding_model: str = "text-embedding-3-small",
+                 embed: Callable[[str], List[float]] = None):
+        """
+        初始化方法
+        :param threshold: 余弦相似度阈值，超过阈值时才返回缓存的回答
+        :param max_entries: 每个提示词下最多缓存的问题数，写满后覆盖最早的条目
+        :param embedding_model: 代理调用embeddings接口时使用的模型
+        :param embed: 自定义的向量化函数，例如本地的embedding模型。为None时由代理调用openAI的embeddings接口
+        """
+        if np is None:
+            raise ImportError(
+                "SemanticCache需要numpy，请安装：pip install wee_agent[vector]")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.embedding_model = embedding_model
+        self.embed = embed
+        self._blocks: Dict[str, _VectorBlock] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, fingerprint: str, vector) -> Optional[str]:
+        """
+        查找与问题向量最相似的已缓存问题
+        :param fingerprint: prompt_fingerprint()计算的提示词指纹
+        :param vector: 问题的向量
+        :return: 相似度超过阈值时返回对应的回答，否则返回None
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            block = self._blocks.get(fingerprint)
+            if block is not None and block.size:
+                scores = block.vectors[:block.size] @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    logging.info(f"命中语义缓存，相似度：{scores[best]:.4f}")
+                    return block.answers[best]
+            self.misses += 1
+            return None
+
+    def set(self, fingerprint: str, vector, answer: str) -> None:
+        """
+        缓存一个问题的回答
+        :param fingerprint: prompt_fingerprint()计算的提示词指纹
+        :param vector: 问题的向量
+        :param answer: 回答
+        :return: 无
+        """
+        vector = self._normalize(vector)
+        with self._lock:
+            block = self._blocks.get(fingerprint)
+            if block is None:
+                block = self._blocks[fingerprint] = _VectorBlock(
+                    len(vector), self.max_entries)
+            block.add(vector, answer, self.max_entries)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回缓存的统计信息
+        :return: 命中次数、未命中次数和缓存的问题数
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": sum(block.size for block in self._blocks.values()),
+            }
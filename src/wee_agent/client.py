@@ -0,0 +1,338 @@
+"""
+本模块是进程内共享的openAI客户端注册表。
+每个OpenAI客户端都有自己的httpx连接池，按请求创建的代理（例如register_agent注册的子代理）如果各自创建客户端，
+就无法复用连接，每次都要重新进行TCP和TLS握手。本模块按服务地址和api key缓存客户端，所有代理共享同一个连接池：
+1. configure_pool()设置连接池的大小、keep-alive时间、超时和是否使用HTTP/2，对之后创建的客户端生效；
+2. warmup_connections()在服务启动时预先建立连接，第一次请求不再等待握手；
+3. pool_stats()返回每个连接池的请求数和连接数，用于确定连接池的大小。
+异步连接属于打开它们的事件循环，共享的异步客户端为每个事件循环维护各自的连接池，多次asyncio.run()之间也可以共享。
+共享的客户端保留openai库的重试，代理调用chat接口时使用without_retries()返回的客户端，由代理的重试策略负责重试。
+
+    from wee_agent import client
+    client.configure_pool(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60)
+    client.warmup_connections(connections=4)
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+__all__ = ["configure_pool", "get_client", "get_async_client", "without_retries",
+           "warmup_connections", "awarmup_connections", "pool_stats",
+           "close_clients"]
+
+_lock = threading.RLock()
+_settings: Dict[str, object] = {
+    "max_connections": 1000,  # 连接池的最大连接数
+    "max_keepalive_connections": 100,  # 最多保持的空闲连接数
+    "keepalive_expiry": 5.0,  # 空闲连接保持的时间（秒）
+    "http2": False,  # 是否使用HTTP/2，需要安装h2
+    "timeout": 600.0,  # 读写和等待连接池的超时时间（秒）
+    "connect_timeout": 5.0,  # 建立连接的超时时间（秒）
+}  # 默认值与openai库的默认值相同
+
+
+class _PooledClient:
+    __slots__ = ("is_async", "client", "http_client", "requests", "responses")
+
+    def __init__(self, is_async: bool):
+        self.is_async = is_async
+        self.client = None
+        self.http_client: Optional[httpx.Client | httpx.AsyncClient] = None
+        self.requests = 0  # 发出的请求数
+        self.responses = 0  # 收到的响应数
+
+
+class _LoopTransport(httpx.AsyncBaseTransport):
+    """
+    按正在运行的事件循环分配连接池的异步transport。连接只能在打开它的事件循环中使用，
+    事件循环被回收后，它的连接池也随之释放，之后的事件循环不会拿到已经关闭的事件循环中的连接。
+    """
+
+    def __init__(self, **options):
+        self._options = options  # 创建每个连接池的参数：limits和http2
+        self._transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport]" = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _current(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        transport = self._transports.get(loop)
+        if transport is None:
+            with self._lock:
+                transport = self._transports.get(loop)
+                if transport is None:
+                    transport = httpx.AsyncHTTPTransport(**self._options)
+                    self._transports[loop] = transport
+        return transport
+
+    def transports(self) -> List[httpx.AsyncHTTPTransport]:
+        with self._lock:
+            return list(self._transports.values())
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._current().handle_async_request(request)
+
+    async def aclose(self) -> None:
+        # 只能关闭当前事件循环的连接，其他事件循环的连接池在事件循环被回收时释放
+        with self._lock:
+            transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_clients: Dict[Tuple[str, str, bool], _PooledClient] = {}  # (服务地址, api key的哈希值, 是否异步) -> 客户端
+_no_retry_clients: "weakref.WeakKeyDictionary[OpenAI | AsyncOpenAI, OpenAI | AsyncOpenAI]" = \
+    weakref.WeakKeyDictionary()  # 客户端 -> 关闭了openai库内部重试的客户端
+
+
+def configure_pool(**settings) -> None:
+    """
+    设置连接池参数，只对之后创建的客户端生效，已经创建的客户端可以先用close_clients()关闭。
+    :param settings: max_connections、max_keepalive_connections、keepalive_expiry、http2、timeout和connect_timeout中的任意几项
+    :return: 无
+    """
+    unknown = set(settings) - set(_settings)
+    if unknown:
+        raise ValueError(f"未知的连接池参数：{sorted(unknown)}")
+    if settings.get("http2"):
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                "使用HTTP/2需要h2，请安装：pip install wee_agent[http2]")
+    with _lock:
+        _settings.update(settings)
+    logging.info(f"设置连接池参数：{_settings}")
+
+
+def _key(base_url: Optional[str], api_key: Optional[str],
+         is_async: bool) -> Tuple[str, str, bool]:
+    api_key = api_key or openai.api_key or os.environ.get("OPENAI_API_KEY") or ""
+    return (base_url or "", hashlib.sha256(api_key.encode()).hexdigest(),
+            is_async)
+
+
+def _http_options(entry: _PooledClient) -> dict:
+    # 通过事件钩子统计请求数，异步客户端的钩子需要是协程函数
+    def on_request(request):
+        entry.requests += 1
+
+    def on_response(response):
+        entry.responses += 1
+
+    if entry.is_async:
+        async def on_request_async(request):
+            on_request(request)
+
+        async def on_response_async(response):
+            on_response(response)
+
+        hooks = {"request": [on_request_async], "response": [on_response_async]}
+    else:
+        hooks = {"request": [on_request], "response": [on_response]}
+
+    return {
+        "limits": httpx.Limits(
+            max_connections=_settings["max_connections"],
+            max_keepalive_connections=_settings["max_keepalive_connections"],
+            keepalive_expiry=_settings["keepalive_expiry"]),
+        "timeout": httpx.Timeout(_settings["timeout"],
+                                 connect=_settings["connect_timeout"]),
+        "http2": _settings["http2"],
+        "event_hooks": hooks,
+    }
+
+
+def _get(base_url: Optional[str], api_key: Optional[str],
+         is_async: bool) -> _PooledClient:
+    key = _key(base_url, api_key, is_async)
+    entry = _clients.get(key)
+    if entry is not None:
+        return entry
+    with _lock:
+        entry = _clients.get(key)
+        if entry is not None:
+            return entry
+        entry = _PooledClient(is_async)
+        options = _http_options(entry)
+        if is_async:
+            transport = _LoopTransport(limits=options.pop("limits"), http2=options.pop("http2"))
+            entry.http_client = openai.DefaultAsyncHttpxClient(transport=transport, **options)
+            client_class = AsyncOpenAI
+        else:
+            entry.http_client = openai.DefaultHttpxClient(**options)
+            client_class = OpenAI
+        entry.client = client_class(api_key=api_key or openai.api_key,
+                                    base_url=base_url,
+                                    timeout=options["timeout"],
+                                    http_client=entry.http_client)
+        _clients[key] = entry
+        logging.info(
+            f"创建共享的{'异步' if is_async else ''}openAI客户端：{entry.client.base_url}")
+        return entry
+
+
+def get_client(base_url: str = None, api_key: str = None) -> OpenAI:
+    """
+    获取共享的OpenAI客户端，服务地址和api key相同的调用返回同一个客户端。
+    :param base_url: openai服务代理，或者其他支持openai的格式的大模型服务，为None时使用openai的默认地址
+    :param api_key: api key，为None时使用openai.api_key或环境变量OPENAI_API_KEY
+    :return: OpenAI客户端
+    """
+    return _get(base_url, api_key, False).client
+
+
+def get_async_client(base_url: str = None, api_key: str = None) -> AsyncOpenAI:
+    """
+    获取共享的AsyncOpenAI客户端。每个事件循环使用各自的连接池，客户端可以在不同的事件循环中使用。
+    :param base_url: openai服务代理，或者其他支持openai的格式的大模型服务，为None时使用openai的默认地址
+    :param api_key: api key，为None时使用openai.api_key或环境变量OPENAI_API_KEY
+    :return: AsyncOpenAI客户端
+    """
+    return _get(base_url, api_key, True).client
+
+
+def without_retries(client: OpenAI | AsyncOpenAI) -> OpenAI | AsyncOpenAI:
+    """
+    返回关闭了openai库内部重试的客户端，与原客户端共享连接池，结果按客户端缓存。
+    代理调用chat接口时由重试策略负责重试，openai库再重试会让重试次数成倍增加；向量和图片等其他接口仍使用原客户端。
+    :param client: OpenAI或AsyncOpenAI客户端，其他对象（例如测试中的假客户端）原样返回
+    :return: 不重试的客户端
+    """
+    if not isinstance(client, (OpenAI, AsyncOpenAI)) or client.max_retries == 0:
+        return client
+    derived = _no_retry_clients.get(client)
+    if derived is None:
+        derived = client.with_options(max_retries=0)
+        _no_retry_clients[client] = derived
+    return derived
+
+
+def warmup_connections(base_url: str = None, api_key: str = None,
+                       connections: int = 1) -> int:
+    """
+    预先建立到服务的连接，连接建立后保存在连接池中，在keepalive_expiry内被之后的请求复用。
+    :param base_url: 服务地址，与get_client()相同
+    :param api_key: api key，与get_client()相同
+    :param connections: 同时建立的连接数，不应超过max_keepalive_connections
+    :return: 成功建立的连接数
+    """
+    entry = _get(base_url, api_key, False)
+    http_client = entry.http_client
+    target = str(entry.client.base_url)  # 发送HEAD请求即可建立连接，返回的状态码不重要
+    # 所有连接都建立后才一起放回连接池，否则先完成的连接会被之后的请求复用
+    barrier = threading.Barrier(max(1, connections))
+
+    def connect(_):
+        try:
+            with http_client.stream("HEAD", target) as response:
+                try:
+                    barrier.wait(timeout=_settings["connect_timeout"])
+                except threading.BrokenBarrierError:
+                    pass
+                response.read()  # 读完响应后连接才会被放回连接池，没有读完就关闭的连接会被断开
+            return True
+        except httpx.HTTPError as e:
+            barrier.abort()
+            logging.warning(f"预先建立到{target}的连接失败：{e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+        succeeded = sum(executor.map(connect, range(connections)))
+    logging.info(f"预先建立了{succeeded}个到{target}的连接")
+    return succeeded
+
+
+async def awarmup_connections(base_url: str = None, api_key: str = None,
+                              connections: int = 1) -> int:
+    """
+    warmup_connections()的异步版本，预先建立异步客户端的连接，需要在使用客户端的事件循环中调用。
+    :param base_url: 服务地址，与get_async_client()相同
+    :param api_key: api key，与get_async_client()相同
+    :param connections: 同时建立的连接数，不应超过max_keepalive_connections
+    :return: 成功建立的连接数
+    """
+    entry = _get(base_url, api_key, True)
+    http_client = entry.http_client
+    target = str(entry.client.base_url)
+    # 与warmup_connections()相同，所有连接都建立后才一起放回连接池
+    opened = 0
+    all_opened = asyncio.Event()
+
+    async def connect():
+        nonlocal opened
+        try:
+            async with http_client.stream("HEAD", target) as response:
+                opened += 1
+                if opened >= connections:
+                    all_opened.set()
+                try:
+                    await asyncio.wait_for(all_opened.wait(),
+                                           _settings["connect_timeout"])
+                except asyncio.TimeoutError:
+                    pass
+                await response.aread()
+            return True
+        except httpx.HTTPError as e:
+            all_opened.set()  # 有连接失败时不再等待
+            logging.warning(f"预先建立到{target}的连接失败：{e}")
+            return False
+
+    succeeded = sum(await asyncio.gather(
+        *(connect() for _ in range(connections))))
+    logging.info(f"预先建立了{succeeded}个到{target}的异步连接")
+    return succeeded
+
+
+def _connections(http_client) -> list:
+    # httpx没有公开连接池，读取httpcore连接池中的连接，读取失败时返回空列表；异步客户端合计每个事件循环的连接池
+    transport = getattr(http_client, "_transport", None)
+    transports = transport.transports() if isinstance(transport, _LoopTransport) else [transport]
+    return [connection for transport in transports
+            for connection in getattr(getattr(transport, "_pool", None), "connections", ())]
+
+
+def pool_stats() -> List[Dict[str, object]]:
+    """
+    返回每个共享客户端连接池的统计信息
+    :return: 服务地址、是否异步、请求数、响应数、当前连接数和其中的空闲连接数
+    """
+    with _lock:
+        entries = list(_clients.values())
+    stats = []
+    for entry in entries:
+        connections = _connections(entry.http_client)
+        stats.append({
+            "base_url": str(entry.client.base_url),
+            "async": entry.is_async,
+            "requests": entry.requests,
+            "responses": entry.responses,
+            "connections": len(connections),
+            "idle_connections": sum(1 for connection in connections
+                                    if connection.is_idle()),
+        })
+    return stats
+
+
+def close_clients() -> None:
+    """
+    关闭全部同步客户端的连接池，并清空注册表，之后获取的客户端会按当前的连接池参数重新创建。
+    异步客户端的连接需要在事件循环中关闭，这里只从注册表中移除。
+    :return: 无
+    """
+    with _lock:
+        entries = list(_clients.values())
+        _clients.clear()
+    for entry in entries:
+        if not entry.is_async:
+            entry.http_client.close()
+    logging.info(f"关闭了{len(entries)}个共享的openAI客户端")
@@ -7,6 +7,8 @@ MAX_TOKEN_LENGTH = {
     "gpt-4o": 128000,
     # 我们最先进的，多模式的旗舰模型，比 GPT-4 Turbo 更便宜，更快。当前指向 gpt-4o-2024-05-13 。
     "gpt-4o-2024-05-13": 128000,  # gpt-4o-2024-05-13
+    # gpt-4o-mini，价格更低、速度更快的小模型，适合处理简单的请求
+    "gpt-4o-mini": 128000,
     # gpt-4-turbo # 带有视觉功能
     "gpt-4-0125-preview": 128000,
     # GPT-4 Turbo 预览模型旨在减少模型不完成任务的“懒惰”情况。返回最多 4096 个输出令牌。了解更多。
@@ -41,5 +43,7 @@ RESET = "\033[0m"  # 重置颜色
 MAGENTA = "\033[35m"  # 洋红色文本
 CYAN = "\033[36m"  # 青色文本
 
-# 设置重试: 每个数字表示多少秒后重试, tuple的长度表示重试次数
-RETRY = (3, 30, 60)
+# 设置重试: 最多尝试的次数（包括第一次），以及指数退避的初始和最大等待时间（秒），参见wee_agent.retry
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
@@ -6,3 +6,23 @@ class AgentExecToolError(Exception):
 class RegisterToolError(Exception):
     def __init__(self, message):
         self.message = message
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class RateLimitExceededError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class SnapshotFormatError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class StoreClosedError(Exception):
+    def __init__(self, message):
+        self.message = message
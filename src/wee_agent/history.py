@@ -0,0 +1,135 @@
+"""本模块用于存储代理的历史对话消息"""
+import bisect
+import itertools
+from array import array
+from typing import List, Optional
+
+__all__ = ["MessageHistory"]
+
+
+class MessageHistory:
+    """
+    代理的历史消息存储。消息按压入的顺序编号（绝对位置），消息窗口的头尾指针都使用绝对位置。
+    每条消息保存消息对象和序列化后的结果，token数、token数前缀和以及每轮对话起点的位置使用array紧凑存储。
+
+    retention为保留策略：消息窗口头部之前最多保留多少条已被裁剪的消息。为None时保留全部历史；
+    为0时被裁剪的消息会尽快释放。释放是批量进行的：可释放的消息达到已保留消息的一半（至少32条）时才整体释放，
+    因此每条消息的平均释放开销是固定的，而保留的消息数不超过窗口大小与retention之和的两倍左右。
+    """
+
+    __slots__ = ("retention", "offset", "messages", "payloads", "tokens",
+                 "_prefix", "round_starts")
+
+    def __init__(self, retention: Optional[int] = None):
+        """
+        初始化方法
+        :param retention: 消息窗口头部之前最多保留的消息数，为None时保留全部历史
+        """
+        self.retention: Optional[int] = retention
+        self.offset: int = 0  # 已释放的消息数，即第一条保留消息的绝对位置
+        self.messages: List = []  # 保留的消息对象
+        self.payloads: List[dict] = []  # 保留消息序列化后的结果
+        self.tokens = array("q")  # 保留消息的token数
+        self._prefix = array("q", [0])  # _prefix[i]为绝对位置offset+i之前全部消息的token数之和
+        self.round_starts = array("q")  # 保留的每轮对话起点（用户消息）的绝对位置
+
+    @property
+    def end(self) -> int:
+        """下一条消息的绝对位置，也就是压入过的消息总数"""
+        return self.offset + len(self.messages)
+
+    def start_at(self, position: int) -> None:
+        """
+        让第一条消息从绝对位置position开始，用于从会话存储中只恢复消息窗口中的消息。只能在没有消息时调用
+        :param position: 第一条消息的绝对位置
+        :return: 无
+        """
+        if self.messages:
+            raise ValueError("start_at() can only be called on an empty history")
+        self.offset = position
+
+    def append(self, message, payload: dict, tokens: int) -> None:
+        """
+        压入一条消息
+        :param message: 消息对象
+        :param payload: 序列化后的消息
+        :param tokens: 消息的token数
+        :return: 无
+        """
+        if message.role == "user":
+            self.round_starts.append(self.end)
+        self.messages.append(message)
+        self.payloads.append(payload)
+        self.tokens.append(tokens)
+        self._prefix.append(self._prefix[-1] + tokens)
+
+    def extend(self, messages: list, payloads: List[dict], tokens) -> None:
+        """
+        批量压入消息，用于恢复会话，比逐条append快
+        :param messages: 消息对象
+        :param payloads: 序列化后的消息
+        :param tokens: 每条消息的token数
+        :return: 无
+        """
+        tokens = array("q", tokens)
+        end = self.end
+        self.round_starts.extend(end + i for i, payload in enumerate(payloads)
+                                 if payload["role"] == "user")
+        self.messages.extend(messages)
+        self.payloads.extend(payloads)
+        self.tokens.extend(tokens)
+        self._prefix.extend(itertools.islice(
+            itertools.accumulate(tokens, initial=self._prefix[-1]), 1, None))
+
+    def prefix(self, position: int) -> int:
+        """
+        绝对位置position之前全部消息的token数之和，position不能早于已释放的消息
+        :param position: 绝对位置
+        :return: token数之和
+        """
+        return self._prefix[position - self.offset]
+
+    def token_sum(self, head: int, tail: int) -> int:
+        """
+        [head, tail)之间消息的token数之和
+        :param head: 起点的绝对位置
+        :param tail: 终点的绝对位置
+        :return: token数之和
+        """
+        return self._prefix[tail - self.offset] - self._prefix[head - self.offset]
+
+    def window(self, head: int, tail: int) -> list:
+        """[head, tail)之间的消息对象"""
+        return self.messages[head - self.offset:tail - self.offset]
+
+    def window_payloads(self, head: int, tail: int) -> List[dict]:
+        """[head, tail)之间序列化后的消息"""
+        return self.payloads[head - self.offset:tail - self.offset]
+
+    def next_round_index(self, position: int) -> int:
+        """
+        round_starts中第一个位于position之后的对话起点的下标
+        :param position: 绝对位置
+        :return: round_starts中的下标
+        """
+        return bisect.bisect_right(self.round_starts, position)
+
+    def release(self, head: int) -> int:
+        """
+        按保留策略释放消息窗口头部之前的消息
+        :param head: 消息窗口头部的绝对位置
+        :return: 释放的消息数
+        """
+        if self.retention is None:
+            return 0
+        releasable = max(0, head - self.retention - self.offset)
+        if releasable == 0 or releasable < max(32, len(self.messages) // 2):
+            return 0
+        del self.messages[:releasable]
+        del self.payloads[:releasable]
+        del self.tokens[:releasable]
+        del self._prefix[:releasable]
+        self.offset += releasable
+        del self.round_starts[:bisect.bisect_left(self.round_starts,
+                                                  self.offset)]
+        return releasable
@@ -1,11 +1,11 @@
 """本模块定义了用于生成对话完成的请求的数据模型。"""
-from typing import List, Dict, Literal, Optional
+from typing import List, Dict, Literal, Optional, Tuple
 
 from openai.types.chat.chat_completion_chunk import \
     ChoiceDelta  # stream模式下返回的消息
 from openai.types.chat.chat_completion_message import \
     ChatCompletionMessage  # 问答模式下返回的消息
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, SkipValidation
 
 
 class Completion(BaseModel):
@@ -82,7 +82,7 @@ class Completion(BaseModel):
     stream_options: Optional[StreamOptions] = StreamOptions(include_usage=False)
     temperature: Optional[float] = Field(1.0, ge=0.0, le=2.0)
     top_p: Optional[float] = Field(None, ge=0.0, le=1.0)
-    tools: Optional[List[Dict]] = None
+    tools: SkipValidation[Optional[List[Dict] | Tuple[Dict, ...]]] = None  # 由set_tool生成，不再校验，同一个类的实例共享同一个元组
     tool_choice: Optional[Literal['none', 'auto', 'required']] = "auto"
     parallel_tool_calls: Optional[bool] = True
     user: Optional[str] = None
@@ -100,3 +100,55 @@ class Tool(BaseModel):
 
     type: Literal['function'] = Field(default='function')
     function: Function
+
+
+class StreamEvent(BaseModel):
+    """stream_events()逐步产生的事件的基类，使用type区分事件类型"""
+    type: Literal['text_delta', 'tool_call_started', 'tool_result', 'usage',
+                  'finish']
+
+
+class TextDelta(StreamEvent):
+    """llm新生成的一段文本"""
+    type: Literal['text_delta'] = 'text_delta'
+    content: str
+
+
+class ToolCallStarted(StreamEvent):
+    """llm要求调用一个tool，即将开始执行"""
+    type: Literal['tool_call_started'] = 'tool_call_started'
+    tool_call_id: str
+    name: str
+    arguments: str  # json字符串
+
+
+class ToolResult(StreamEvent):
+    """tool执行完毕，结果已经压入消息队列"""
+    type: Literal['tool_result'] = 'tool_result'
+    tool_call_id: str
+    name: str
+    content: str
+
+
+class Usage(StreamEvent):
+    """一次api调用的token消耗"""
+    type: Literal['usage'] = 'usage'
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+    cached_tokens: int = 0  # prompt中命中服务端缓存的token数
+
+
+class Finish(StreamEvent):
+    """对话结束，content为本次create的完整回复"""
+    type: Literal['finish'] = 'finish'
+    finish_reason: str
+    content: str
+
+
+class MapResult(BaseModel):
+    """map()和批处理中一个输入的结果，output和error中只有一个不为None"""
+    index: int  # 输入的位置
+    input: str
+    output: Optional[str] = None
+    error: Optional[str] = None  # 出错时为错误类型和信息
@@ -0,0 +1,203 @@
+"""
+本模块是客户端的限流器，在发送请求前按每分钟请求数（RPM）和每分钟token数（TPM）控制发送速度。
+各个代理独立发送请求时，只能在收到429之后才知道超过了限制，随后的重试又会造成更多的429。
+RateLimiter使用两个令牌桶：请求桶每个请求消耗1，token桶消耗请求的prompt token估算值；
+收到回复后再按response.usage中实际消耗的token数修正token桶。
+令牌不足时，调用者等待到令牌足够为止，或者在需要等待的时间超过max_wait时立刻抛出RateLimitExceededError。
+
+同一个进程中的代理共享同一个RateLimiter实例即可；多个进程可以使用同一个SQLite文件共享限额：
+
+    limiter = RateLimiter(rpm=500, tpm=200000, path="limits.sqlite")
+    agent = WeeAgent(rate_limiter=limiter)
+"""
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from wee_agent.errors import RateLimitExceededError
+
+__all__ = ["RateLimiter"]
+
+
+class RateLimiter:
+    """
+    RPM和TPM令牌桶限流器。令牌可以预支：请求获准后立刻扣除令牌，余额为负时之后的请求需要等待余额恢复，
+    因此等待的请求按到达的顺序均匀地发出，而不是同时醒来争抢。线程安全，使用SQLite时进程安全。
+    """
+
+    def __init__(self,
+                 *,
+                 rpm: float = None,
+                 tpm: float = None,
+                 max_wait: float = None,
+                 path: str = None,
+                 name: str = "default"):
+        """
+        初始化方法
+        :param rpm: 每分钟最多发送的请求数，为None时不限制
+        :param tpm: 每分钟最多消耗的token数，为None时不限制
+        :param max_wait: 最多等待的秒数，需要等待更久时抛出RateLimitExceededError；为0时从不等待，为None时一直等待
+        :param path: SQLite文件路径，多个进程使用同一个文件和name时共享限额，为None时只在进程内共享
+        :param name: 限额的名称，同一个文件中可以保存多个互不影响的限额，例如每个api key一个
+        """
+        self.capacity: Dict[str, float] = {}  # 桶的容量，即一分钟的限额
+        if rpm:
+            self.capacity["requests"] = float(rpm)
+        if tpm:
+            self.capacity["tokens"] = float(tpm)
+        self.max_wait = max_wait
+        self.name = name
+        self.path = path
+
+        self._levels: Dict[str, float] = dict(self.capacity)  # 桶中的令牌数，可以为负
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.admitted = 0
+        self.rejected = 0
+        self.waited = 0.0  # 累计等待的秒数
+
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=30,
+                                       check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits ("
+                "name TEXT NOT NULL, kind TEXT NOT NULL, level REAL NOT NULL, "
+                "updated REAL NOT NULL, PRIMARY KEY (name, kind))")
+            logging.info(f"使用文件共享限额：{path}")
+
+    def _read(self, now: float) -> Dict[str, float]:
+        # 读取桶中的令牌数，并按经过的时间补充令牌
+        if self._db is None:
+            levels, updated = self._levels, {kind: self._updated
+                                             for kind in self.capacity}
+        else:
+            rows = self._db.execute(
+                "SELECT kind, level, updated FROM rate_limits WHERE name = ?",
+                (self.name,)).fetchall()
+            levels = {kind: level for kind, level, _ in rows}
+            updated = {kind: stamp for kind, _, stamp in rows}
+        return {kind: min(capacity,
+                          levels.get(kind, capacity)
+                          + max(0.0, now - updated.get(kind, now)) * capacity / 60)
+                for kind, capacity in self.capacity.items()}
+
+    def _write(self, levels: Dict[str, float], now: float) -> None:
+        if self._db is None:
+            self._levels, self._updated = levels, now
+        else:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rate_limits (name, kind, level, updated) "
+                "VALUES (?, ?, ?, ?)",
+                [(self.name, kind, level, now) for kind, level in levels.items()])
+
+    def _update(self, costs: Dict[str, float], check: bool) -> float:
+        """
+        在一个事务中补充令牌、扣除消耗
+        :param costs: 每个桶需要扣除的令牌数
+        :param check: 是否检查等待时间，为False时直接扣除
+        :return: 需要等待的秒数
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                levels = self._read(now)
+                for kind, cost in costs.items():
+                    if kind in levels:
+                        levels[kind] -= cost
+                # 余额为负的桶需要等待令牌补充到0
+                wait = max([-level * 60 / self.capacity[kind]
+                            for kind, level in levels.items() if level < 0],
+                           default=0.0)
+                if check and self.max_wait is not None and wait > self.max_wait:
+                    self.rejected += 1
+                else:
+                    self._write(levels, now)
+                    if check:
+                        self.admitted += 1
+                        self.waited += wait
+                if self._db is not None:
+                    self._db.execute("COMMIT")
+            except BaseException:
+                if self._db is not None:
+                    self._db.execute("ROLLBACK")
+                raise
+        return wait
+
+    def reserve(self, tokens: int = 0) -> float:
+        """
+        为一个请求预支令牌
+        :param tokens: 请求的token估算值
+        :return: 发送请求前需要等待的秒数
+        :raises RateLimitExceededError: 需要等待的时间超过了max_wait，此时不会扣除令牌
+        """
+        if not self.capacity:
+            return 0.0
+        wait = self._update({"requests": 1, "tokens": tokens}, check=True)
+        if self.max_wait is not None and wait > self.max_wait:
+            raise RateLimitExceededError(
+                f"需要等待{wait:.2f}秒才能发送请求，超过了{self.max_wait}秒！")
+        return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        预支令牌，并阻塞等待到可以发送请求
+        :param tokens: 请求的token估算值
+        :return: 等待的秒数
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logging.info(f"触发客户端限流，等待{wait:.2f}秒")
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        """
+        acquire()的异步版本，等待时不阻塞事件循环
+        :param tokens: 请求的token估算值
+        :return: 等待的秒数
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            logging.info(f"触发客户端限流，等待{wait:.2f}秒")
+            await asyncio.sleep(wait)
+        return wait
+
+    def reconcile(self, estimated: int, actual: int) -> None:
+        """
+        收到回复后，按实际消耗的token数修正token桶
+        :param estimated: 发送前预支的token数
+        :param actual: response.usage中实际消耗的token数
+        :return: 无
+        """
+        if "tokens" in self.capacity and actual != estimated:
+            self._update({"tokens": actual - estimated}, check=False)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        返回限流器的统计信息
+        :return: 获准的请求数、被拒绝的请求数、累计等待的秒数，以及每个桶当前的令牌数
+        """
+        with self._lock:
+            levels = self._read(time.time())
+            return {
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "waited": self.waited,
+                **{f"{kind}_available": level for kind, level in levels.items()},
+            }
+
+    def close(self) -> None:
+        """关闭SQLite连接"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
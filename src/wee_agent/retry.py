@@ -0,0 +1,289 @@
+"""
+本模块是调用llm失败时的重试策略。
+RetryPolicy决定一次失败的调用是否重试、重试前等待多久：
+1. 等待时间按指数退避并加入完全随机的抖动（full jitter），即在[0, min(max_delay, base_delay * 2 ** attempt))中随机取值，
+   避免大量请求在同一时刻重试；
+2. 服务端在响应头中给出retry-after-ms或Retry-After时，按服务端的提示等待；
+3. 重试预算：成功的调用积累预算，失败的调用消耗预算，预算低于一半时不再重试。
+   服务整体出问题时重试不会成倍放大请求量，吞吐平滑下降而不是卡在重试中；
+4. 熔断：同一个服务地址连续失败达到阈值后，在冷却时间内直接抛出CircuitOpenError，冷却后放行一个试探请求。
+
+默认情况下进程内的所有代理共享同一个策略，也就共享重试预算和熔断状态：
+
+    policy = RetryPolicy(max_attempts=6, max_delay=30)
+    agent = WeeAgent(retry_policy=policy)
+"""
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import openai
+
+from wee_agent.config import RETRY_BASE_DELAY, RETRY_MAX_ATTEMPTS, \
+    RETRY_MAX_DELAY
+from wee_agent.errors import CircuitOpenError
+
+__all__ = ["RetryPolicy", "RetryBudget", "CircuitBreaker",
+           "default_retry_policy"]
+
+# 服务端或网络的问题，计入熔断
+_SERVER_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+# 可以重试的错误，APITimeoutError是APIConnectionError的子类
+_RETRYABLE_ERRORS = _SERVER_ERRORS + (openai.RateLimitError,
+                                      openai.ConflictError)
+
+
+class RetryBudget:
+    """
+    重试预算，与gRPC的重试限流相同：预算从max_tokens开始，每次失败减1，每次成功加token_ratio，
+    不超过max_tokens；预算不高于max_tokens的一半时不允许重试。线程安全。
+    """
+
+    def __init__(self, *, max_tokens: float = 100, token_ratio: float = 0.1):
+        """
+        初始化方法
+        :param max_tokens: 预算的上限，也是初始值
+        :param token_ratio: 每次成功的调用恢复的预算，越小则失败后恢复得越慢
+        """
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self._tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> float:
+        return self._tokens
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.token_ratio)
+
+    def record_failure(self) -> bool:
+        """
+        记录一次失败
+        :return: 是否还允许重试
+        """
+        with self._lock:
+            self._tokens = max(0.0, self._tokens - 1)
+            return self._tokens > self.max_tokens / 2
+
+
+class CircuitBreaker:
+    """
+    单个服务地址的熔断器。连续失败threshold次后断开，cooldown秒后放行一个试探请求，
+    试探成功则恢复，失败则再次断开。线程安全。
+    """
+
+    def __init__(self, *, threshold: int = 5, cooldown: float = 30.0):
+        """
+        初始化方法
+        :param threshold: 断开前允许的连续失败次数
+        :param cooldown: 断开后等待多久（秒）放行试探请求
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0  # 连续失败的次数
+        self.opened_at: Optional[float] = None  # 断开的时间，为None时处于闭合状态
+        self._probing = False  # 是否已经放行了试探请求
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """closed、open或half_open"""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        """
+        是否允许发出请求
+        :return: 闭合状态下总是允许；冷却后只允许一个试探请求
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release(self) -> None:
+        """
+        一次请求结束。试探请求没有得到成功或失败的结论就结束时（例如被取消、被客户端限流拒绝、
+        因为超长被裁剪），放行下一个试探请求，否则熔断器会一直处于半开状态而不再放行任何请求。
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                logging.warning(f"连续失败{self.failures}次，熔断{self.cooldown}秒")
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class RetryPolicy:
+    """
+    重试策略，组合了指数退避、服务端提示、重试预算和按服务地址的熔断器。可以在多个代理之间共享。
+    """
+
+    def __init__(self,
+                 *,
+                 max_attempts: int = RETRY_MAX_ATTEMPTS,
+                 base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY,
+                 max_retry_after: float = 120.0,
+                 budget: RetryBudget = None,
+                 breaker_threshold: int = 5,
+                 breaker_cooldown: float = 30.0):
+        """
+        初始化方法
+        :param max_attempts: 一次调用最多尝试的次数，包括第一次
+        :param base_delay: 指数退避的初始等待时间（秒）
+        :param max_delay: 指数退避的最大等待时间（秒）
+        :param max_retry_after: 服务端提示的等待时间的上限（秒）
+        :param budget: 重试预算，为None时创建一个新的预算
+        :param breaker_threshold: 熔断前允许的连续失败次数
+        :param breaker_cooldown: 熔断的冷却时间（秒）
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = budget if budget is not None else RetryBudget()
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        """
+        获取服务地址的熔断器
+        :param endpoint: 服务地址
+        :return: 熔断器
+        """
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    endpoint, CircuitBreaker(threshold=self.breaker_threshold,
+                                             cooldown=self.breaker_cooldown))
+        return breaker
+
+    def check(self, endpoint: str) -> None:
+        """
+        发送请求前检查熔断状态
+        :param endpoint: 服务地址
+        :return: 无
+        :raises CircuitOpenError: 服务地址处于熔断状态
+        """
+        if not self.breaker(endpoint).allow():
+            raise CircuitOpenError(f"{endpoint} 连续调用失败，暂停调用！")
+
+    def release(self, endpoint: str) -> None:
+        """
+        一次请求结束，无论成功、失败还是被取消，都要调用，释放半开状态下的试探名额
+        :param endpoint: 服务地址
+        :return: 无
+        """
+        self.breaker(endpoint).release()
+
+    def on_success(self, endpoint: str) -> None:
+        """
+        记录一次成功的调用
+        :param endpoint: 服务地址
+        :return: 无
+        """
+        self.breaker(endpoint).record_success()
+        self.budget.record_success()
+
+    def on_failure(self, endpoint: str, error: Exception,
+                   attempt: int) -> Optional[float]:
+        """
+        记录一次失败的调用，并决定是否重试
+        :param endpoint: 服务地址
+        :param error: 调用抛出的错误
+        :param attempt: 之前已经重试的次数，第一次调用失败时为0
+        :return: 重试前需要等待的秒数，不应重试时返回None
+        """
+        if isinstance(error, _SERVER_ERRORS):
+            self.breaker(endpoint).record_failure()
+        elif isinstance(error, openai.APIStatusError):
+            self.breaker(endpoint).record_success()  # 服务能正常响应，只是拒绝了请求
+        if not isinstance(error, _RETRYABLE_ERRORS):
+            return None
+        if not self.budget.record_failure():
+            logging.warning("重试预算已用完，不再重试！")
+            return None
+        if attempt + 1 >= self.max_attempts:
+            return None
+        return self.delay(attempt, error)
+
+    def delay(self, attempt: int, error: Exception = None) -> float:
+        """
+        计算重试前的等待时间。服务端给出提示时按提示等待，否则按指数退避随机取值。
+        :param attempt: 之前已经重试的次数
+        :param error: 调用抛出的错误
+        :return: 等待的秒数
+        """
+        hint = self.retry_after(error)
+        if hint is not None:
+            return min(hint, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(error: Exception) -> Optional[float]:
+        """
+        读取错误响应头中服务端建议的等待时间
+        :param error: 调用抛出的错误
+        :return: 等待的秒数，没有提示时返回None
+        """
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        headers = response.headers
+        try:
+            if headers.get("retry-after-ms"):
+                return max(0.0, float(headers["retry-after-ms"]) / 1000)
+            value = headers.get("retry-after")
+            if not value:
+                return None
+            try:
+                return max(0.0, float(value))
+            except ValueError:  # HTTP日期格式
+                retry_at = email.utils.parsedate_to_datetime(value)
+                return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+_default_policy: Optional[RetryPolicy] = None
+_default_lock = threading.Lock()
+
+
+def default_retry_policy() -> RetryPolicy:
+    """
+    进程内共享的默认重试策略，没有指定retry_policy的代理都使用它
+    :return: 默认的重试策略
+    """
+    global _default_policy
+    if _default_policy is None:
+        with _default_lock:
+            if _default_policy is None:
+                _default_policy = RetryPolicy()
+    return _default_policy
@@ -0,0 +1,173 @@
+"""
+本模块用于为每次调用llm选择模型。代理只绑定一个模型时，简单的问题也要交给又慢又贵的大模型处理。
+ModelRouter按从便宜到昂贵的顺序保存多个模型，每次请求：
+1. 按规则过滤：prompt的token估算值不超过模型的max_prompt_tokens，请求带tools时模型需要支持tools，
+   消息中有图片时模型需要支持图片；
+2. 级联（cascade）：先用第一个符合条件的模型，调用失败、遇到限流，或者回复没有通过校验
+   （response_format为json_object时回复不是合法的json，或者自定义的validate返回False）时，升级到下一个模型。
+   遇到限流时不等待重试，直接换下一个模型，不同模型的限额相互独立。
+   stream模式下回复的trunk在生成的同时就交给了调用者，无法收回，因此不校验回复，只在调用失败或限流时升级。
+
+    router = ModelRouter([ModelRoute("gpt-4o-mini", max_prompt_tokens=4000), ModelRoute("gpt-4o", vision=True)])
+    agent = WeeAgent(model="gpt-4o", router=router)
+
+代理的model和content_length仍然决定消息窗口的大小，应设置为其中上下文最长的模型。所有模型使用代理的同一个客户端或服务地址池。
+"""
+import json
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+import openai
+
+from wee_agent.config import MAX_TOKEN_LENGTH
+
+__all__ = ["ModelRoute", "ModelRouter"]
+
+
+class ModelRoute:
+    """
+    一个可以被选择的模型及其适用条件
+    """
+
+    def __init__(self,
+                 model: str,
+                 *,
+                 context_length: int = None,
+                 max_prompt_tokens: int = None,
+                 tools: bool = True,
+                 vision: bool = False):
+        """
+        初始化方法
+        :param model: 模型名称
+        :param context_length: 模型的上下文长度，为None时从MAX_TOKEN_LENGTH中查找
+        :param max_prompt_tokens: prompt的token估算值超过该值时不使用本模型，默认为上下文长度的0.9，
+                                  设置得更小可以只把短小的请求交给本模型
+        :param tools: 模型是否支持tools
+        :param vision: 模型是否支持图片输入
+        """
+        if context_length is None:
+            if model not in MAX_TOKEN_LENGTH:
+                raise ValueError(f"请输入模型 {model} 的上下文长度参数！")
+            context_length = MAX_TOKEN_LENGTH[model]
+        self.model = model
+        self.context_length = context_length
+        self.max_prompt_tokens = max_prompt_tokens if max_prompt_tokens is not None \
+            else int(context_length * 0.9)
+        self.tools = tools
+        self.vision = vision
+
+    def __repr__(self):
+        return f"ModelRoute(model='{self.model}', max_prompt_tokens={self.max_prompt_tokens}, " \
+               f"tools={self.tools}, vision={self.vision})"
+
+    def accepts(self, prompt_tokens: int, tools: bool, images: bool) -> bool:
+        """
+        本模型能否处理请求
+        :param prompt_tokens: prompt的token估算值
+        :param tools: 请求是否带有tools
+        :param images: 消息中是否有图片
+        :return: 是否能处理
+        """
+        return prompt_tokens <= self.max_prompt_tokens \
+            and (self.tools or not tools) and (self.vision or not images)
+
+
+def _has_images(messages: List[dict]) -> bool:
+    return any(isinstance(message.get("content"), list)
+               and any(part.get("type") == "image_url"
+                       for part in message["content"])
+               for message in messages)
+
+
+class ModelRouter:
+    """
+    按规则和级联为每次请求选择模型。线程安全，多个代理可以共享同一个路由器及其统计信息。
+    """
+
+    def __init__(self,
+                 routes: Sequence[ModelRoute | str],
+                 *,
+                 escalate_on_error: bool = True,
+                 validate: Callable[[str], bool] = None):
+        """
+        初始化方法
+        :param routes: 按从便宜到昂贵的顺序排列的模型，字符串表示使用默认条件的模型
+        :param escalate_on_error: 调用失败（重试之后仍然失败）时是否升级到下一个模型，限流时总是升级
+        :param validate: 自定义的回复校验函数，参数为回复的文本，返回False时升级到下一个模型；stream模式下不校验
+        """
+        if not routes:
+            raise ValueError("至少需要一个模型！")
+        self.routes: List[ModelRoute] = [
+            route if isinstance(route, ModelRoute) else ModelRoute(route)
+            for route in routes]
+        self.escalate_on_error = escalate_on_error
+        self.validate = validate
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = {route.model: 0 for route in self.routes}  # 每个模型的调用次数
+        self.escalations: Dict[str, int] = {route.model: 0 for route in self.routes}  # 每个模型升级的次数
+
+    def candidates(self, payload: dict, prompt_tokens: int) -> List[ModelRoute]:
+        """
+        按顺序返回能处理请求的模型
+        :param payload: 请求参数
+        :param prompt_tokens: prompt的token估算值
+        :return: 能处理请求的模型；都不能处理时只返回最后一个模型，由服务端决定是否接受
+        """
+        tools = bool(payload.get("tools"))
+        images = _has_images(payload["messages"])
+        routes = [route for route in self.routes
+                  if route.accepts(prompt_tokens, tools, images)]
+        if not routes:
+            logging.warning(f"没有模型能处理{prompt_tokens}个token的请求，使用{self.routes[-1].model}")
+            routes = self.routes[-1:]
+        return routes
+
+    def should_escalate(self, error: Exception) -> bool:
+        """
+        调用失败时是否升级到下一个模型
+        :param error: 调用抛出的错误
+        :return: 是否升级
+        """
+        if isinstance(error, openai.RateLimitError):
+            return True
+        return self.escalate_on_error and isinstance(error, openai.OpenAIError)
+
+    def accept(self, content: Optional[str], json_mode: bool = False) -> bool:
+        """
+        校验回复。json_mode为True时回复需要是合法的json，设置了validate时还需要通过validate。
+        :param content: 回复的文本
+        :param json_mode: 请求的response_format是否为json_object
+        :return: 是否通过校验
+        """
+        if content is None:  # tool调用
+            return True
+        if json_mode:
+            try:
+                json.loads(content)
+            except ValueError:
+                return False
+        return self.validate is None or self.validate(content)
+
+    def record(self, model: str, escalated: bool) -> None:
+        """
+        记录一次调用
+        :param model: 模型名称
+        :param escalated: 是否因为失败或没有通过校验升级到了下一个模型
+        :return: 无
+        """
+        with self._lock:
+            self.requests[model] += 1
+            if escalated:
+                self.escalations[model] += 1
+
+    def stats(self) -> List[Dict[str, object]]:
+        """
+        返回每个模型的统计信息
+        :return: 模型名称、调用次数和升级次数
+        """
+        with self._lock:
+            return [{"model": route.model,
+                     "requests": self.requests[route.model],
+                     "escalations": self.escalations[route.model]}
+                    for route in self.routes]
@@ -0,0 +1,157 @@
+"""
+本模块用于在一个进程中同时服务大量对话。
+AgentRuntime以一个配置好的代理为模板，按会话id创建和查找轻量的会话（WeeAgent.new_session()）。
+所有会话共享模板的提示词、模型、tools、openAI客户端和缓存，每个会话只保存自己的历史消息和token消耗记录。
+模板设置了session_store时，不在内存中的会话（新进程或已被淘汰）在第一次访问时从存储中恢复：
+
+    runtime = AgentRuntime(MyAgent(prompt="..."), max_sessions=50000, idle_timeout=1800)
+    answer = runtime("user-42", "你好")
+    answer = await async_runtime.acall("user-42", "你好")  # 模板为AsyncWeeAgent时
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from wee_agent.wee_agent import WeeAgent
+
+__all__ = ["AgentRuntime"]
+
+
+class AgentRuntime:
+    """
+    多会话运行时。会话按最近使用的顺序保存，超过max_sessions或空闲超过idle_timeout的会话会被淘汰。
+    查找和创建会话是线程安全的；同一个会话不应被同时调用。
+    """
+
+    def __init__(self,
+                 agent: WeeAgent,
+                 *,
+                 max_sessions: int = None,
+                 idle_timeout: float = None):
+        """
+        初始化方法
+        :param agent: 作为模板的代理，tools应在创建运行时之前注册完毕
+        :param max_sessions: 最多保存的会话数，超过后淘汰最久未使用的会话，为None时不限制
+        :param idle_timeout: 会话的最大空闲时间（秒），超过后会被淘汰，为None时不过期
+        """
+        self.agent = agent
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+
+        self._sessions: OrderedDict[str, Tuple[float, WeeAgent]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.created = 0
+        self.resumed = 0
+        self.evictions = 0
+        logging.info(
+            f"创建多会话运行时：max_sessions={max_sessions}, idle_timeout={idle_timeout}")
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def _expire(self, now: float) -> None:
+        # 会话按最近使用的顺序排列，从最久未使用的一端开始淘汰，遇到未过期的会话即停止
+        if self.idle_timeout is not None:
+            deadline = now - self.idle_timeout
+            while self._sessions:
+                used, _ = next(iter(self._sessions.values()))
+                if used > deadline:
+                    break
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+        if self.max_sessions is not None:
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, session_id: str) -> Optional[WeeAgent]:
+        """
+        查找会话，不会创建新的会话
+        :param session_id: 会话id
+        :return: 会话，不存在或已过期时返回None
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            item = self._sessions.get(session_id)
+            if item is None:
+                return None
+            self._sessions[session_id] = (now, item[1])
+            self._sessions.move_to_end(session_id)
+            return item[1]
+
+    def session(self, session_id: str, user_name: str = None) -> WeeAgent:
+        """
+        查找会话，不存在时以模板代理创建一个新的会话，模板设置了会话存储时先从存储中恢复
+        :param session_id: 会话id
+        :param user_name: 新会话的用户名称，默认与模板相同；查找到已有会话时忽略
+        :return: 会话
+        """
+        with self._lock:
+            item = self._sessions.get(session_id)
+            if item is not None:
+                return self._touch(session_id, item[1])
+        # 从会话存储恢复可能读取磁盘，不持有锁，避免阻塞其他会话
+        session = self.agent.new_session(user_name=user_name, session_id=session_id)
+        with self._lock:
+            item = self._sessions.setdefault(session_id, (time.monotonic(), session))
+            if item[1] is session:
+                self.created += 1
+                if session.history.end > 0:
+                    self.resumed += 1
+            # 其他线程先创建了同一个会话时使用已有的会话
+            return self._touch(session_id, item[1])
+
+    def _touch(self, session_id: str, session: WeeAgent) -> WeeAgent:
+        now = time.monotonic()
+        self._sessions[session_id] = (now, session)
+        self._sessions.move_to_end(session_id)
+        self._expire(now)
+        return session
+
+    def end_session(self, session_id: str) -> bool:
+        """
+        结束会话，释放会话的历史消息。会话存储中保存的会话不会被删除
+        :param session_id: 会话id
+        :return: 会话是否存在
+        """
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __call__(self, session_id: str, input_text: str = None) -> str:
+        """
+        在指定的会话中对话，会话不存在时自动创建
+        :param session_id: 会话id
+        :param input_text: 用户输入的文本
+        :return: 对话结果
+        """
+        return self.session(session_id)(input_text)
+
+    async def acall(self, session_id: str, input_text: str = None) -> str:
+        """
+        __call__()的异步版本，模板代理需要是AsyncWeeAgent
+        :param session_id: 会话id
+        :param input_text: 用户输入的文本
+        :return: 对话结果
+        """
+        return await self.session(session_id).acall(input_text)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        返回运行时的统计信息
+        :return: 当前会话数、创建的会话数、从存储中恢复的会话数和淘汰的会话数
+        """
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "created": self.created,
+                "resumed": self.resumed,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,82 @@
+"""
+本模块定义了代理状态快照的二进制格式，用于把对话迁移到其他进程或机器（WeeAgent.snapshot()/restore()）。
+快照不使用pickle：pickle依赖类的定义且加载不可信的数据并不安全；也不使用pydantic逐条序列化消息，速度太慢。
+
+格式（小端序）：
+    文件头  magic b"WEEA" | 版本 u8 | 标志 u8（bit0：正文经过zlib压缩）| 保留 u16 | 正文的crc32 u32
+    正文    整数字段 _FIELDS 个 i64 | 每条消息的token数 i32 × count | UTF-8 JSON 文本
+JSON文本保存会话的元信息（会话id、名称、提示词、摘要、completion参数）和序列化后的消息列表，
+消息的token数、前缀和以及每轮对话的起点都不需要重新计算编码。
+"""
+import json
+import struct
+import zlib
+from array import array
+from typing import Dict, List, Tuple
+
+from wee_agent.errors import SnapshotFormatError
+
+__all__ = ["pack_snapshot", "unpack_snapshot", "SNAPSHOT_VERSION"]
+
+SNAPSHOT_MAGIC = b"WEEA"
+SNAPSHOT_VERSION = 1
+_COMPRESSED = 1
+_HEADER = struct.Struct("<4sBBHI")
+# 整数字段，按顺序保存；新的版本只能在末尾追加字段
+_FIELDS = ("first", "head", "round_count", "last_prompt_tokens", "last_total_tokens",
+           "last_question_tokens", "last_cached_tokens", "prompt_tokens_total",
+           "cached_tokens_total", "count")
+_NUMBERS = struct.Struct(f"<{len(_FIELDS)}q")
+
+
+def pack_snapshot(numbers: Dict[str, int], tokens: array, meta: dict,
+                  payloads: List[dict], compress: bool = True) -> bytes:
+    """
+    编码快照
+    :param numbers: _FIELDS中的整数字段，count由payloads的长度决定
+    :param tokens: 每条消息的token数
+    :param meta: 会话的元信息，需要可以序列化为json
+    :param payloads: 序列化后的消息
+    :param compress: 是否使用zlib压缩正文
+    :return: 快照
+    """
+    numbers = dict(numbers, count=len(payloads))
+    text = json.dumps({"meta": meta, "messages": payloads}, ensure_ascii=False,
+                      separators=(",", ":")).encode()
+    body = b"".join((_NUMBERS.pack(*(numbers[name] for name in _FIELDS)),
+                     array("i", tokens).tobytes(), text))
+    checksum = zlib.crc32(body)
+    if compress:
+        body = zlib.compress(body, 1)
+    return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                        _COMPRESSED if compress else 0, 0, checksum) + body
+
+
+def unpack_snapshot(data: bytes) -> Tuple[Dict[str, int], array, dict, List[dict]]:
+    """
+    解码快照
+    :param data: pack_snapshot()返回的快照
+    :return: (整数字段, 每条消息的token数, 元信息, 序列化后的消息)
+    """
+    if len(data) < _HEADER.size:
+        raise SnapshotFormatError("快照不完整")
+    magic, version, flags, _, checksum = _HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotFormatError("不是代理的快照")
+    if version > SNAPSHOT_VERSION:
+        raise SnapshotFormatError(f"不支持的快照版本{version}，当前支持的最高版本为{SNAPSHOT_VERSION}")
+    body = memoryview(data)[_HEADER.size:]
+    try:
+        if flags & _COMPRESSED:
+            body = memoryview(zlib.decompress(body))
+    except zlib.error as e:
+        raise SnapshotFormatError(f"快照已损坏：{e}")
+    if zlib.crc32(body) != checksum:
+        raise SnapshotFormatError("快照已损坏：校验和不一致")
+    numbers = dict(zip(_FIELDS, _NUMBERS.unpack_from(body)))
+    start = _NUMBERS.size
+    end = start + 4 * numbers["count"]
+    tokens = array("i")
+    tokens.frombytes(body[start:end])
+    document = json.loads(bytes(body[end:]))
+    return numbers, tokens, document["meta"], document["messages"]
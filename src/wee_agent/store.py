@@ -0,0 +1,307 @@
+"""
+本模块用于持久化保存会话，进程重启或会话迁移到其他进程后可以继续对话。
+设置了session_store的代理在每个会话压入消息时，把序列化后的消息、token数和会话状态交给存储：
+1. 写入是批量进行的：消息先放在内存缓冲中，由后台线程每flush_interval秒或缓冲达到batch_size条时一次写入；
+2. 恢复会话时只读取会话状态和消息窗口中的消息，已经离开窗口的消息不会被读取，恢复耗时只与窗口大小有关。
+   每轮对话的起点由消息的角色重新计算，token数直接使用保存的值，不需要重新编码；
+3. SessionStore定义了存储的接口，JsonlSessionStore（每个会话一个只追加的JSONL文件）和SqliteSessionStore
+   是两种实现，其他存储（例如Redis）实现_write、_load和_delete即可。
+
+    store = SqliteSessionStore("sessions.sqlite")
+    runtime = AgentRuntime(WeeAgent(session_store=store))
+    runtime("user-42", "hello")  # 重启后，同一个会话id会从存储中恢复
+"""
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+__all__ = ["SessionStore", "JsonlSessionStore", "SqliteSessionStore"]
+
+# 保存的消息：(绝对位置, 序列化后的消息, token数)
+StoredMessage = Tuple[int, dict, int]
+
+
+class SessionStore(abc.ABC):
+    """
+    会话存储的基类，负责缓冲和批量写入。线程安全。
+    """
+
+    def __init__(self, *, batch_size: int = 64, flush_interval: float = 1.0):
+        """
+        初始化方法
+        :param batch_size: 缓冲的消息达到该数量时立刻写入
+        :param flush_interval: 后台线程写入缓冲的间隔（秒）
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._messages: Dict[str, List[StoredMessage]] = {}  # 会话id -> 等待写入的消息
+        self._states: Dict[str, dict] = {}  # 会话id -> 最新的会话状态，同一个会话只写入最后一次的状态
+        self._pending = 0
+        self._lock = threading.Lock()  # 保护缓冲
+        self._write_lock = threading.Lock()  # 保证同一时刻只有一个线程写入
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._run, daemon=True,
+                                         name=f"{type(self).__name__}_flush")
+        self._flusher.start()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"写入会话存储失败：{e}")
+
+    def append(self, session_id: str, position: int, payload: dict,
+               tokens: int, state: dict) -> None:
+        """
+        保存一条消息和会话的最新状态，只放入缓冲，不会等待写入
+        :param session_id: 会话id
+        :param position: 消息的绝对位置
+        :param payload: 序列化后的消息
+        :param tokens: 消息的token数
+        :param state: 会话状态，至少包括消息窗口的起点head
+        :return: 无
+        """
+        with self._lock:
+            self._messages.setdefault(session_id, []).append(
+                (position, payload, tokens))
+            self._states[session_id] = state
+            self._pending += 1
+            full = self._pending >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def save_state(self, session_id: str, state: dict) -> None:
+        """
+        只保存会话状态，例如裁剪了消息窗口但没有新消息时
+        :param session_id: 会话id
+        :param state: 会话状态
+        :return: 无
+        """
+        with self._lock:
+            self._states[session_id] = state
+
+    def flush(self) -> None:
+        """把缓冲中的消息和状态写入存储"""
+        with self._write_lock:
+            with self._lock:
+                messages, self._messages = self._messages, {}
+                states, self._states = self._states, {}
+                self._pending = 0
+            if messages or states:
+                self._write(messages, states)
+
+    def load(self, session_id: str) -> Optional[Tuple[dict, List[StoredMessage]]]:
+        """
+        读取会话状态和消息窗口中的消息
+        :param session_id: 会话id
+        :return: (会话状态, 从窗口起点开始按位置排列的消息)，会话不存在时返回None
+        """
+        self.flush()
+        return self._load(session_id)
+
+    def delete(self, session_id: str) -> None:
+        """
+        删除会话
+        :param session_id: 会话id
+        :return: 无
+        """
+        with self._write_lock:
+            with self._lock:
+                self._pending -= len(self._messages.pop(session_id, ()))
+                self._states.pop(session_id, None)
+            self._delete(session_id)
+
+    def close(self) -> None:
+        """写入缓冲中的数据，并停止后台线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.flush()
+
+    # 以下由具体的存储实现
+    @abc.abstractmethod
+    def _write(self, messages: Dict[str, List[StoredMessage]],
+               states: Dict[str, dict]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _load(self, session_id: str) -> Optional[Tuple[dict, List[StoredMessage]]]:
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, session_id: str) -> None:
+        pass
+
+
+class JsonlSessionStore(SessionStore):
+    """
+    每个会话使用目录中的两个文件：只追加的消息文件<id>.jsonl，和会话状态文件<id>.state.json。
+    状态文件中记录了窗口起点的消息在消息文件中的字节位置，恢复时从该位置开始读取。
+    """
+
+    def __init__(self, directory: str, **kwargs):
+        """
+        初始化方法
+        :param directory: 保存会话文件的目录
+        :param kwargs: batch_size和flush_interval，参见SessionStore
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        # 会话id -> (第一条记录的位置, 之后每条消息在消息文件中的字节位置)，只保留窗口起点之后的部分
+        self._offsets: Dict[str, Tuple[int, array]] = {}
+        super().__init__(**kwargs)
+
+    def _path(self, session_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, quote(session_id, safe="") + suffix)
+
+    def _head_offset(self, session_id: str, head: int, end: int) -> int:
+        # 窗口起点的字节位置，并丢弃起点之前的记录
+        base, offsets = self._offsets.get(session_id, (head, array("q")))
+        if head - base >= len(offsets):  # 起点的消息还没有写入，之后写入的消息都不早于end
+            self._offsets[session_id] = (base + len(offsets), array("q"))
+            return end
+        offset = offsets[max(0, head - base)]
+        if head > base:
+            self._offsets[session_id] = (head, offsets[head - base:])
+        return offset
+
+    def _write(self, messages: Dict[str, List[StoredMessage]],
+               states: Dict[str, dict]) -> None:
+        for session_id in messages.keys() | states.keys():
+            with open(self._path(session_id, ".jsonl"), "ab") as f:
+                end = f.tell()
+                if session_id in messages:
+                    base, offsets = self._offsets.setdefault(
+                        session_id, (messages[session_id][0][0], array("q")))
+                    for position, payload, tokens in messages[session_id]:
+                        offsets.append(end)
+                        line = json.dumps({"p": position, "m": payload, "t": tokens},
+                                          ensure_ascii=False).encode() + b"\n"
+                        f.write(line)
+                        end += len(line)
+            state = states.get(session_id)
+            if state is None:
+                continue
+            state = dict(state, offset=self._head_offset(session_id, state["head"], end))
+            path = self._path(session_id, ".state.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)  # 原子地替换，写入中断时保留旧的状态
+
+    def _load(self, session_id: str) -> Optional[Tuple[dict, List[StoredMessage]]]:
+        try:
+            with open(self._path(session_id, ".state.json"), encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        messages, offsets = [], array("q")
+        path = self._path(session_id, ".jsonl")
+        with open(path, "rb") as f:
+            f.seek(state["offset"])
+            offset = state["offset"]
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # 写入中断时最后一行不完整，截断后之后的消息才能正常追加
+                    os.truncate(path, offset)
+                    break
+                if record["p"] >= state["head"]:
+                    messages.append((record["p"], record["m"], record["t"]))
+                    offsets.append(offset)
+                offset += len(line)
+        self._offsets[session_id] = (state["head"], offsets)
+        return state, messages
+
+    def _delete(self, session_id: str) -> None:
+        self._offsets.pop(session_id, None)
+        for suffix in (".jsonl", ".state.json"):
+            try:
+                os.remove(self._path(session_id, suffix))
+            except FileNotFoundError:
+                pass
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    使用SQLite保存会话，消息按(会话id, 位置)索引，恢复时只查询窗口起点之后的消息。
+    多个进程可以使用同一个文件。
+    """
+
+    def __init__(self, path: str, **kwargs):
+        """
+        初始化方法
+        :param path: SQLite文件路径
+        :param kwargs: batch_size和flush_interval，参见SessionStore
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS session_messages ("
+            "session_id TEXT NOT NULL, position INTEGER NOT NULL, "
+            "payload TEXT NOT NULL, tokens INTEGER NOT NULL, "
+            "PRIMARY KEY (session_id, position))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS session_states ("
+            "session_id TEXT PRIMARY KEY, state TEXT NOT NULL)")
+        self._db_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def _write(self, messages: Dict[str, List[StoredMessage]],
+               states: Dict[str, dict]) -> None:
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO session_messages VALUES (?, ?, ?, ?)",
+                    [(session_id, position, json.dumps(payload, ensure_ascii=False), tokens)
+                     for session_id, records in messages.items()
+                     for position, payload, tokens in records])
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO session_states VALUES (?, ?)",
+                    [(session_id, json.dumps(state, ensure_ascii=False))
+                     for session_id, state in states.items()])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _load(self, session_id: str) -> Optional[Tuple[dict, List[StoredMessage]]]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT state FROM session_states WHERE session_id = ?",
+                (session_id,)).fetchone()
+            if row is None:
+                return None
+            state = json.loads(row[0])
+            rows = self._db.execute(
+                "SELECT position, payload, tokens FROM session_messages "
+                "WHERE session_id = ? AND position >= ? ORDER BY position",
+                (session_id, state["head"])).fetchall()
+        return state, [(position, json.loads(payload), tokens)
+                       for position, payload, tokens in rows]
+
+    def _delete(self, session_id: str) -> None:
+        with self._db_lock:
+            self._db.execute("DELETE FROM session_messages WHERE session_id = ?",
+                             (session_id,))
+            self._db.execute("DELETE FROM session_states WHERE session_id = ?",
+                             (session_id,))
+
+    def close(self) -> None:
+        super().close()
+        with self._db_lock:
+            self._db.close()
@@ -0,0 +1,155 @@
+"""本模块用于将stream模式下返回的trunk合并成完整的回复"""
+import time
+from typing import Dict, List, Optional
+
+from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.completion_usage import CompletionUsage
+
+__all__ = ["StreamAccumulator", "completion_to_chunks"]
+
+
+class _ToolCallBuffer:
+    __slots__ = ("id", "name", "arguments")
+
+    def __init__(self):
+        self.id: Optional[str] = None
+        self.name: List[str] = []
+        self.arguments: List[str] = []
+
+
+class StreamAccumulator:
+    """
+    逐个接收stream模式下的trunk，把文本和tool调用参数片段追加到缓冲区中，
+    全部接收后再一次性构造完整的回复。每个trunk的处理开销是固定的，与已接收的内容长度无关。
+    tool调用按trunk中的index归并，同一个tool调用的参数可以分散在多个trunk中；
+    只包含usage、choices为空的最后一个trunk也会被正确处理。
+    """
+
+    __slots__ = ("id", "model", "created", "system_fingerprint", "role",
+                 "finish_reason", "usage", "_content", "_tool_calls")
+
+    def __init__(self):
+        self.id: str = ""
+        self.model: str = ""
+        self.created: int = 0
+        self.system_fingerprint: Optional[str] = None
+        self.role: str = "assistant"
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[CompletionUsage] = None
+        self._content: List[str] = []
+        self._tool_calls: Dict[int, _ToolCallBuffer] = {}
+
+    def add(self, chunk: ChatCompletionChunk) -> Optional[str]:
+        """
+        接收一个trunk
+        :param chunk: stream模式下返回的trunk
+        :return: trunk中新生成的文本，没有则返回None
+        """
+        if not self.id:
+            self.id = chunk.id
+            self.model = chunk.model
+            self.created = chunk.created
+        if chunk.system_fingerprint:
+            self.system_fingerprint = chunk.system_fingerprint
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return None
+
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+        delta = choice.delta
+        if delta.role:
+            self.role = delta.role
+        if delta.tool_calls:
+            for tool_call in delta.tool_calls:
+                buffer = self._tool_calls.get(tool_call.index)
+                if buffer is None:
+                    buffer = self._tool_calls[tool_call.index] = _ToolCallBuffer()
+                if tool_call.id:
+                    buffer.id = tool_call.id
+                if tool_call.function:
+                    if tool_call.function.name:
+                        buffer.name.append(tool_call.function.name)
+                    if tool_call.function.arguments:
+                        buffer.arguments.append(tool_call.function.arguments)
+        if delta.content:
+            self._content.append(delta.content)
+            return delta.content
+        return None
+
+    @property
+    def content(self) -> str:
+        """到目前为止收到的全部文本"""
+        return "".join(self._content)
+
+    def build_message(self) -> ChatCompletionMessage:
+        """
+        用已接收的trunk构造assistant的回复消息
+        :return: 完整的回复消息
+        """
+        tool_calls = [
+            {
+                "id": buffer.id or f"call_{index}",
+                "type": "function",
+                "function": {"name": "".join(buffer.name),
+                             "arguments": "".join(buffer.arguments)},
+            }
+            for index, buffer in sorted(self._tool_calls.items())
+        ]
+        # 只有tool调用时content为None，与非stream模式的返回保持一致
+        content = self.content if self._content or not tool_calls else None
+        return ChatCompletionMessage(role=self.role, content=content,
+                                     tool_calls=tool_calls or None)
+
+    def build(self) -> ChatCompletion:
+        """
+        用已接收的trunk构造一个与非stream模式相同格式的ChatCompletion
+        :return: 完整的回复
+        """
+        return ChatCompletion(
+            id=self.id,
+            object="chat.completion",
+            created=self.created or int(time.time()),
+            model=self.model,
+            system_fingerprint=self.system_fingerprint,
+            choices=[{
+                "index": 0,
+                "message": self.build_message(),
+                "finish_reason": self.finish_reason or (
+                    "tool_calls" if self._tool_calls else "stop"),
+            }],
+            usage=self.usage,
+        )
+
+
+def completion_to_chunks(completion: ChatCompletion) -> List[ChatCompletionChunk]:
+    """
+    将完整的回复拆成stream模式下的trunk，用于把缓存的回复交给需要trunk的调用者。
+    第一个trunk包含全部的文本和tool调用，最后一个trunk只包含usage。
+    :param completion: 完整的回复
+    :return: trunk列表
+    """
+    choice = completion.choices[0]
+    message = choice.message
+    delta = {"role": message.role, "content": message.content}
+    if message.tool_calls:
+        delta["tool_calls"] = [
+            {"index": index, "id": tool_call.id, "type": "function",
+             "function": {"name": tool_call.function.name,
+                          "arguments": tool_call.function.arguments}}
+            for index, tool_call in enumerate(message.tool_calls)
+        ]
+    common = {"id": completion.id, "object": "chat.completion.chunk",
+              "created": completion.created, "model": completion.model,
+              "system_fingerprint": completion.system_fingerprint}
+    chunks = [ChatCompletionChunk(
+        choices=[{"index": 0, "delta": delta,
+                  "finish_reason": choice.finish_reason}], **common)]
+    if completion.usage is not None:
+        chunks.append(ChatCompletionChunk(choices=[], usage=completion.usage,
+                                          **common))
+    return chunks
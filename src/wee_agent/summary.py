@@ -0,0 +1,102 @@
+"""
+本模块用于把离开消息窗口的历史对话压缩成滚动摘要。
+裁剪消息窗口时整轮对话被丢弃，长对话会丢失之前的上下文；扩大窗口又会让每次请求更慢、更贵。
+设置了Summarizer的代理在裁剪窗口时，把离开窗口的消息交给后台线程，用便宜的模型与已有的摘要合并成新的摘要，
+摘要作为一条系统消息紧跟在提示词之后发送。生成摘要不会阻塞对话：每次发送请求前只取已经完成的摘要，
+没有完成时先使用旧的摘要。
+
+    summarizer = Summarizer(model="gpt-4o-mini", max_tokens=300)
+    agent = WeeAgent(summarizer=summarizer, window_mode="halving")
+"""
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
+from openai import OpenAI
+
+from wee_agent.client import get_client
+from wee_agent.utils import content_str
+
+__all__ = ["Summarizer"]
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the new messages into the current summary. Keep facts, names, numbers, decisions, "
+    "open questions and the user's preferences; drop greetings and repetition. "
+    "Reply with the updated summary only.")
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"  # 摘要消息的开头
+
+
+def _transcript(messages: List[dict]) -> str:
+    # 把序列化后的消息转换成摘要模型容易阅读的文本
+    lines = []
+    for message in messages:
+        content = message.get("content")
+        text = content_str(content) if isinstance(content, (str, list)) else ""
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call["function"]
+            text += f"\n[call {function['name']}({function['arguments']})]"
+        lines.append(f"{message.get('name') or message['role']}: {text.strip()}")
+    return "\n".join(lines)
+
+
+class Summarizer:
+    """
+    滚动摘要的生成器，在后台线程中调用llm。多个代理和会话可以共享同一个生成器。
+    """
+
+    def __init__(self,
+                 *,
+                 model: str = "gpt-4o-mini",
+                 base_url: str = None,
+                 client: OpenAI = None,
+                 max_tokens: int = 512,
+                 prompt: str = SUMMARY_PROMPT,
+                 workers: int = 1):
+        """
+        初始化方法
+        :param model: 生成摘要的模型，应使用便宜、快速的模型
+        :param base_url: 模型的服务地址，为None时使用openai的默认地址
+        :param client: 同步的OpenAI客户端，为None时使用base_url的共享客户端
+        :param max_tokens: 摘要的最大token数，摘要的大小因此是固定的
+        :param prompt: 生成摘要的提示词
+        :param workers: 同时生成摘要的线程数
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.prompt = prompt
+        # 后台任务不影响对话的延迟，使用共享客户端时保留openai库的重试
+        self.client = client if client is not None else get_client(base_url)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers),
+                                           thread_name_prefix="summarizer")
+
+    def summarize(self, summary: str, messages: List[dict]) -> str:
+        """
+        把新的消息合并到摘要中
+        :param summary: 当前的摘要，没有时为空字符串
+        :param messages: 离开消息窗口的消息，即发送给llm的格式
+        :return: 新的摘要
+        """
+        response = self.client.chat.completions.create(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            messages=[
+                {"role": "system", "content": self.prompt},
+                {"role": "user", "content": f"Current summary:\n{summary or '(empty)'}\n\n"
+                                            f"New messages:\n{_transcript(messages)}"},
+            ])
+        return (response.choices[0].message.content or "").strip()
+
+    def submit(self, summary: str, messages: List[dict]) -> Future:
+        """
+        在后台线程中生成摘要
+        :param summary: 当前的摘要
+        :param messages: 离开消息窗口的消息
+        :return: 结果为新摘要的Future
+        """
+        logging.info(f"在后台把{len(messages)}条消息合并到摘要中")
+        return self.executor.submit(self.summarize, summary, messages)
+
+    def close(self) -> None:
+        """等待正在生成的摘要完成，并关闭线程池"""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,154 @@
+"""
+本模块是进程内共享的tiktoken编码注册表。
+tiktoken第一次使用某个编码时会从网络下载BPE文件，在无法访问网络的机器上会失败，在冷启动的机器上也会让第一次请求多出几秒延迟。
+本模块提供：
+1. 按编码名称缓存的编码对象，整个进程只加载一次，模型名称到编码的映射也会被缓存；
+2. warmup()，在服务启动时显式加载编码，之后的请求不再依赖网络或磁盘缓存的状态；
+3. 从本地目录加载BPE文件。目录是进程级的设置，用set_bpe_dir()或环境变量WEE_AGENT_BPE_DIR指定，
+   由export_bpe()在能访问网络的机器上生成：python -m wee_agent.tokenizer ./bpe
+   每个编码保存为<编码>.tiktoken（BPE文件）和<编码>.json（分词正则和特殊token），
+   直接读取文件构造编码，不修改TIKTOKEN_CACHE_DIR等环境变量。
+"""
+import base64
+import json
+import logging
+import os
+import sys
+import threading
+from typing import Dict, Iterable, Optional
+
+import tiktoken
+from tiktoken.model import encoding_name_for_model
+from tiktoken_ext.openai_public import ENCODING_CONSTRUCTORS
+
+from wee_agent.config import DEFAULT_MODEL
+
+__all__ = ["get_encoding", "warmup", "set_bpe_dir", "export_bpe"]
+
+DEFAULT_ENCODING = "cl100k_base"  # 无法识别的模型使用的编码
+BUNDLED_ENCODINGS = ("cl100k_base", "o200k_base")  # export_bpe默认导出的编码
+
+_lock = threading.RLock()
+_encodings: Dict[str, tiktoken.Encoding] = {}  # 编码名称 -> 编码
+_failed: set = set()  # 加载失败的编码名称，避免每条消息都重新访问网络
+_model_to_encoding: Dict[str, str] = {}  # 模型名称 -> 编码名称
+_bpe_dir: Optional[str] = None
+
+
+def set_bpe_dir(path: Optional[str]) -> None:
+    """
+    设置存放BPE文件的本地目录，之后整个进程加载编码时优先从该目录读取。
+    :param path: export_bpe()生成的目录，为None时恢复默认（环境变量WEE_AGENT_BPE_DIR或从网络下载）
+    :return: 无
+    """
+    global _bpe_dir
+    with _lock:
+        _bpe_dir = path
+        _failed.clear()  # 目录变化后，之前失败的编码可以重新尝试
+    logging.info(f"设置BPE文件目录为：{path}")
+
+
+def _resolve_bpe_dir() -> Optional[str]:
+    if _bpe_dir:
+        return _bpe_dir
+    return os.getenv("WEE_AGENT_BPE_DIR") or None
+
+
+def _load(encoding_name: str) -> tiktoken.Encoding:
+    # 设置了本地目录时从export_bpe()导出的文件构造编码，否则由tiktoken下载或读取它自己的缓存
+    bpe_dir = _resolve_bpe_dir()
+    if bpe_dir is None:
+        return tiktoken.get_encoding(encoding_name)
+    path = os.path.join(bpe_dir, encoding_name)
+    with open(f"{path}.json", encoding="utf-8") as f:
+        spec = json.load(f)
+    with open(f"{path}.tiktoken", "rb") as f:
+        ranks = {base64.b64decode(token): int(rank)
+                 for token, rank in (line.split() for line in f if line.strip())}
+    return tiktoken.Encoding(encoding_name, pat_str=spec["pat_str"], mergeable_ranks=ranks,
+                             special_tokens=spec["special_tokens"],
+                             explicit_n_vocab=spec.get("explicit_n_vocab"))
+
+
+def _encoding_name(model: str) -> str:
+    name = _model_to_encoding.get(model)
+    if name is None:
+        try:
+            name = encoding_name_for_model(model)
+        except KeyError:
+            name = DEFAULT_ENCODING
+        _model_to_encoding[model] = name
+    return name
+
+
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    获取模型对应的编码。每个编码在进程内只加载一次。
+    加载失败时返回None，并记住失败的结果，直到下一次warmup()或set_bpe_dir()才会重新尝试。
+    :param model: 模型名称
+    :return: tiktoken编码，加载失败时为None
+    """
+    name = _encoding_name(model)
+    encoding = _encodings.get(name)
+    if encoding is not None or name in _failed:
+        return encoding
+    with _lock:
+        if name in _encodings or name in _failed:
+            return _encodings.get(name)
+        try:
+            _encodings[name] = _load(name)
+            logging.debug(f"Encoding for model {model}: {name}")
+        except Exception as e:
+            _failed.add(name)
+            logging.warning(
+                f"无法加载模型 {model} 的tiktoken编码 {name}，将使用估算的token数: {e}")
+        return _encodings.get(name)
+
+
+def warmup(models: Iterable[str] = (DEFAULT_MODEL,),
+           bpe_dir: str = None) -> Dict[str, bool]:
+    """
+    预先加载模型使用的编码。建议在服务启动时调用，避免第一次请求时才去下载或读取BPE文件。
+    之前加载失败的编码会被重新尝试。
+    :param models: 需要加载编码的模型名称
+    :param bpe_dir: 存放BPE文件的本地目录，不为None时先调用set_bpe_dir()
+    :return: 每个模型的编码是否加载成功
+    """
+    if bpe_dir is not None:
+        set_bpe_dir(bpe_dir)
+    result = {}
+    for model in models:
+        with _lock:
+            _failed.discard(_encoding_name(model))
+        result[model] = get_encoding(model) is not None
+    logging.info(f"tiktoken编码预加载结果：{result}")
+    return result
+
+
+def export_bpe(directory: str,
+               encodings: Iterable[str] = BUNDLED_ENCODINGS) -> None:
+    """
+    在能访问网络的机器上下载BPE文件并保存到指定目录，之后可以将目录复制到无法访问网络的机器上，
+    通过set_bpe_dir()或环境变量WEE_AGENT_BPE_DIR使用。
+    :param directory: 保存BPE文件的目录
+    :param encodings: 需要导出的编码名称
+    :return: 无
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in encodings:
+        spec = ENCODING_CONSTRUCTORS[name]()
+        path = os.path.join(directory, name)
+        with open(f"{path}.tiktoken", "wb") as f:
+            for token, rank in sorted(spec["mergeable_ranks"].items(), key=lambda item: item[1]):
+                f.write(base64.b64encode(token) + b" " + str(rank).encode() + b"\n")
+        with open(f"{path}.json", "w", encoding="utf-8") as f:
+            json.dump({"pat_str": spec["pat_str"], "special_tokens": spec["special_tokens"],
+                       "explicit_n_vocab": spec.get("explicit_n_vocab")}, f)
+        logging.info(f"已导出编码 {name} 到 {directory}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        sys.exit("用法：python -m wee_agent.tokenizer <目录>")
+    export_bpe(sys.argv[1])
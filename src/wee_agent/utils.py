@@ -5,7 +5,7 @@ import json
 import logging
 import random
 import re
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 
 import pydantic
 import tiktoken
@@ -14,6 +14,8 @@ from jsonschema import validate
 from jsonschema.exceptions import ValidationError
 from pydantic import BaseModel
 
+from wee_agent.tokenizer import get_encoding
+
 
 # 将图片转换成base64编码
 def image_to_base64(image: bytes) -> str:
@@ -171,13 +173,8 @@ def merge(base_model_1: BaseModel, base_model_2: BaseModel) -> BaseModel:
         raise e
 
 
-def num_tokens_from_messages(messages: list, model="gpt-3.5-turbo-0613"):
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    logging.debug(f"Encoding for model {model}: {encoding}")
+def _tokens_per_message_and_name(model: str) -> tuple[int, int]:
+    # 每条消息和每个name字段额外消耗的token数
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -186,36 +183,101 @@ def num_tokens_from_messages(messages: list, model="gpt-3.5-turbo-0613"):
         "gpt-4-0613",
         "gpt-4-32k-0613",
     }:  # note: future models may deviate from this
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return 3, 1
     elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4
-        tokens_per_name = -1
+        return 4, -1
     elif "gpt-3.5-turbo" in model:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+        return _tokens_per_message_and_name("gpt-3.5-turbo-0613")
     elif "gpt-4" in model:
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        return _tokens_per_message_and_name("gpt-4-0613")
     else:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    #     raise NotImplementedError(
-    #         f"Model {model} not supported for token counting."
-    #     )
+        return 3, 1
+
+
+def num_tokens_from_text(text: str, encoding: Optional[tiktoken.Encoding]) -> int:
+    """
+    计算一段文本的token数，encoding为None时按字符估算：ascii字符约4个一个token，其他字符每个一个token。
+    :param text: 文本
+    :param encoding: tiktoken编码
+    :return: token数
+    """
+    if not text:
+        return 0
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def num_tokens_from_message(message: dict | BaseModel,
+                            model="gpt-3.5-turbo-0613") -> int:
+    """
+    计算一条消息的token数，不包括回复的起始token。
+    支持字典格式的消息和Completion中定义的各种消息对象。content为列表时只计算其中的文本；
+    assistant消息中tool调用的名称和参数也计入token数。
+    :param message: 消息
+    :param model: 模型名称
+    :return: token数
+    """
+    encoding = get_encoding(model)
+    tokens_per_message, tokens_per_name = _tokens_per_message_and_name(model)
+    if isinstance(message, BaseModel):
+        message = {key: getattr(message, key) for key in
+                   ("role", "name", "content", "tool_calls")
+                   if getattr(message, key, None) is not None}
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        if key == "tool_calls":
+            for tool_call in value or []:
+                function = tool_call["function"] if isinstance(
+                    tool_call, dict) else tool_call.function
+                if isinstance(function, dict):
+                    name, arguments = function.get("name"), function.get(
+                        "arguments")
+                else:
+                    name, arguments = function.name, function.arguments
+                num_tokens += num_tokens_from_text(name, encoding)
+                num_tokens += num_tokens_from_text(arguments, encoding)
+            continue
+        if key not in ("role", "name", "content"):
+            continue
+        if isinstance(value, list):  # 图文混合的消息，只计算其中的文本
+            value = "".join(
+                (item.get("text") if isinstance(item, dict) else getattr(
+                    item, "text", None)) or "" for item in value)
+        num_tokens += num_tokens_from_text(value, encoding)
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+def num_tokens_from_messages(messages: list, model="gpt-3.5-turbo-0613"):
+    """Returns the number of tokens used by a list of messages."""
     num_tokens = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            if key not in ("role", "name", "content"):
-                continue
-            if value is None:
-                value = ""
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+        num_tokens += num_tokens_from_message(message, model)
     num_tokens += 3
     return num_tokens
 
 
+def cached_tokens_from_usage(usage) -> int:
+    """
+    读取usage中命中服务端prompt缓存的token数。
+    openai和vLLM使用prompt_tokens_details.cached_tokens，DeepSeek使用prompt_cache_hit_tokens，
+    旧版本openai库中这些字段是未声明的额外字段，可能是字典。
+    :param usage: api返回的usage
+    :return: 命中缓存的token数，服务端没有返回时为0
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        cached = details.get("cached_tokens")
+    else:
+        cached = getattr(details, "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return int(cached or 0)
+
+
 def python_type_to_json_schema(python_type: Any) -> str:
     """
     Maps a Python type annotation to a JSON schema type.
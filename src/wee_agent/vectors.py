@@ -0,0 +1,462 @@
+"""
+本模块是进程内的向量存储，用于代理的长期记忆，不需要部署Milvus等向量数据库。
+向量按行存放在内存映射的float32文件中，查找时对整块矩阵做一次矩阵乘法，再用argpartition取出top-k，
+进程重启后只需要重新映射文件，百万级别的向量也可以立刻打开，只有被访问的页才会读入内存。需要安装numpy：pip install wee_agent[vector]
+
+    store = VectorStore("memory/", dimension=1536)
+    store.add(vectors, [{"text": text} for text in texts])
+    agent.register_tool(name="recall", tool=recall_tool(store, embed))
+
+目录中的文件：
+    meta.json                  版本、维度、条目数、删除数、下一个id和当前的文件代数，原子地替换
+    vectors.<代>               float32[capacity, dimension]，归一化后的向量
+    ids.<代> / offsets.<代>    int64[capacity]，每行的id和记录在records中的字节位置，id单调递增
+    deleted.<代>               uint8[capacity]，删除标记（墓碑）
+    records.<代>.jsonl         只追加的记录，每行一个json
+    ivf.<序号>.*.npy            可选的近似最近邻索引，参见wee_agent.ann
+删除只设置墓碑，由调用者在空闲时调用maybe_compact()，被删除的行超过compact_ratio时整理：
+把未删除的行写入新一代文件（有索引时重新建立索引），再替换meta.json切换到新的一代，整理中断时仍然使用旧的一代。add()和delete()的修改在flush()或close()之后才持久化。
+
+向量数达到百万级别时，可以用build_index()建立IVF索引，查找时只计算少数几个簇中的int8或float16编码，
+再按float32向量重新排序；建立索引之后追加的向量仍然被精确地计算，积累较多时应重新建立索引。
+"""
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from wee_agent.ann import IvfIndex
+from wee_agent.errors import StoreClosedError
+from wee_agent.wee_agent import set_tool
+
+try:
+    import numpy as np
+except ImportError:  # numpy是可选依赖，只有VectorStore需要
+    np = None
+
+__all__ = ["VectorStore", "recall_tool"]
+
+FORMAT_VERSION = 1
+_MIN_CAPACITY = 1024
+_COLUMNS = (("ids", "int64"), ("offsets", "int64"), ("deleted", "uint8"))
+
+
+class VectorStore:
+    """
+    使用内存映射文件的向量存储，按余弦相似度（normalize=False时为内积）查找。
+    每个向量有一个单调递增的id和一条json记录。线程安全。
+    """
+
+    def __init__(self,
+                 path: str,
+                 *,
+                 dimension: int = None,
+                 normalize: bool = True,
+                 block_size: int = 65536,
+                 compact_ratio: float = 0.25):
+        """
+        初始化方法，目录中已有存储时直接打开
+        :param path: 存储目录
+        :param dimension: 向量的维度，为None时由已有的存储或第一次添加的向量决定
+        :param normalize: 是否在添加和查找时归一化向量，即按余弦相似度查找
+        :param block_size: 查找时每次参与矩阵乘法的行数，限制临时内存的大小
+        :param compact_ratio: 被删除的行超过该比例时，maybe_compact()才整理
+        """
+        if np is None:
+            raise ImportError(
+                "VectorStore需要numpy，请安装：pip install wee_agent[vector]")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.block_size = block_size
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._closed = False
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["version"] > FORMAT_VERSION:
+                raise ValueError(f"不支持的向量存储版本：{meta['version']}")
+            if dimension is not None and dimension != meta["dimension"]:
+                raise ValueError(f"向量维度不一致：存储为{meta['dimension']}，传入{dimension}")
+        else:
+            meta = {"version": FORMAT_VERSION, "dimension": dimension,
+                    "normalize": normalize, "count": 0, "deleted": 0,
+                    "next_id": 0, "capacity": 0, "generation": 0, "index": None}
+        self.dimension: Optional[int] = meta["dimension"]
+        self.normalize: bool = meta["normalize"]
+        self.count: int = meta["count"]  # 包括被删除的行
+        self.deleted: int = meta["deleted"]
+        self.next_id: int = meta["next_id"]
+        self.capacity: int = meta["capacity"]
+        self.generation: int = meta["generation"]
+        self._arrays: Dict[str, "np.memmap"] = {}
+        if self.capacity:
+            self._map()
+        self.index_settings: Optional[dict] = meta.get("index")  # 建立索引的参数和索引文件的序号
+        self.index: Optional[IvfIndex] = None
+        if self.index_settings is not None:
+            self.index = IvfIndex.load(self._index_prefix(),
+                                       quantization=self.index_settings["quantization"])
+        logging.info(f"打开向量存储{path}：{len(self)}条向量，维度{self.dimension}")
+
+    def __len__(self) -> int:
+        return self.count - self.deleted
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise StoreClosedError(f"向量存储{self.path}已经关闭")
+
+    def _file(self, name: str, generation: int = None) -> str:
+        generation = self.generation if generation is None else generation
+        suffix = ".jsonl" if name == "records" else ""
+        return os.path.join(self.path, f"{name}.{generation}{suffix}")
+
+    def _index_prefix(self, serial: int = None) -> str:
+        serial = self.index_settings["serial"] if serial is None else serial
+        return os.path.join(self.path, f"ivf.{serial}")
+
+    def _map(self) -> None:
+        # 按当前的容量映射全部数组文件，文件不足时扩展
+        self._arrays = {}
+        for name, dtype, shape in (("vectors", "float32", (self.capacity, self.dimension)),
+                                   *((name, dtype, (self.capacity,)) for name, dtype in _COLUMNS)):
+            path = self._file(name)
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            with open(path, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+            self._arrays[name] = np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _reserve(self, rows: int) -> None:
+        if self.count + rows <= self.capacity:
+            return
+        capacity = max(_MIN_CAPACITY, self.capacity)
+        while capacity < self.count + rows:
+            capacity *= 2
+        for array in self._arrays.values():
+            array.flush()
+        self._arrays = {}
+        self.capacity = capacity
+        self._map()
+
+    def _prepare(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        if self.normalize:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        return vectors
+
+    def add(self, vectors, records: Sequence[dict] = None) -> List[int]:
+        """
+        追加向量
+        :param vectors: 一个向量或者按行排列的多个向量
+        :param records: 每个向量对应的记录，例如{"text": "..."}，需要可以序列化为json
+        :return: 新向量的id
+        """
+        vectors = self._prepare(vectors)
+        rows = len(vectors)
+        records = records if records is not None else [{}] * rows
+        if len(records) != rows:
+            raise ValueError("向量和记录的数量不一致")
+        with self._lock:
+            self._check_open()
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+            if vectors.shape[1] != self.dimension:
+                raise ValueError(f"向量维度不一致：存储为{self.dimension}，传入{vectors.shape[1]}")
+            self._reserve(rows)
+            start, stop = self.count, self.count + rows
+            with open(self._file("records"), "ab") as f:
+                offset = f.tell()
+                for row, record in enumerate(records, start):
+                    line = json.dumps(record, ensure_ascii=False).encode() + b"\n"
+                    self._arrays["offsets"][row] = offset
+                    f.write(line)
+                    offset += len(line)
+            self._arrays["vectors"][start:stop] = vectors
+            ids = np.arange(self.next_id, self.next_id + rows, dtype=np.int64)
+            self._arrays["ids"][start:stop] = ids
+            self._arrays["deleted"][start:stop] = 0
+            self.count, self.next_id = stop, self.next_id + rows
+            return ids.tolist()
+
+    def _rows(self, ids) -> "np.ndarray":
+        # id单调递增，用二分查找得到行号，不存在的id返回-1
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if not self.count:
+            return np.full(len(ids), -1, dtype=np.int64)
+        stored = self._arrays["ids"][:self.count]
+        rows = np.minimum(np.searchsorted(stored, ids), self.count - 1)
+        return np.where(stored[rows] == ids, rows, -1)
+
+    def delete(self, ids) -> int:
+        """
+        删除向量，只设置墓碑，不整理；释放空间需要调用maybe_compact()或compact()
+        :param ids: 一个或多个id
+        :return: 实际删除的向量数
+        """
+        with self._lock:
+            self._check_open()
+            rows = self._rows(ids)
+            rows = np.unique(rows[rows >= 0])
+            rows = rows[self._arrays["deleted"][rows] == 0] if len(rows) else rows
+            if len(rows):
+                self._arrays["deleted"][rows] = 1
+                self.deleted += len(rows)
+            return len(rows)
+
+    def get(self, id_: int) -> Optional[dict]:
+        """
+        读取向量的记录
+        :param id_: 向量的id
+        :return: 记录，不存在或已删除时返回None
+        """
+        with self._lock:
+            self._check_open()
+            row = int(self._rows([id_])[0])
+            if row < 0 or self._arrays["deleted"][row]:
+                return None
+            return self._read_records([row])[0]
+
+    def _read_records(self, rows: Sequence[int]) -> List[dict]:
+        records = []
+        with open(self._file("records"), "rb") as f:
+            for row in rows:
+                f.seek(int(self._arrays["offsets"][row]))
+                records.append(json.loads(f.readline()))
+        return records
+
+    def _exact_search(self, queries, k: int) -> Tuple["np.ndarray", "np.ndarray"]:
+        # 分块计算矩阵乘法，每块用argpartition取出top-k后合并，返回行号和相似度
+        size = len(queries)
+        best_scores = np.full((size, 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((size, 0), dtype=np.int64)
+        for start in range(0, self.count, self.block_size):
+            stop = min(start + self.block_size, self.count)
+            scores = queries @ self._arrays["vectors"][start:stop].T
+            if self.deleted:
+                scores[:, self._arrays["deleted"][start:stop].astype(bool)] = -np.inf
+            scores = np.concatenate((best_scores, scores), axis=1)
+            rows = np.concatenate(
+                (best_rows, np.broadcast_to(np.arange(start, stop), (size, stop - start))),
+                axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                rows = np.take_along_axis(rows, top, axis=1)
+            best_scores, best_rows = scores, rows
+        return best_rows, best_scores
+
+    def _approximate_search(self, queries, k: int, nprobe: int,
+                            rerank: int) -> Tuple["np.ndarray", "np.ndarray"]:
+        # 用索引选出候选行，加上建立索引之后追加的行，按float32向量重新计算相似度
+        tail = np.arange(self.index.count, self.count, dtype=np.int64)
+        best_rows = np.zeros((len(queries), k), dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            rows = np.sort(np.concatenate(
+                (self.index.candidates(query, nprobe, k * rerank), tail)))
+            if self.deleted:
+                rows = rows[self._arrays["deleted"][rows] == 0]
+            scores = self._arrays["vectors"][rows] @ query
+            if len(rows) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                rows, scores = rows[top], scores[top]
+            best_rows[i, :len(rows)], best_scores[i, :len(rows)] = rows, scores
+        return best_rows, best_scores
+
+    def search_batch(self, queries, k: int = 5, *, nprobe: int = None,
+                     rerank: int = None, exact: bool = False) -> Tuple["np.ndarray", "np.ndarray"]:
+        """
+        批量查找最相似的k个向量。建立了索引时使用近似查找，否则精确地计算全部向量
+        :param queries: 一个或按行排列的多个查询向量
+        :param k: 每个查询返回的数量
+        :param nprobe: 近似查找时查找的簇的数量，默认使用build_index()的设置，越大越准确也越慢
+        :param rerank: 近似查找时按float32向量重新排序的候选数为k的多少倍，默认使用build_index()的设置
+        :param exact: 是否忽略索引，精确地查找
+        :return: (id, 相似度)，形状都是(查询数, k)，按相似度从高到低排列，不足k个时id为-1
+        """
+        queries = self._prepare(queries)
+        with self._lock:
+            self._check_open()
+            if self.index is not None and not exact:
+                best_rows, best_scores = self._approximate_search(
+                    queries, k, nprobe or self.index_settings["nprobe"],
+                    rerank or self.index_settings["rerank"])
+            else:
+                best_rows, best_scores = self._exact_search(queries, k)
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            best_rows = np.take_along_axis(best_rows, order, axis=1)
+            ids = self._arrays["ids"][best_rows] if best_rows.size else best_rows
+            ids = np.where(np.isfinite(best_scores), ids, -1)
+        padding = k - ids.shape[1]
+        if padding > 0:
+            ids = np.pad(ids, ((0, 0), (0, padding)), constant_values=-1)
+            best_scores = np.pad(best_scores, ((0, 0), (0, padding)),
+                                 constant_values=-np.inf)
+        return ids, best_scores
+
+    def build_index(self, *, nlist: int = None, quantization: str = "int8",
+                    nprobe: int = 16, rerank: int = 4, **kwargs) -> None:
+        """
+        为当前的全部向量建立IVF索引，参见wee_agent.ann，之后的查找默认使用近似查找
+        :param nlist: 簇的数量，默认为向量数的平方根
+        :param quantization: 编码的类型，int8或float16
+        :param nprobe: 默认查找的簇的数量
+        :param rerank: 默认按float32向量重新排序的候选数为k的多少倍
+        :param kwargs: IvfIndex.build()的其他参数：sample、iterations和seed
+        :return: 无
+        """
+        with self._lock:
+            self._check_open()
+            if not len(self):
+                raise ValueError("向量存储为空，无法建立索引")
+            previous = self.index_settings
+            serial = previous["serial"] + 1 if previous else 0
+            self.index = IvfIndex.build(self._arrays["vectors"][:self.count], nlist=nlist,
+                                        quantization=quantization, block_size=self.block_size,
+                                        prefix=self._index_prefix(serial), **kwargs)
+            self.index_settings = {"serial": serial, "nlist": self.index.nlist,
+                                   "quantization": quantization, "nprobe": nprobe,
+                                   "rerank": rerank,
+                                   "build": dict(kwargs)}
+            self.flush()  # meta.json切换到新的索引之后再删除旧的索引
+            if previous is not None:
+                IvfIndex.remove(self._index_prefix(previous["serial"]))
+
+    def drop_index(self) -> None:
+        """删除索引，之后的查找都是精确查找"""
+        with self._lock:
+            previous, self.index_settings, self.index = self.index_settings, None, None
+            self.flush()
+            if previous is not None:
+                IvfIndex.remove(self._index_prefix(previous["serial"]))
+
+    def search(self, query, k: int = 5, **kwargs) -> List[Tuple[int, float, dict]]:
+        """
+        查找与一个查询向量最相似的k个向量
+        :param query: 查询向量
+        :param k: 返回的数量
+        :param kwargs: search_batch()的nprobe、rerank和exact
+        :return: 按相似度从高到低排列的(id, 相似度, 记录)
+        """
+        ids, scores = self.search_batch(query, k, **kwargs)
+        hits = [(int(id_), float(score)) for id_, score in zip(ids[0], scores[0]) if id_ >= 0]
+        with self._lock:
+            rows = self._rows([id_ for id_, _ in hits])
+            records = self._read_records(rows.tolist())
+        return [(id_, score, record) for (id_, score), record in zip(hits, records)]
+
+    def maybe_compact(self) -> bool:
+        """
+        被删除的行超过compact_ratio时整理。整理需要复制全部未删除的行，有索引时还要重新建立索引，
+        应由调用者在空闲时或后台线程中调用，而不是在每次删除之后
+        :return: 是否进行了整理
+        """
+        with self._lock:
+            self._check_open()
+            if self.deleted <= self.compact_ratio * self.count:
+                return False
+            self.compact()
+            return True
+
+    def compact(self) -> None:
+        """把未删除的行写入新一代文件并切换过去，释放被删除的行占用的空间"""
+        with self._lock:
+            self._check_open()
+            if not self.count:
+                return
+            live = np.flatnonzero(self._arrays["deleted"][:self.count] == 0)
+            old = dict(self._arrays)
+            old_generation, old_records = self.generation, self._file("records")
+            self.generation += 1
+            self.count, self.deleted = len(live), 0
+            self.capacity = max(_MIN_CAPACITY, self.capacity if self.count * 2 > self.capacity
+                                else self.capacity // 2)
+            self._map()
+            offset = 0
+            with open(old_records, "rb") as source, open(self._file("records"), "wb") as target:
+                for start in range(0, len(live), self.block_size):
+                    rows = live[start:start + self.block_size]
+                    stop = start + len(rows)
+                    self._arrays["vectors"][start:stop] = old["vectors"][rows]
+                    self._arrays["ids"][start:stop] = old["ids"][rows]
+                    self._arrays["deleted"][start:stop] = 0
+                    for row, old_row in enumerate(rows, start):
+                        source.seek(int(old["offsets"][old_row]))
+                        line = source.readline()
+                        self._arrays["offsets"][row] = offset
+                        target.write(line)
+                        offset += len(line)
+            del old
+            self.flush()
+            if self.index_settings is not None and not self.count:
+                self.drop_index()
+            elif self.index_settings is not None:  # 行号改变了，重新建立索引
+                settings = self.index_settings
+                self.build_index(nlist=settings["nlist"], quantization=settings["quantization"],
+                                 nprobe=settings["nprobe"], rerank=settings["rerank"],
+                                 **settings["build"])
+            for name in ("vectors", *(name for name, _ in _COLUMNS)):
+                os.remove(self._file(name, old_generation))
+            os.remove(old_records)
+            logging.info(f"整理向量存储{self.path}：保留{self.count}条向量")
+
+    def flush(self) -> None:
+        """把修改写入文件，并原子地更新meta.json"""
+        with self._lock:
+            self._check_open()
+            for array in self._arrays.values():
+                array.flush()
+            meta = {"version": FORMAT_VERSION, "dimension": self.dimension,
+                    "normalize": self.normalize, "count": self.count,
+                    "deleted": self.deleted, "next_id": self.next_id,
+                    "capacity": self.capacity, "generation": self.generation,
+                    "index": self.index_settings}
+            path = os.path.join(self.path, "meta.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(path + ".tmp", path)
+
+    def close(self) -> None:
+        """写入修改并释放内存映射，之后再使用存储会抛出StoreClosedError，重复关闭没有影响"""
+        with self._lock:
+            if self._closed:
+                return
+            self.flush()
+            self._arrays, self.index = {}, None
+            self._closed = True
+
+
+def recall_tool(store: VectorStore, embed: Callable[[str], List[float]],
+                *, k: int = 5, min_score: float = 0.0, field: str = "text") -> Callable:
+    """
+    生成一个从向量存储中回忆相关内容的tool，用register_tool注册到代理中：
+    agent.register_tool(name="recall", tool=recall_tool(store, embed))
+    :param store: 向量存储
+    :param embed: 向量化函数，与存储中的向量使用同一个模型
+    :param k: 最多返回的条数
+    :param min_score: 相似度低于该值的结果不返回
+    :param field: 返回记录中的哪个字段
+    :return: tool函数
+    """
+
+    @set_tool
+    def recall(query: str) -> str:
+        """
+        从长期记忆中查找与问题相关的内容
+        :param query: 要回忆的内容的描述
+        :return: 相关的内容，每行一条
+        """
+        hits = [(score, record.get(field, "")) for _, score, record in store.search(embed(query), k)
+                if score >= min_score]
+        if not hits:
+            return "没有找到相关的记忆"
+        return "\n".join(f"- ({score:.2f}) {text}" for score, text in hits)
+
+    return recall
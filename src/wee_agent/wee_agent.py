@@ -1,33 +1,54 @@
 """
 本模块用于存放核心功能
 """
+import asyncio
 import base64
+import bisect
+import functools
+import inspect
 import logging
+import threading
 import time
 import uuid
-from typing import List, Dict, Optional, Callable, Iterator
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import List, Dict, Optional, Callable, Iterator, AsyncIterator, \
+    Generator, Sequence, Tuple
 import traceback
 
 import openai
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from openai.types.chat.chat_completion import ChatCompletion
 from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
 
-from wee_agent.utils import image_to_base64, num_tokens_from_messages
+from wee_agent.utils import image_to_base64, num_tokens_from_message, \
+    cached_tokens_from_usage
 from wee_agent.config import MAX_TOKEN_LENGTH, DEFAULT_MODEL, GREEN, \
-    RESET, RETRY
-from wee_agent.errors import AgentExecToolError, RegisterToolError
-from wee_agent.models import Completion
-from wee_agent.utils import generate_function_schema, merge, \
-    generate_random_name
+    RESET
+from wee_agent.errors import AgentExecToolError, CircuitOpenError, RegisterToolError
+from wee_agent.balancer import EndpointPool
+from wee_agent.history import MessageHistory
+from wee_agent.ratelimit import RateLimiter
+from wee_agent.retry import RetryPolicy, default_retry_policy
+from wee_agent.router import ModelRoute, ModelRouter
+from wee_agent.models import Completion, StreamEvent, TextDelta, \
+    ToolCallStarted, ToolResult, Usage, Finish, MapResult
+from wee_agent.client import get_async_client, get_client, without_retries
+from wee_agent.batch import ResultLog
+from wee_agent.cache import CompletionCache, SemanticCache, \
+    completion_cache_key, prompt_fingerprint
+from wee_agent.snapshot import pack_snapshot, unpack_snapshot
+from wee_agent.store import SessionStore
+from wee_agent.stream import StreamAccumulator, completion_to_chunks
+from wee_agent.summary import SUMMARY_PREFIX, Summarizer
+from wee_agent.utils import generate_function_schema, generate_random_name
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-__all__ = ["WeeAgent", "set_tool"]
+__all__ = ["WeeAgent", "AsyncWeeAgent", "set_tool"]
 
 
 def set_tool(method: Callable) -> Callable:
@@ -40,9 +61,40 @@ def set_tool(method: Callable) -> Callable:
     return method
 
 
+@functools.lru_cache(maxsize=None)
+def _method_schema(method: Callable) -> dict:
+    # 内置tool方法的schema只与方法本身有关，每个方法只生成一次
+    return generate_function_schema(method)
+
+
+def _collect_tool_schemas(cls: type) -> Tuple[Dict, ...]:
+    """
+    按属性名称排序，收集类（包括父类）中被set_tool修饰的方法的schema。
+    只读取类字典中的原始对象，不会触发property或__getattr__。
+    :param cls: 代理类
+    :return: tool的schema元组，不可修改，由类的所有实例共享
+    """
+    attributes = {}
+    for klass in reversed(cls.__mro__):  # 子类的定义覆盖父类的同名属性
+        attributes.update(vars(klass))
+    schemas = []
+    for attr in sorted(attributes):
+        value = attributes[attr]
+        # staticmethod和classmethod需要取出被包装的函数
+        schema = getattr(getattr(value, "__func__", value), "tool_schema", None)
+        if schema is not None:
+            schemas.append(schema)
+    return tuple(schemas)
+
+
 class WeeAgent:
     completion_model: dict = Completion(messages=[],
                                         model=DEFAULT_MODEL).model_dump()  # 用于存储模型的配置信息
+    _class_tools: Tuple[Dict, ...] = ()  # 类中被set_tool修饰的方法的schema，定义子类时生成一次，由所有实例共享
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._class_tools = _collect_tool_schemas(cls)
 
     def __init__(self,
                  *,
@@ -56,7 +108,20 @@ class WeeAgent:
                  need_user_input: bool = False,
                  max_round: int = 10,
                  stream: bool = False,
-                 draw_image: bool = False
+                 draw_image: bool = False,
+                 tool_workers: int = 1,
+                 response_cache: CompletionCache = None,
+                 semantic_cache: SemanticCache = None,
+                 history_retention: int = None,
+                 request_timeout: float = None,
+                 retry_policy: RetryPolicy = None,
+                 rate_limiter: RateLimiter = None,
+                 endpoints: Sequence[str] | EndpointPool = None,
+                 router: ModelRouter = None,
+                 window_mode: str = "sliding",
+                 window_low_water: float = 0.5,
+                 summarizer: Summarizer = None,
+                 session_store: SessionStore = None
                  ):
         """
         初始化方法
@@ -71,13 +136,26 @@ class WeeAgent:
         :param max_round: 最大对话轮数，默认为10轮。如果为0，则表示无限对话，直到用户主动结束对话或超出最大对话窗口长度被裁剪。1round为用户发起一个问题得到一个回复。如果中间涉及到tool调用，则也算一轮。
         :param stream: 是否使用stream模式，默认为False。stream模式下，openAI会将回复分成多个trunk返回，需要用户自行合并。stream模式下，openAI会返回更多的信息，包括token的使用情况。
         :param draw_image: 是否需要生成图片，默认为False。
+        :param tool_workers: 同时执行同一轮回复中tool调用的最大数量，默认为1，即按顺序逐个执行。大于1时，llm一次返回的多个tool调用会并发执行，结果仍按原顺序压入消息队列。
+        :param response_cache: 回复缓存，参见wee_agent.cache。完全相同的请求会直接返回缓存的回复，多个代理可以共享同一个缓存。默认为None，即不使用缓存。
+        :param semantic_cache: 语义回答缓存，参见wee_agent.cache。用户的问题与之前的问题足够相似时，直接返回之前的回答，不再调用llm。默认为None，即不使用。
+        :param history_retention: 消息窗口之外最多保留多少条已被裁剪的历史消息，默认为None，即保留全部历史。长时间运行的对话可以设置为0，被裁剪的消息会被批量释放，内存占用不再随对话轮数增长。
+        :param request_timeout: 调用llm的超时时间（秒），默认为None，即使用连接池的超时设置。只影响当前代理，连接池仍然共享。
+        :param retry_policy: 调用llm失败时的重试策略，参见wee_agent.retry。默认为None，即使用进程内共享的策略，所有代理共享重试预算和熔断状态。
+        :param rate_limiter: 客户端限流器，参见wee_agent.ratelimit。多个代理共享同一个限流器时，按每分钟请求数和token数控制总的发送速度。默认为None，即不限流。
+        :param endpoints: 提供同一个模型的多个服务地址，或者EndpointPool，参见wee_agent.balancer。每次调用llm时按负载选择一个服务，失败时换到其他服务重试。默认为None，即只使用base_url。
+        :param router: 模型路由器，参见wee_agent.router。每次调用llm时按prompt长度、tools和图片选择模型，先用便宜的模型，失败、限流或回复没有通过校验时升级到下一个模型。默认为None，即总是使用model。
+        :param window_mode: 消息窗口的裁剪方式。sliding每次只裁剪超出的轮次，窗口的起点几乎每轮都会移动；halving在超出预算或轮数时一次裁剪到预算或轮数的window_low_water，之后多轮对话的请求前缀保持不变，可以命中服务端的prompt缓存。默认为sliding。
+        :param window_low_water: halving模式下裁剪后窗口占预算或最大轮数的比例，默认为0.5。
+        :param summarizer: 滚动摘要生成器，参见wee_agent.summary。裁剪窗口时，离开窗口的对话在后台被合并成摘要，摘要紧跟在系统消息之后发送。默认为None，即直接丢弃离开窗口的对话。
+        :param session_store: 会话存储，参见wee_agent.store。有会话id的会话会批量保存每条消息和会话状态，new_session()传入已保存的会话id时只读取消息窗口恢复会话。默认为None，即不保存。
         """
         self.completion = Completion(messages=[], model=model)
         if model not in MAX_TOKEN_LENGTH:
             if content_length == 0 or not isinstance(content_length, int):
                 raise AgentExecToolError(
                     f"请在初始化时输入模型 {model} 的上下文长度参数！")
-            if base_url is None:
+            if base_url is None and endpoints is None:
                 raise AgentExecToolError(
                     f"请在初始化时输入模型 {model} 的服务地址！")
             self.content_length = content_length
@@ -96,21 +174,15 @@ class WeeAgent:
         self.user_name: str = generate_random_name() if not user_name else user_name  # 用户的名称,如果没传入则随机生成一个
         self.prompt: str = prompt
 
-        self.history_messages: List[
-            Completion.Message | ChatCompletionMessage] = []  # 历史对话消息
-
+        self.summarizer: Optional[Summarizer] = summarizer
+        self.session_store: Optional[SessionStore] = session_store
         self.max_round_in_message_window: int = max_round  # 消息窗口最大对话轮数,如果为0，则表示无限对话，直到用户主动结束对话或超出最大对话窗口长度被裁剪。不为0，则超过对话轮数的消息会被裁剪
-        self.message_window_round_count = 0  # 当前对话窗口对话轮数
-        self.message_windows: Dict[str, int] = {
-            "head": 0,
-            "tail": 0,
-        }  # 用于存储当前消息窗口的头尾指针
-
-        self.last_prompt_tokens: int = 0  # 上一次调用api发送的prompt的token数
-        self.last_total_tokens: int = 0  # 上一次调用api一共消耗的token数
-        self.last_question_tokens: int = 0  # 上一次调用api发送的问题的token数
-        self.last_assistant_response: Optional[
-            ChatCompletion] = None  # 上一次调用api返回的结果
+        if window_mode not in ("sliding", "halving"):
+            raise ValueError(f"window_mode must be 'sliding' or 'halving', but got {window_mode}")
+        self.window_mode: str = window_mode  # 消息窗口的裁剪方式
+        self.window_low_water: float = window_low_water if 0 < window_low_water < 1 else 0.5  # halving模式下裁剪后窗口占预算的比例
+        logging.info(f"设置消息窗口的裁剪方式为：{self.window_mode}")
+        self._init_conversation(history_retention)
 
         # 设置输入token占总token上限的比例
         if isinstance(input_token_ratio, float) and 0 < input_token_ratio < 1:
@@ -127,42 +199,59 @@ class WeeAgent:
         logging.info(
             f"设置输入token的最大长度为：{self.max_input_token},输出token的最大长度为：{self.max_output_token}")
 
-        # 设置调用llm失败重试次数
-        self.max_retry_times = len(RETRY)
-        logging.info(f"设置调用llm失败重试次数为：{self.max_retry_times}")
+        # 设置调用llm失败时的重试策略，默认使用进程内共享的策略
+        self.retry_policy: RetryPolicy = retry_policy if retry_policy is not None else default_retry_policy()
+        logging.info(f"设置调用llm最多尝试次数为：{self.retry_policy.max_attempts}")
+
+        # 设置多个服务地址时，按负载分配调用llm的请求，图片和向量等其他请求使用base_url或第一个服务地址
+        if endpoints is not None and not isinstance(endpoints, EndpointPool):
+            endpoints = EndpointPool(endpoints)
+        self.endpoints: Optional[EndpointPool] = endpoints
+        if endpoints is not None and base_url is None:
+            base_url = endpoints.base_urls[0]
 
         # 初始化openAI客户端
         try:
-            self.open_ai_client: OpenAI = OpenAI(
-                api_key=openai.api_key,
-                base_url=base_url,
-            )
+            self.open_ai_client: OpenAI = self._create_client(base_url)
+            if request_timeout is not None:
+                # with_options返回的客户端与原客户端共享连接池
+                self.open_ai_client = self.open_ai_client.with_options(
+                    timeout=request_timeout)
+            self.endpoint_clients: Dict[str, OpenAI] = {}  # 服务地址 -> 客户端
+            for url in endpoints.base_urls if endpoints is not None else ():
+                client = self._create_client(url)
+                self.endpoint_clients[url] = client if request_timeout is None \
+                    else client.with_options(timeout=request_timeout)
             logging.info("连接openAI服务成功！")
         except Exception as e:
             logging.error(f"无法初始化OpenAI客户端！: {e}")
             raise e
 
-        self.tool_list: List[Dict] = []
+        self.rate_limiter: Optional[RateLimiter] = rate_limiter
+        self.router: Optional[ModelRouter] = router
+        self.response_cache: Optional[CompletionCache] = response_cache
+        self.semantic_cache: Optional[SemanticCache] = semantic_cache
+
+        # 设置并发执行tool的数量，线程池在第一次需要并发执行时才创建
+        self.tool_workers: int = max(1, tool_workers)
+        self.tool_executor: Optional[Executor] = None
+        logging.info(f"设置并发执行tool的数量为：{self.tool_workers}")
 
-        # 读取类中被装饰器set_tool修饰的方法，构造对应的schema
-        for attr in dir(self):
-            if hasattr(getattr(self, attr), "tool_schema"):
-                self.tool_list.append(getattr(self, attr).tool_schema)
+        # 类中被装饰器set_tool修饰的方法的schema在定义类时已经生成，所有实例共享同一个列表
+        self.tool_list: Tuple[Dict, ...] = self._class_tools
         logging.info(f"注册装饰器tool: {self.tool_list}")
 
         # 如果需要用户介入对话，则添加用户输入工具
         if need_user_input:
-            self.tool_list.append(
-                generate_function_schema(self._ask_user))
+            self._add_tool_schema(_method_schema(type(self)._ask_user))
             logging.info("需要用户介入对话！")
 
         # 如果需要生成图片，则添加生成图片工具
         if draw_image:
-            self.tool_list.append(
-                generate_function_schema(self._draw_image))
+            self._add_tool_schema(_method_schema(type(self)._draw_image))
             logging.info("需要生成图片！")
 
-        # 将生成的工具列表传入对话completion
+        # 将生成的工具列表传入对话completion，tools字段不做校验，不会复制列表
         if self.tool_list:
             self.completion.tools = self.tool_list
             logging.info(f"设置对话工具：{self.completion.tools=}")
@@ -180,8 +269,10 @@ class WeeAgent:
         max_output_token={self.max_output_token},
         tools={self.tool_list},
         messages={self.history_messages},
+        released_messages={self.history.offset},
         message_windows={self.message_windows},
-        messages_in_message_windows={self.history_messages[self.message_windows["head"]:self.message_windows["tail"]]},
+        messages_in_message_windows={self.history.window(self.message_windows["head"], self.message_windows["tail"])},
+        window_tokens={self.window_tokens},
         last_prompt_tokens={self.last_prompt_tokens},
         last_completion_tokens={self.last_total_tokens},
         last_assistant_response={self.last_assistant_response}
@@ -195,7 +286,7 @@ class WeeAgent:
         else:
             try:
                 if key in self.completion_model:
-                    setattr(self.completion, key, value)
+                    setattr(self._own_completion(), key, value)
                     return
                 else:
                     super().__setattr__(key, value)
@@ -211,6 +302,10 @@ class WeeAgent:
                 return getattr(self.completion, item)
             except AttributeError:
                 pass  # 如果在定义completion时没有设置该属性，则继续执行下面的代码
+        # new_session()创建的会话没有的属性，从模板代理中读取
+        template = self.__dict__.get("_template")
+        if template is not None:
+            return getattr(template, item)
         # 提供简化版错误信息，并且使用 type(self).__name__ 获取类名
         raise AttributeError(
             f"Attribute '{item}' not found in {type(self).__name__}")
@@ -223,14 +318,32 @@ class WeeAgent:
         :return: 按照用户要求返回文本或者json格式的对话结果
         """
         try:
-            if input_text:
-                self.user_input(input_text)
-            return self.create()
+            return self._respond(input_text)
         except Exception as e:
             tb = traceback.format_exc()
             logging.error(f"对话出现错误: {e}-{tb}")
             return f"对话出现错误: {e},无法返回对话结果！"
 
+    def _respond(self, input_text: str = None) -> str:
+        """
+        压入用户输入并获取回复，设置了语义缓存时先查找缓存。与__call__不同，出现错误时直接抛出。
+        :param input_text: 用户输入的文本
+        :return: 对话结果
+        """
+        if input_text:
+            self.user_input(input_text)
+        if not input_text or self.semantic_cache is None:
+            return self.create()
+        # 先在语义缓存中查找相似的问题
+        fingerprint = prompt_fingerprint(self.prompt)
+        vector = self._embed(input_text)
+        answer = self.semantic_cache.get(fingerprint, vector)
+        if answer is not None:
+            return self._replay_answer(answer)
+        answer = self.create()
+        self.semantic_cache.set(fingerprint, vector, answer)
+        return answer
+
     #########################
     # 以下是设置属性
     #########################
@@ -249,7 +362,7 @@ class WeeAgent:
 
             # 如果没有，则生成默认的jsonschema
             pass
-        self.completion.response_format.type = value
+        self._own_completion().response_format.type = value
 
     # 设置提示词属性，会同时更新系统消息
     @property
@@ -260,6 +373,39 @@ class WeeAgent:
     def prompt(self, value):
         self._prompt = value
         self.system_message = self._create_message("system", self._prompt)
+        self.system_message_tokens: int = num_tokens_from_message(
+            self.system_message, self.model)  # 系统消息的token数
+        self._system_payload: dict = self.system_message.model_dump(
+            exclude_defaults=True, exclude_none=True)  # 序列化后的系统消息
+
+    @property
+    def history_messages(self) -> List[Completion.Message | ChatCompletionMessage]:
+        """保留的历史对话消息，设置了history_retention时不包括已经释放的消息"""
+        return self.history.messages
+
+    @property
+    def message_tokens(self):
+        """保留的每条历史消息的token数，与history_messages一一对应"""
+        return self.history.tokens
+
+    @property
+    def prompt_cache_hit_rate(self) -> float:
+        """本次对话发送的prompt token中命中服务端缓存的比例"""
+        if not self.prompt_tokens_total:
+            return 0.0
+        return self.cached_tokens_total / self.prompt_tokens_total
+
+    @property
+    def window_tokens(self) -> int:
+        """
+        发送系统消息和当前消息窗口中的消息所需的prompt token数。
+        使用压入消息时缓存的token数计算，不需要重新编码消息，耗时与窗口大小无关。
+        """
+        return (self.system_message_tokens
+                + self._summary_tokens
+                + self.history.token_sum(self.message_windows["head"],
+                                         self.message_windows["tail"])
+                + 3)  # 每次回复都以<|start|>assistant<|message|>开始
 
     # 设置模型
     @property
@@ -268,14 +414,10 @@ class WeeAgent:
 
     @model.setter
     def model(self, value):
-        if value in MAX_TOKEN_LENGTH:
-            self.completion.model = value
-        elif 'gpt-4' in value:
-            self.completion.model = 'gpt-4-turbo-preview'
-        elif 'gpt-3' in value:
-            self.completion.model = 'gpt-3.5-turbo'
-        else:
-            self.completion.model = value
+        # 不再把未知的gpt-4*和gpt-3*模型替换成其他模型，按原样使用
+        if value not in MAX_TOKEN_LENGTH:
+            logging.warning(f"模型 {value} 不在MAX_TOKEN_LENGTH中，请确认上下文长度设置正确")
+        self._own_completion().model = value
 
     @property
     def stream_options(self):
@@ -283,12 +425,89 @@ class WeeAgent:
 
     @stream_options.setter
     def stream_options(self, value):
-        self.completion.stream_options.include_usage = value
+        self._own_completion().stream_options.include_usage = value
 
     #########################
     # 以下是内部方法
     #########################
 
+    def _init_conversation(
+            self,
+            history_retention: int = None
+    ) -> None:
+        """
+        初始化属于单个对话的状态：历史消息、消息窗口、对话轮数和token消耗记录。
+        new_session()创建的会话只拥有这些状态，其余配置通过__getattr__从模板代理中读取。
+        :param history_retention: 消息窗口之外最多保留多少条已被裁剪的历史消息
+        :return: 无
+        """
+        # 历史对话消息，同时保存每条消息序列化后的结果、token数及其前缀和、每轮对话起点的位置
+        self.history: MessageHistory = MessageHistory(
+            retention=history_retention)
+        self.session_id: Optional[str] = None  # 会话id，设置了多个服务地址时用于让同一个会话总是使用同一个服务
+
+        self.message_window_round_count = 0  # 当前对话窗口对话轮数
+        self.message_windows: Dict[str, int] = {
+            "head": 0,
+            "tail": 0,
+        }  # 用于存储当前消息窗口的头尾指针
+
+        self.last_prompt_tokens: int = 0  # 上一次调用api发送的prompt的token数
+        self.last_total_tokens: int = 0  # 上一次调用api一共消耗的token数
+        self.last_question_tokens: int = 0  # 上一次调用api发送的问题的token数
+        self.last_assistant_response: Optional[
+            ChatCompletion] = None  # 上一次调用api返回的结果
+        self.last_cached_tokens: int = 0  # 上一次调用api的prompt中命中服务端缓存的token数
+        self.prompt_tokens_total: int = 0  # 本次对话累计发送的prompt token数
+        self.cached_tokens_total: int = 0  # 本次对话累计命中服务端缓存的prompt token数
+
+        self.summary: str = ""  # 离开消息窗口的对话的滚动摘要
+        self._summary_payload: Optional[dict] = None  # 序列化后的摘要消息
+        self._summary_tokens: int = 0  # 摘要消息的token数
+        self._summary_future = None  # 正在后台生成的摘要
+        self._summary_backlog: List[dict] = []  # 等待合并到摘要中的消息
+        self._reserved_tokens: Optional[int] = None  # 正在进行的请求向限流器预支的token数
+
+    def _own_completion(self) -> Completion:
+        """
+        返回可以修改的completion。会话在第一次修改completion的参数时才从模板拷贝一份，之前与模板共享。
+        :return: 属于当前实例的completion
+        """
+        state = self.__dict__
+        if "completion" not in state:
+            template = state.get("_template")
+            if template is None:  # __init__设置completion之前
+                raise AttributeError("completion")
+            # 浅拷贝，tools列表仍然共享；会被原地修改的子对象单独拷贝
+            completion = template.completion
+            nested = {key: getattr(completion, key).model_copy()
+                      for key in ("response_format", "stream_options")
+                      if getattr(completion, key) is not None}
+            state["completion"] = completion.model_copy(update=nested)
+        return state["completion"]
+
+    def _add_tool_schema(
+            self,
+            schema: dict
+    ) -> None:
+        """
+        为当前实例添加一个tool。tool_list是与同类的其他实例或会话共享的元组，添加时生成新的元组（写时复制）。
+        :param schema: tool的schema
+        :return: 无
+        """
+        self.tool_list = self.tool_list + (schema,)
+        self._own_completion().tools = self.tool_list
+
+    @staticmethod
+    def _create_client(base_url: str = None) -> OpenAI:
+        """
+        创建与llm服务通讯的客户端，子类可以重写本方法以替换客户端类型。
+        默认使用进程内共享的客户端，服务地址相同的代理共享同一个连接池，参见wee_agent.client。
+        :param base_url: openai服务代理，或者其他支持openai的格式的大模型服务
+        :return: openAI客户端
+        """
+        return get_client(base_url)
+
     # 与用户交互，默认为通过控制台输入输出，需要重写以实现其他交互方式
     def _ask_user(
             self,
@@ -384,67 +603,464 @@ class WeeAgent:
 
         return message
 
+    def _trim_for_context_length(
+            self,
+            error: Exception
+    ) -> bool:
+        """
+        请求超过上下文窗口长度时，裁剪一轮历史对话以便重试。
+        :param error: 调用api抛出的错误
+        :return: 是否裁剪了窗口。不是超长错误，或窗口中只剩最后一轮对话无法再裁剪时返回False
+        """
+        if not isinstance(error, openai.BadRequestError) or \
+                error.code != "context_length_exceeded":
+            return False
+        round_starts = self.history.round_starts
+        index = self.history.next_round_index(self.message_windows["head"])
+        if index >= len(round_starts) or \
+                round_starts[index] >= self.message_windows["tail"]:
+            return False
+        logging.error(f"超过上下文窗口长度！尝试缩小对话窗口！")
+        self._shrink_window()  # 裁剪历史消息后重试，重试时会按新的窗口构造请求
+        return True
+
+    def _set_summary(self, summary: str) -> None:
+        # 设置摘要，并计算摘要消息序列化后的结果和token数
+        self.summary = summary
+        if not summary:
+            self._summary_payload, self._summary_tokens = None, 0
+            return
+        self._summary_payload = {"role": "system", "name": "summary",
+                                 "content": SUMMARY_PREFIX + summary}
+        self._summary_tokens = num_tokens_from_message(self._summary_payload,
+                                                       self.model)
+
+    def _update_summary(self) -> None:
+        """
+        取出后台已经生成好的摘要，并把等待中的消息提交给后台。不会等待正在生成的摘要。
+        同一个对话同时只有一个摘要在生成，生成期间离开窗口的消息在下一次提交时一起合并。
+        :return: 无
+        """
+        future = self._summary_future
+        if future is not None:
+            if not future.done():
+                return
+            self._summary_future = None
+            try:
+                self._set_summary(future.result())
+            except Exception as e:
+                logging.warning(f"生成摘要失败，丢弃了离开窗口的消息：{e}")
+        if self._summary_backlog:
+            self._summary_future = self.summarizer.submit(self.summary,
+                                                          self._summary_backlog)
+            self._summary_backlog = []
+
+    def _shrink_window(self) -> None:
+        """
+        请求实际超出预算时缩小消息窗口：sliding模式裁剪一轮对话，halving模式裁剪到当前窗口token数的low water
+        :return: 无
+        """
+        if self.window_mode == "halving":
+            self.trim_history_by_token(self.window_tokens - 1)
+        else:
+            self.trim_history(reset=False)
+
+    def _retry_delay(
+            self,
+            endpoint: str,
+            error: Exception,
+            attempt: int
+    ) -> Optional[float]:
+        """
+        处理一次失败的api调用，由重试策略决定是否重试。同步和异步的调用共用本方法。
+        :param endpoint: 服务地址
+        :param error: 调用api抛出的错误
+        :param attempt: 之前已经重试的次数
+        :return: 重试前需要等待的秒数；裁剪了超长的窗口、可以立即重试时返回None
+        :raises: 不应重试时抛出原来的错误
+        """
+        if self._trim_for_context_length(error):
+            return None
+        delay = self.retry_policy.on_failure(endpoint, error, attempt)
+        if delay is None:
+            logging.error(
+                f"Open AI API returned an error! can't continue... {error}")
+            raise error
+        logging.warning(
+            f"OpenAI API returned an API Error: {error}，{delay:.2f}秒后重试第{attempt + 1}次...")
+        return delay
+
+    def _endpoint_healthy(self, endpoint: str) -> bool:
+        # 被动健康检查：熔断中的服务地址视为不可用
+        return self.retry_policy.breaker(endpoint).state != "open"
+
+    def _route(self, failed: set) -> tuple:
+        """
+        为一次api调用选择服务地址和客户端。设置了多个服务地址时，由服务地址池按负载或会话选择，
+        并尽量避开本次调用中已经失败的服务。没有会话id的代理不做会话粘滞，按负载选择。
+        :param failed: 本次调用中已经失败的服务地址
+        :return: 服务地址和客户端
+        """
+        if self.endpoints is None:
+            return str(self.open_ai_client.base_url), self.open_ai_client
+        endpoint = self.endpoints.acquire(self.session_id, failed,
+                                          self._endpoint_healthy)
+        return endpoint, self.endpoint_clients[endpoint]
+
+    def _release(self, endpoint: str, started: float = None) -> None:
+        """
+        一次api调用结束，向服务地址池报告延迟。stream模式下记录的是收到响应头的时间。
+        :param endpoint: _route()选择的服务地址
+        :param started: 成功时为发送请求的时间，失败时为None
+        :return: 无
+        """
+        if self.endpoints is not None:
+            self.endpoints.release(endpoint, None if started is None
+                                   else time.perf_counter() - started)
+
+    def _failover(self, failed: set) -> bool:
+        # 还有没失败过的健康服务时，立刻换到该服务重试，不再等待
+        return self.endpoints is not None and \
+            self.endpoints.has_alternative(failed, self._endpoint_healthy)
+
+    def _check_circuit(self, endpoint: str, failed: set) -> bool:
+        """
+        发送请求前检查服务地址的熔断状态。熔断中的服务视为本次调用已经失败，还有其他健康的服务时换到该服务。
+        :param endpoint: _route()选择的服务地址
+        :param failed: 本次调用中已经失败的服务地址
+        :return: 是否可以向该服务发送请求，为False时应重新选择服务
+        :raises CircuitOpenError: 没有其他可用的服务
+        """
+        try:
+            self.retry_policy.check(endpoint)
+        except CircuitOpenError:
+            self._release(endpoint)
+            failed.add(endpoint)
+            if self._failover(failed):
+                return False
+            raise
+        return True
+
+    def _model_payload(self, model: str = None) -> dict:
+        # 构造请求参数，由模型路由器选择模型时替换其中的模型
+        payload = self._build_payload()
+        if model is not None:
+            payload["model"] = model
+        return payload
+
+    def _route_models(self) -> List[ModelRoute]:
+        # 按模型路由器的规则，返回能处理当前请求的模型
+        return self.router.candidates(self._build_payload(), self.window_tokens)
+
+    def _escalate(self, route: ModelRoute, reason) -> None:
+        self.router.record(route.model, escalated=True)
+        logging.warning(f"模型{route.model}{reason}，升级到下一个模型")
+
+    def _response_valid(self, response) -> bool:
+        # stream模式下回复在调用者读取trunk时才能得到，已经交给调用者的trunk无法收回，不做校验（见ModelRouter）
+        if self.completion.stream:
+            return True
+        json_mode = self.completion.response_format is not None and \
+            self.completion.response_format.type == "json_object"
+        return self.router.accept(response.choices[0].message.content,
+                                  json_mode)
+
     def _call_openai_api(self):
-        # 调用openAI接口，如果碰到错误会再等待一段时间后重试，最多尝试三次
+        # 设置了模型路由器时按顺序尝试能处理请求的模型，否则使用代理的模型
+        if self.router is None:
+            return self._call_model()
+        routes = self._route_models()
+        for route in routes[:-1]:
+            try:
+                response = self._call_model(route.model, fallback=True)
+            except Exception as e:
+                if not self.router.should_escalate(e):
+                    raise
+                self._escalate(route, f"调用失败：{e}")
+                continue
+            if self._response_valid(response):
+                self.router.record(route.model, escalated=False)
+                return response
+            # 没有通过校验的回复也消耗了token，修正预支后再调用下一个模型
+            self._settle_rate_limit(response.usage.total_tokens if response.usage else None)
+            self._escalate(route, "的回复没有通过校验")
+        self.router.record(routes[-1].model, escalated=False)
+        return self._call_model(routes[-1].model)
+
+    def _call_model(self, model: str = None, fallback: bool = False):
+        """
+        调用openAI接口，失败时由重试策略决定是否重试以及等待多久
+        :param model: 使用的模型，为None时使用代理的模型
+        :param fallback: 是否还有下一个模型可以升级，为True时遇到限流直接抛出错误，不等待重试
+        :return: api的返回结果
+        """
         attempt = 0
-        while attempt < self.max_retry_times:
+        failed = set()
+        while True:
+            # 命中缓存的回复不经过服务地址选择，也不计入延迟和重试策略的统计
+            payload = self._model_payload(model)
+            key, cached = self._lookup_cache(payload)
+            if cached is not None:
+                return iter(completion_to_chunks(cached)) if payload.get("stream") else cached
+            endpoint, client = self._route(failed)
+            if not self._check_circuit(endpoint, failed):
+                continue
+            started = time.perf_counter()
             try:
-                return self.open_ai_client.chat.completions.create(
-                    **self.completion.model_dump(exclude_defaults=True,
-                                                 exclude_none=True))
-            # 需要报错并中断
-            except openai.BadRequestError as e:
-                if e.status_code == 400 and e.code == "context_length_exceeded":
-                    # 超过上下文窗口长度
-                    logging.error(f"超过上下文窗口长度！尝试缩小对话窗口！")
-                    self.trim_history()  # 裁剪历史消息后重试
-                    self.completion.messages = self._create_messages()  # 重置对话窗口
-                    continue
+                try:
+                    response = self._send(payload, client, key)
+                finally:
+                    self.retry_policy.release(endpoint)
+            except Exception as e:
+                self._release(endpoint)
+                self._settle_rate_limit(0)
+                if fallback and isinstance(e, openai.RateLimitError):
+                    raise
+                delay = self._retry_delay(endpoint, e, attempt)
+                if delay is not None:
+                    attempt += 1
+                    failed.add(endpoint)
+                    if not self._failover(failed):
+                        time.sleep(delay)
+                continue
+            self._release(endpoint, started)
+            self.retry_policy.on_success(endpoint)
+            return response
+
+    def _embed(self, text: str) -> List[float]:
+        """
+        计算文本的向量，用于语义缓存。优先使用语义缓存中自定义的向量化函数。
+        :param text: 文本
+        :return: 向量
+        """
+        if self.semantic_cache.embed is not None:
+            return self.semantic_cache.embed(text)
+        response = self.open_ai_client.embeddings.create(
+            model=self.semantic_cache.embedding_model, input=text)
+        return response.data[0].embedding
+
+    def _replay_answer(self, answer: str) -> str:
+        """
+        将语义缓存中找到的回答作为assistant的回复压入消息队列，保持对话历史完整。
+        :param answer: 缓存的回答
+        :return: 缓存的回答
+        """
+        self.last_assistant_response = ChatCompletionMessage(
+            role="assistant", content=answer)
+        self._assistant_input(self.last_assistant_response)
+        self.message_window_round_count += 1
+        return answer
+
+    def _reserve_rate_limit(self, tokens: int) -> None:
+        """
+        限流器允许发送后，记录本次请求预支的token数，收到回复后再按实际消耗修正。
+        限流器拒绝的请求没有扣除令牌，不记录，失败时也就不会退还
+        :param tokens: 预支的token数，即当前消息窗口的prompt token估算值
+        :return: 无
+        """
+        self._reserved_tokens = tokens
+
+    def _settle_rate_limit(self, actual: Optional[int]) -> None:
+        """
+        按实际消耗的token数修正本次请求的预支。请求失败时退还全部预支，避免重试时重复扣除
+        :param actual: 实际消耗的token数，失败时为0，为None时保留预支的估算值
+        :return: 无
+        """
+        if self._reserved_tokens is not None and actual is not None:
+            self.rate_limiter.reconcile(self._reserved_tokens, actual)
+        self._reserved_tokens = None
 
-            except (
-                    openai.APIConnectionError,
-                    openai.AuthenticationError,
-                    openai.NotFoundError,
-                    openai.PermissionDeniedError,
-            ) as e:
-                logging.error(
-                    f"Open AI API returned an error! can't continue... {e}")
-                raise e
-            # 需要稍后重新尝试的错误
-            except (
-                    openai.APITimeoutError,
-                    openai.ConflictError,
-                    openai.InternalServerError,
-                    openai.RateLimitError,
-                    openai.UnprocessableEntityError
-            ) as e:
-                logging.error(f"OpenAI API returned an API Error: {e}")
-                attempt += 1
-                if attempt == self.max_retry_times:
-                    raise e
-                logging.info(f"{RETRY[attempt]}秒后重试第{attempt}次...")
-                time.sleep(RETRY[attempt])
+    def _create_completion(self, payload: dict, client: OpenAI = None):
+        """
+        调用chat.completions.create。设置了限流器时，先等待限流器允许发送。
+        :param payload: 发送给chat.completions.create的参数
+        :param client: 发送请求的客户端，默认为open_ai_client
+        :return: api的返回结果
+        """
+        if self.rate_limiter is not None:
+            tokens = self.window_tokens
+            self.rate_limiter.acquire(tokens)
+            self._reserve_rate_limit(tokens)
+        # 重试由重试策略负责，关闭openai库内部的重试
+        client = without_retries(client if client is not None else self.open_ai_client)
+        return client.chat.completions.create(**payload)
+
+    def _lookup_cache(self, payload: dict) -> tuple:
+        """
+        在回复缓存中查找请求，在选择服务地址之前调用，命中时调用者直接返回缓存的回复。
+        stream模式下调用者把缓存的回复拆成trunk返回，之后的处理无需区分回复是否来自缓存。
+        :param payload: 发送给chat.completions.create的参数
+        :return: 缓存的键和缓存的回复；没有设置回复缓存时键为None，未命中时回复为None
+        """
+        if self.response_cache is None:
+            return None, None
+        key = completion_cache_key(payload)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            logging.info("命中回复缓存！")
+        return key, cached
+
+    def _send(self, payload: dict, client: OpenAI = None, key: str = None):
+        """
+        调用api发送请求。设置了回复缓存时，将回复写入缓存。
+        :param payload: 发送给chat.completions.create的参数
+        :param client: 发送请求的客户端，默认为open_ai_client
+        :param key: _lookup_cache()返回的缓存的键，为None时不写入缓存
+        :return: api的返回结果，stream模式下为trunk迭代器
+        """
+        if key is None:
+            return self._create_completion(payload, client)
+        response = self._create_completion(payload, client)
+        if payload.get("stream"):
+            return self.response_cache.record_stream(key, response)
+        self.response_cache.set(key, response)
+        return response
 
     @staticmethod
+    def _relay_stream_chunks(
+            trunks: Iterator[ChatCompletionChunk]
+    ) -> Generator[TextDelta, None, ChatCompletion]:
+        """
+        在收到每个trunk时产生其中的文本片段，最终将返回的一系列trunk合并成一个完整的消息回复。
+        :param trunks: stream模式下api返回的trunk
+        :return: 合并后的回复，作为生成器的返回值
+        """
+        accumulator = StreamAccumulator()
+        for trunk in trunks:
+            text = accumulator.add(trunk)
+            if text:
+                yield TextDelta(content=text)
+        return accumulator.build()
+
     def _merge_and_display_stream_chunks(
-            trunks: Iterator[ChatCompletionChunk]) -> ChatCompletionChunk:
+            self,
+            trunks: Iterator[ChatCompletionChunk]) -> ChatCompletion:
         # 如果是stream模式，则在屏幕上输出每次返回的消息，最终将返回的一系列trunk合并成一个完整的消息回复
         logging.info("stream 模式...")
-        response = next(trunks).model_copy()
-        response.choices[0].delta.content = ''  # 确保第一条返回结果为空
-        for trunk in trunks:
-            if trunk.choices and trunk.choices[0].delta.content is not None:
-                print(
-                    f'{GREEN}{trunk.choices[0].delta.content}{RESET}',
-                    end='',
-                    flush=True
-                )
-                # yield f'{GREEN}{trunk.choices[0].delta.content}{RESET}'
-            response = merge(response, trunk)  # 将返回的一系列trunk合并成一个
-        if response.choices[0].delta.content is not None:
+        relay = self._relay_stream_chunks(trunks)
+        while True:
+            try:
+                event = next(relay)
+            except StopIteration as stop:
+                response = stop.value
+                break
+            print(f'{GREEN}{event.content}{RESET}', end='', flush=True)
+        if response.choices[0].message.content:
             print()  # 输出换行
         return response
 
+    def _stream_settings(self, enable: bool = None):
+        """
+        stream_events需要临时打开stream模式并要求返回token消耗，本方法用于切换和恢复设置。
+        :param enable: 为None时打开stream模式，并返回原设置；否则为之前返回的原设置，用于恢复
+        :return: 原设置
+        """
+        completion = self._own_completion()
+        saved = (completion.stream, completion.stream_options)
+        if enable is None:
+            completion.stream = True
+            completion.stream_options = Completion.StreamOptions(
+                include_usage=True)
+        else:
+            completion.stream, completion.stream_options = enable
+        return saved
+
+    def _tool_call_events(self, tool_calls: list) -> List[ToolCallStarted]:
+        # 为assistant回复中的每个tool调用构造开始事件
+        return [ToolCallStarted(tool_call_id=tool_call.id,
+                                name=tool_call.function.name,
+                                arguments=tool_call.function.arguments)
+                for tool_call in tool_calls]
+
+    def _tool_result_events(self, tool_calls: list) -> List[ToolResult]:
+        # tool执行完毕后，结果位于消息队列的末尾
+        results = self.history_messages[-len(tool_calls):]
+        return [ToolResult(tool_call_id=tool_call.id,
+                           name=tool_call.function.name,
+                           content=message.content)
+                for tool_call, message in zip(tool_calls, results)]
+
+    def _accept_response(
+            self,
+            response: ChatCompletion
+    ):
+        """
+        记录一次api返回的token消耗，按token和轮次裁剪消息窗口，并将assistant的回复压入消息队列。
+        同步和异步的create共用本方法，保证两者的窗口管理逻辑一致。
+        :param response: 完整的api返回结果，stream模式下为合并后的结果
+        :return: 返回结果中的第一个choice
+        """
+        # 按实际消耗的token数修正限流器，命中缓存的回复没有预支token
+        self._settle_rate_limit(response.usage.total_tokens if response.usage else None)
+
+        # 记录token消耗信息
+        if response.usage:
+            self.last_prompt_tokens = response.usage.prompt_tokens  # 最后回复的token数
+            self.last_question_tokens = response.usage.completion_tokens - self.last_total_tokens  # 计算最后一条问题的token数
+            self.last_total_tokens = response.usage.total_tokens  # 计算总token数
+            self.last_cached_tokens = cached_tokens_from_usage(response.usage)
+            self.prompt_tokens_total += response.usage.prompt_tokens
+            self.cached_tokens_total += self.last_cached_tokens
+
+            # 如果返回的token消耗超过了限制，则裁剪一条历史消息
+            # 虽然有可能裁剪后prompt_token数还是超限，但最少腾出了一轮对话的空间。
+            # 所以，当你期待llm产生大量回复时，要小心规划prompt_token的比例关系
+            if MAX_TOKEN_LENGTH and hasattr(response,
+                                            'usage') and response.usage.total_tokens > self.max_input_token:
+                self._shrink_window()
+
+        # 如果设置了最大对话窗口轮次，则根据窗口轮次进行裁剪
+        # 注意：如果llm返回的stop_reason为tool，或者说tool调用轮次不受窗口最大窗口轮次影响
+        # 也就是说，调用tool发生的交互不单独记为一轮对话
+        if response.choices[0].finish_reason != 'tool_calls' and \
+                0 < self.max_round_in_message_window < self.message_window_round_count:
+            if self.window_mode == "halving":
+                keep = max(1, int(self.max_round_in_message_window * self.window_low_water))
+                self.trim_history(number=self.message_window_round_count - keep)
+            else:
+                while 0 < self.max_round_in_message_window < self.message_window_round_count:
+                    self.trim_history(reset=False)
+
+        choice = response.choices[0]
+
+        # 将返回的消息压入消息队列
+        self.last_assistant_response = choice.message
+        self._assistant_input(
+            self.last_assistant_response)
+        return choice
+
+    def _settle_choice(
+            self,
+            choice,
+            total_content: str
+    ) -> tuple[bool, str]:
+        """
+        根据finish_reason处理非tool_calls的返回结果。
+        :param choice: api返回结果中的choice
+        :param total_content: 之前已经累积的回复内容
+        :return: (对话是否结束, 累积后的回复内容)
+        """
+        finish_reason = choice.finish_reason
+        if finish_reason == "stop":
+            total_content += self.last_assistant_response.content
+            self.message_window_round_count += 1
+            # 如果设置了返回类型为json，并设置了返回json的样式schema，则验证返回结果是否符合schema
+            # 不符合的话，使用user_input进行提示，并重新调用openai
+            return True, total_content
+        elif finish_reason == "length":
+            total_content += self.last_assistant_response.content
+            self.message_window_round_count += 1
+            self.user_input("请继续")  # 尝试让openai继续回答
+            return False, total_content
+        elif finish_reason == "content_filter":
+            logging.warning(
+                f"Warning! content_filter: {self.last_assistant_response.content}")
+            self.message_window_round_count += 1
+            return True, total_content + self.last_assistant_response.content
+        else:
+            logging.error(f"Error! Unknown finish_reason: ")
+            raise ValueError(f"Error! Unknown finish_reason: ")
+
     def _push_message(
             self,
             message: Completion.UserMessage | Completion.ToolMessage | Completion.AssistantMessage | Completion.SystemMessage | ChatCompletionMessage
@@ -454,8 +1070,52 @@ class WeeAgent:
 
         :param message: 消息字典。
         """
-        self.history_messages.append(message)
-        self.message_windows["tail"] = len(self.history_messages)
+        payload = message.model_dump(exclude_defaults=True, exclude_none=True)
+        tokens = num_tokens_from_message(message, self.model)
+        self.history.append(message, payload, tokens)
+        self.message_windows["tail"] = self.history.end
+        if self.session_store is not None and self.session_id is not None:
+            self.session_store.append(self.session_id, self.history.end - 1,
+                                      payload, tokens, self._session_state())
+
+    def _session_state(self) -> dict:
+        # 会话存储中保存的会话状态，消息窗口的终点总是最后一条消息，轮数在恢复时重新计算
+        return {
+            "head": self.message_windows["head"],
+            "summary": self.summary,
+            "last_prompt_tokens": self.last_prompt_tokens,
+            "last_total_tokens": self.last_total_tokens,
+            "last_cached_tokens": self.last_cached_tokens,
+            "prompt_tokens_total": self.prompt_tokens_total,
+            "cached_tokens_total": self.cached_tokens_total,
+        }
+
+    def _restore_session(
+            self,
+            state: dict,
+            messages: List[tuple]
+    ) -> None:
+        """
+        用会话存储中的会话状态和消息窗口中的消息恢复对话，窗口之前的消息不会被读取。
+        消息对象由序列化后的消息重新构造，token数使用保存的值。
+        :param state: 会话状态
+        :param messages: 从窗口起点开始的(绝对位置, 序列化后的消息, token数)
+        :return: 无
+        """
+        head = state["head"]
+        self.history.start_at(head)
+        for position, payload, tokens in messages:
+            if position != self.history.end:
+                logging.warning(f"会话{self.session_id}保存的消息不连续，只恢复了前{position - head}条消息")
+                break
+            self.history.append(_message_from_payload(payload), payload, tokens)
+        self.message_windows = {"head": head, "tail": self.history.end}
+        self.message_window_round_count = len(self.history.round_starts)
+        self._set_summary(state.get("summary", ""))
+        for key in ("last_prompt_tokens", "last_total_tokens", "last_cached_tokens",
+                    "prompt_tokens_total", "cached_tokens_total"):
+            setattr(self, key, state.get(key, 0))
+        logging.info(f"从会话存储恢复会话{self.session_id}：窗口中有{len(self.history.messages)}条消息")
 
     def _assistant_input(
             self,
@@ -505,6 +1165,72 @@ class WeeAgent:
         # 将返回结果加入到历史消息中
         return response
 
+    def _run_tool_calls(
+            self,
+            tool_calls: list
+    ) -> None:
+        """
+        执行llm在一轮回复中要求的全部tool调用，并将结果按tool_calls中的顺序压入消息队列。
+        tool_workers大于1时，多个tool调用在线程池中并发执行，耗时取决于最慢的一个。
+        :param tool_calls: assistant回复中的tool_calls
+        :return: 无
+        """
+        logging.info(f"收到{len(tool_calls)}个函数调用")
+        if self.tool_workers > 1 and len(tool_calls) > 1:
+            if self.tool_executor is None:
+                self.tool_executor = ThreadPoolExecutor(
+                    max_workers=self.tool_workers,
+                    thread_name_prefix=f"{self.name}_tool")
+            futures = [
+                self.tool_executor.submit(
+                    self._call_method,
+                    tool_call.function.name,
+                    **eval(tool_call.function.arguments))
+                for tool_call in tool_calls
+            ]
+            results = [future.result() for future in futures]
+        else:
+            results = []
+            for _i, tool_call in enumerate(tool_calls, start=1):
+                logging.info(f"正在处理第{_i}个函数调用")
+                results.append(self._call_method(
+                    tool_call.function.name,
+                    **eval(tool_call.function.arguments)
+                ))
+        # 将返回值按原顺序加入消息列表
+        for tool_call, function_call_result in zip(tool_calls, results):
+            self._tool_input(function_call_result, tool_call.id)
+
+    def _prepare_messages(
+            self
+    ) -> None:
+        """
+        发送请求前，先取出后台已经生成好的摘要，再按token预算裁剪消息窗口。请求参数在发送时由_build_payload构造。
+        :return: 无
+        """
+        self._update_summary()
+        self.trim_history_by_token()
+
+    def _build_payload(
+            self
+    ) -> dict:
+        """
+        构造发送给chat.completions.create的参数，结果与
+        completion.messages = _create_messages() 后再 completion.model_dump(exclude_defaults=True, exclude_none=True) 相同。
+        每条消息在压入消息队列时已经序列化，系统消息在设置提示词时序列化，tools本身就是字典，
+        这里只需序列化其余的少量参数，再拼接消息窗口中的消息，不会重新校验历史消息。
+        :return: 请求参数
+        """
+        payload = self.completion.model_dump(
+            exclude={"messages", "tools"}, exclude_defaults=True,
+            exclude_none=True)
+        payload["messages"] = [self._system_payload] + (
+            [self._summary_payload] if self._summary_payload else []) + self.history.window_payloads(
+            self.message_windows["head"], self.message_windows["tail"])
+        if self.completion.tools:
+            payload["tools"] = self.completion.tools
+        return payload
+
     def _create_messages(
             self
     ) -> List[Completion.Message]:
@@ -512,9 +1238,9 @@ class WeeAgent:
          返回系统消息和消息窗口中的消息,用于发送给openai
         :return: 用于发送的消息列表
         """
-        return [self.system_message] + self.history_messages[
-                                       self.message_windows['head']:
-                                       self.message_windows["tail"]]
+        summary = [Completion.SystemMessage(**self._summary_payload)] if self._summary_payload else []
+        return [self.system_message] + summary + self.history.window(
+            self.message_windows["head"], self.message_windows["tail"])
 
     ###########################
     # 以下是外部方法
@@ -546,8 +1272,7 @@ class WeeAgent:
         setattr(self, name, agent.__call__)
 
         # 将agent()的签名加入到tools列表中
-        self.tool_list.append(agent_schema)
-        self.completion.tools = self.tool_list
+        self._add_tool_schema(agent_schema)
 
     def register_tool(self, *, name: str, tool: Callable):
         """
@@ -570,8 +1295,7 @@ class WeeAgent:
                 setattr(self, name, tool)
 
                 # 将tool()的签名加入到tools列表中
-                self.tool_list.append(tool_schema)
-                self.completion.tools = self.tool_list
+                self._add_tool_schema(tool_schema)
                 logging.info(f"注册了工具方法：{name}")
             except Exception as e:
                 logger.error(f"Error registering tool: {e}")
@@ -580,6 +1304,216 @@ class WeeAgent:
             logger.error(f"Error registering tool: {tool} is not callable.")
             raise TypeError(f"Error registering tool: {tool} is not callable.")
 
+    def map(
+            self,
+            inputs: Sequence[str],
+            *,
+            concurrency: int = 8,
+            results_path: str = None,
+            progress: Callable[[int, int], None] = None
+    ) -> List[MapResult]:
+        """
+        用同一个代理处理大量互不相关的输入。每个输入在一个独立的会话（new_session()）中对话，
+        concurrency个线程同时处理，单个输入出错不会影响其他输入。
+        设置了results_path时，每完成一个输入就把结果追加到文件中；中断后用同一个文件重新运行，
+        已经成功的输入会被跳过，失败的输入会被重新处理。
+        :param inputs: 全部输入
+        :param concurrency: 同时处理的输入数
+        :param results_path: 结果文件路径，为None时不保存
+        :param progress: 每完成一个输入调用一次progress(已完成数, 总数)
+        :return: 按输入顺序排列的结果
+        """
+        log = ResultLog(inputs, results_path, progress)
+        pending = iter(log.pending())
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:  # 线程之间共享同一个迭代器，每个输入只会被处理一次
+                    index = next(pending, None)
+                if index is None:
+                    return
+                try:
+                    output = self.new_session()._respond(inputs[index])
+                    result = MapResult(index=index, input=inputs[index],
+                                       output=output)
+                except Exception as e:
+                    result = _map_error(index, inputs[index], e)
+                log.record(result)
+
+        workers = max(1, concurrency)
+        try:
+            with ThreadPoolExecutor(max_workers=workers,
+                                    thread_name_prefix=f"{self.name}_map") as executor:
+                for future in [executor.submit(worker) for _ in range(workers)]:
+                    future.result()
+        finally:
+            log.close()
+        return log.results
+
+    def new_session(
+            self,
+            *,
+            user_name: str = None,
+            session_id: str = None
+    ) -> "WeeAgent":
+        """
+        以当前代理为模板创建一个轻量的会话。会话是同一个类的实例，可以像代理一样调用，
+        但只保存自己的历史消息、消息窗口、对话轮数和token消耗记录；提示词、模型、tools、
+        openAI客户端、缓存和tool线程池等配置都通过__getattr__从模板读取，不拷贝，也不会重新创建客户端或扫描tool，
+        创建一个会话约需要20微秒。
+        注意：会话按引用读取模板的配置，创建会话之后不应再修改模板的配置；在会话中设置属性、注册tool
+        或修改completion的参数只影响该会话，第一次修改completion的参数时会话才拷贝一份completion。
+        :param user_name: 会话的用户名称，默认与模板相同
+        :param session_id: 会话id，设置了多个服务地址时，id相同的会话总是使用同一个服务；设置了会话存储时，已保存的会话会被恢复
+        :return: 新的会话
+        """
+        if self.tool_workers > 1 and self.tool_executor is None:
+            # 先在模板上创建线程池，全部会话共享同一个线程池
+            self.tool_executor = ThreadPoolExecutor(
+                max_workers=self.tool_workers,
+                thread_name_prefix=f"{self.name}_tool")
+        session = object.__new__(type(self))
+        state = session.__dict__
+        state["_template"] = self  # 从会话创建会话时，先从该会话读取，再逐级读取它的模板
+        if user_name:
+            state["user_name"] = user_name
+        session._init_conversation(self.history.retention)
+        session.session_id = session_id
+        if self.session_store is not None and session_id is not None:
+            record = self.session_store.load(session_id)
+            if record is not None:
+                session._restore_session(*record)
+        return session
+
+    def snapshot(
+            self,
+            *,
+            window_only: bool = False,
+            compress: bool = True
+    ) -> bytes:
+        """
+        把对话状态编码为紧凑的二进制快照，可以在其他进程或机器上用restore()恢复，格式参见wee_agent.snapshot。
+        快照包括历史消息、消息窗口、对话轮数、token消耗记录、摘要、提示词和completion的参数；
+        tools、客户端和缓存等配置不在快照中，由恢复时的代理提供。
+        :param window_only: 是否只保存消息窗口中的消息，默认保存全部保留的历史消息
+        :param compress: 是否使用zlib压缩快照
+        :return: 快照
+        """
+        first = self.message_windows["head"] if window_only else self.history.offset
+        start = first - self.history.offset
+        numbers = {
+            "first": first,
+            "head": self.message_windows["head"],
+            "round_count": self.message_window_round_count,
+            "last_prompt_tokens": self.last_prompt_tokens,
+            "last_total_tokens": self.last_total_tokens,
+            "last_question_tokens": self.last_question_tokens,
+            "last_cached_tokens": self.last_cached_tokens,
+            "prompt_tokens_total": self.prompt_tokens_total,
+            "cached_tokens_total": self.cached_tokens_total,
+        }
+        meta = {
+            "session_id": self.session_id,
+            "name": self.name,
+            "user_name": self.user_name,
+            "prompt": self.prompt,
+            "summary": self.summary,
+            "completion": self.completion.model_dump(
+                exclude={"messages", "tools"}, exclude_defaults=True),
+        }
+        return pack_snapshot(numbers, self.history.tokens[start:], meta,
+                             self.history.payloads[start:], compress)
+
+    @classmethod
+    def restore(
+            cls,
+            data: bytes,
+            *,
+            template: "WeeAgent" = None,
+            **kwargs
+    ) -> "WeeAgent":
+        """
+        由snapshot()生成的快照恢复对话。消息对象由序列化后的消息重新构造，token数使用快照中的值，不需要重新编码。
+        :param data: 快照
+        :param template: 模板代理，恢复的对话是模板的新会话（参见new_session()），共享模板的tools和客户端，不重新创建代理。
+        为None时用kwargs创建新的代理
+        :param kwargs: template为None时创建代理的参数，name、prompt和model默认使用快照中的值
+        :return: 恢复后的代理
+        """
+        numbers, tokens, meta, payloads = unpack_snapshot(data)
+        settings = meta["completion"]
+        if template is None:
+            kwargs.setdefault("name", meta["name"])
+            kwargs.setdefault("prompt", meta["prompt"])
+            kwargs.setdefault("model", settings["model"])
+            agent = cls(**kwargs)
+        else:
+            agent = template.new_session()
+            agent.prompt = meta["prompt"]
+        agent.session_id = meta["session_id"]
+        agent.user_name = meta["user_name"]
+        tools = agent.completion.tools
+        agent.completion = Completion.model_validate(dict(settings, messages=[]))
+        agent.completion.tools = tools
+
+        agent.history.start_at(numbers["first"])
+        agent.history.extend([_message_from_payload(payload) for payload in payloads],
+                             payloads, tokens)
+        agent.message_windows = {"head": numbers["head"], "tail": agent.history.end}
+        agent.message_window_round_count = numbers["round_count"]
+        agent._set_summary(meta["summary"])
+        for key in ("last_prompt_tokens", "last_total_tokens", "last_question_tokens",
+                    "last_cached_tokens", "prompt_tokens_total", "cached_tokens_total"):
+            setattr(agent, key, numbers[key])
+        return agent
+
+    def stream_events(
+            self,
+            input_text: str = None
+    ) -> Iterator[StreamEvent]:
+        """
+        以生成器的方式进行对话，收到llm的回复时立刻产生事件，而不是等待完整的回复后再返回。
+        处理流程与create()相同，包括多轮的tool调用。产生的事件依次为：
+        TextDelta（文本片段）、ToolCallStarted（开始执行tool）、ToolResult（tool执行结果）、
+        Usage（每次api调用的token消耗）和最后的Finish（完整的回复）。
+        无论初始化时是否设置了stream，本方法都使用stream模式调用api。
+        :param input_text: 用户输入的文本
+        :return: 事件生成器
+        """
+        if input_text:
+            self.user_input(input_text)
+        saved = self._stream_settings()
+        total_content = ''
+        try:
+            while True:
+                self._prepare_messages()
+                response = yield from self._relay_stream_chunks(
+                    self._call_openai_api())
+                if response.usage:
+                    yield Usage(**response.usage.model_dump(
+                        include={'prompt_tokens', 'completion_tokens',
+                                 'total_tokens'}),
+                                cached_tokens=cached_tokens_from_usage(
+                                    response.usage))
+
+                choice = self._accept_response(response)
+                if choice.finish_reason == "tool_calls":
+                    tool_calls = self.last_assistant_response.tool_calls
+                    yield from self._tool_call_events(tool_calls)
+                    self._run_tool_calls(tool_calls)
+                    yield from self._tool_result_events(tool_calls)
+                    continue
+
+                finished, total_content = self._settle_choice(choice,
+                                                              total_content)
+                if finished:
+                    yield Finish(finish_reason=choice.finish_reason,
+                                 content=total_content)
+                    return
+        finally:
+            self._stream_settings(saved)
+
     def trim_history(
             self,
             number: int = 1,
@@ -594,30 +1528,75 @@ class WeeAgent:
         :return:
         """
 
-        if reset:  # 重置消息窗口
+        round_starts = self.history.round_starts
+        head = self.message_windows["head"]
+        # 窗口中第一个位于head之后的用户消息，就是下一轮对话的起点
+        target = self.history.next_round_index(head) + number - 1
+        if reset:  # 重置消息窗口，用户更换了话题，之前的摘要也不再需要
             self.message_windows["head"] = self.message_windows["tail"]
             self.message_window_round_count = 0
-            return
-        for item in range(self.message_windows["head"] + 1,
-                          self.message_windows["tail"]):
-
-            if self.history_messages[item].role == "user":
-                self.message_windows["head"] = item
-                self.message_window_round_count -= 1  # 当前消息窗口对话轮数减一
-                number -= 1
-                if number == 0:
-                    return
-                break
-        else:  # 如果没找到下一个user信息，则说明窗口中已经没有user信息，此时清空整个窗口
+            self._set_summary("")
+            self._summary_future, self._summary_backlog = None, []
+            head = self.message_windows["head"]
+        elif target < len(round_starts) and \
+                round_starts[target] < self.message_windows["tail"]:
+            self.message_windows["head"] = round_starts[target]
+            self.message_window_round_count = max(
+                0, self.message_window_round_count - number)  # 当前消息窗口对话轮数减少number
+        else:  # 如果没找到足够的user信息，则说明窗口中已经没有足够的对话轮次，此时清空整个窗口
             self.message_windows['head'] = self.message_windows['tail']
             self.message_window_round_count = 0
-
-    def trim_history_by_token(self):
+        if self.summarizer is not None and self.message_windows["head"] > head:
+            # 离开窗口的消息在释放之前交给后台合并到摘要中
+            self._summary_backlog += self.history.window_payloads(
+                head, self.message_windows["head"])
+            self._update_summary()
+        # 按保留策略释放窗口之外的消息
+        self.history.release(self.message_windows["head"])
+        if self.session_store is not None and self.session_id is not None:
+            self.session_store.save_state(self.session_id, self._session_state())
+
+    def trim_history_by_token(
+            self,
+            max_tokens: int = None
+    ) -> None:
         """
         将消息窗口的大小裁剪到小于等于分配的token窗口比例。
+        在发送请求前调用，使用缓存的token数前缀和，在所有对话轮次的起点中二分查找能放进token预算的最大窗口，
+        一次完成裁剪。如果只保留最后一轮对话仍然超出预算，则保留最后一轮，由api返回错误。
+        halving模式下超出预算时裁剪到预算的window_low_water，为之后的对话留出空间。
+        :param max_tokens: token预算，默认为max_input_token
         :return:
         """
-        pass
+        budget = self.max_input_token if max_tokens is None else max_tokens
+        if self.window_tokens <= budget:
+            return
+        if self.window_mode == "halving":
+            # 一次裁剪到预算的low water，之后多轮对话不需要再裁剪，请求的前缀保持不变
+            budget = int(budget * self.window_low_water)
+        head, tail = self.message_windows["head"], self.message_windows["tail"]
+        round_starts = self.history.round_starts
+        low = self.history.next_round_index(head)
+        high = bisect.bisect_left(round_starts, tail)
+        if low >= high:  # 窗口中没有其他对话轮次的起点，无法裁剪
+            logging.warning(
+                f"消息窗口的token数{self.window_tokens}超过了预算{budget}，但无法再裁剪！")
+            return
+        # 窗口的起点越靠后，token数越少，二分查找第一个满足预算的起点
+        fixed = self.system_message_tokens + self._summary_tokens + self.history.prefix(tail) + 3
+        first, last = low, high - 1
+        while first < last:
+            middle = (first + last) // 2
+            if fixed - self.history.prefix(round_starts[middle]) <= budget:
+                last = middle
+            else:
+                first = middle + 1
+        if fixed - self.history.prefix(round_starts[first]) > budget:
+            logging.warning(
+                f"只保留最后一轮对话，消息窗口的token数仍然超过了预算{budget}！")
+        self.trim_history(number=first - low + 1)
+        logging.info(
+            f"发送前按token裁剪了{first - low + 1}轮对话，当前窗口token数：{self.window_tokens}")
 
     def user_input(
             self,
@@ -674,7 +1653,7 @@ class WeeAgent:
 
         if text:
             ret.content.append(
-                Completion.Message.TextContent(text=text, type="text"))
+                Completion.UserMessage.TextContent(text=text, type="text"))
         self._push_message(ret)
 
     def create(
@@ -696,7 +1675,7 @@ class WeeAgent:
 
         while True:
             # 创建要发送到openAI的消息
-            self.completion.messages = self._create_messages()
+            self._prepare_messages()
 
             # 调用openAI接口
             response = self._call_openai_api()
@@ -704,65 +1683,436 @@ class WeeAgent:
             # 处理返回结果，如果是stream方式，则需要合并生成的消息
             if self.completion.stream:
                 response = self._merge_and_display_stream_chunks(response)
-            # 记录token消耗信息
-            if response.usage:
-                self.last_prompt_tokens = response.usage.prompt_tokens  # 最后回复的token数
-                self.last_question_tokens = response.usage.completion_tokens - self.last_total_tokens  # 计算最后一条问题的token数
-                self.last_total_tokens = response.usage.total_tokens  # 计算总token数
-
-                # 如果返回的token消耗超过了限制，则裁剪一条历史消息
-                # 虽然有可能裁剪后prompt_token数还是超限，但最少腾出了一轮对话的空间。
-                # 所以，当你期待llm产生大量回复时，要小心规划prompt_token的比例关系
-                if MAX_TOKEN_LENGTH and hasattr(response,
-                                                'usage') and response.usage.total_tokens > self.max_input_token:
-                    self.trim_history(reset=False)
 
-            # 如果设置了最大对话窗口轮次，则根据窗口轮次进行裁剪
-            # 注意：如果llm返回的stop_reason为tool，或者说tool调用轮次不受窗口最大窗口轮次影响
-            # 也就是说，调用tool发生的交互不单独记为一轮对话
-            while response.choices[0].finish_reason != 'tool_calls' and \
-                    0 < self.max_round_in_message_window < self.message_window_round_count:
-                self.trim_history(reset=False)
+            choice = self._accept_response(response)
+            if choice.finish_reason == "tool_calls":
+                self._run_tool_calls(self.last_assistant_response.tool_calls)
+                logging.debug("本地api调用处理完毕，重新调用openAI api..")
+                continue
 
-            choice = response.choices[0]
+            finished, total_content = self._settle_choice(choice, total_content)
+            if finished:
+                return total_content
 
-            # 将返回的消息压入消息队列
-            self.last_assistant_response = choice.delta if self.stream else choice.message
-            self._assistant_input(
-                self.last_assistant_response)
 
-            # 根据finish_reason分别进行处理
-            finish_reason = choice.finish_reason
-            if finish_reason == "stop":
-                total_content += self.last_assistant_response.content
-                self.message_window_round_count += 1
-                # 如果设置了返回类型为json，并设置了返回json的样式schema，则验证返回结果是否符合schema
-                # 不符合的话，使用user_input进行提示，并重新调用openai
+def _message_from_payload(payload: dict):
+    # 由会话存储中序列化后的消息重新构造消息对象
+    role = payload["role"]
+    if role == "user":
+        return Completion.UserMessage.model_validate(payload)
+    if role == "tool":
+        return Completion.ToolMessage.model_validate(payload)
+    if role == "system":
+        return Completion.SystemMessage.model_validate(payload)
+    return ChatCompletionMessage.model_validate(payload)
 
-                return total_content
-            elif finish_reason == "tool_calls":
-                logging.info(
-                    f"收到{len(self.last_assistant_response.tool_calls)}个函数调用")
-                for _i, tool_call in enumerate(
-                        self.last_assistant_response.tool_calls,
-                        start=1):
-                    logging.info(f"正在处理第{_i}个函数调用")
-                    function_call_result = self._call_method(
-                        method_name=tool_call.function.name,
-                        **eval(tool_call.function.arguments)
-                    )
-                    # 将返回值加入消息列表，并重新调用api
-                    self._tool_input(function_call_result, tool_call.id)
-                logging.debug("本地api调用处理完毕，重新调用openAI api..")
-            elif response.choices[0].finish_reason == "length":
-                total_content += self.last_assistant_response.content
-                self.message_window_round_count += 1
-                self.user_input("请继续")  # 尝试让openai继续回答
-            elif choice.finish_reason == "content_filter":
-                logging.warning(
-                    f"Warning! content_filter: {self.last_assistant_response.content}")
-                self.message_window_round_count += 1
-                return total_content + choice.message.content
+
+def _map_error(index: int, text: str, error: Exception) -> MapResult:
+    # map()中单个输入出错时的结果
+    logging.error(f"处理第{index}个输入时出现错误: {error}")
+    return MapResult(index=index, input=text,
+                     error=f"{type(error).__name__}: {error}")
+
+
+async def _aiter_chunks(
+        chunks: List[ChatCompletionChunk]) -> AsyncIterator[ChatCompletionChunk]:
+    # 将缓存的trunk列表包装成异步迭代器
+    for chunk in chunks:
+        yield chunk
+
+
+class AsyncWeeAgent(WeeAgent):
+    """
+    WeeAgent的asyncio版本，使用AsyncOpenAI客户端与llm通讯。
+    消息窗口、tool调用和重试逻辑与WeeAgent相同，但等待llm回复和重试时不会阻塞线程，
+    可以在一个事件循环中同时进行大量对话。使用 await agent.acall(...) 或 await agent(...) 调用。
+    """
+
+    @staticmethod
+    def _create_client(base_url: str = None) -> AsyncOpenAI:
+        return get_async_client(base_url)
+
+    async def __call__(self, input_text: str = None,
+                       history: list = None) -> str:
+        """
+        用户直接调用AsyncWeeAgent实例，传入用户输入的文本，返回对话结果
+        :param input_text: 用户输入的文本
+        :param history: 用户输入的历史对话, 本参数用来接收gradio对话模块发来的历史对话，无实际用途
+        :return: 按照用户要求返回文本或者json格式的对话结果
+        """
+        return await self.acall(input_text, history)
+
+    async def acall(self, input_text: str = None,
+                    history: list = None) -> str:
+        """
+        异步对话入口，行为与WeeAgent.__call__一致
+        :param input_text: 用户输入的文本
+        :param history: 用户输入的历史对话, 本参数用来接收gradio对话模块发来的历史对话，无实际用途
+        :return: 按照用户要求返回文本或者json格式的对话结果
+        """
+        try:
+            return await self._arespond(input_text)
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.error(f"对话出现错误: {e}-{tb}")
+            return f"对话出现错误: {e},无法返回对话结果！"
+
+    async def _arespond(self, input_text: str = None) -> str:
+        """
+        _respond的异步版本，出现错误时直接抛出
+        :param input_text: 用户输入的文本
+        :return: 对话结果
+        """
+        if input_text:
+            self.user_input(input_text)
+        if not input_text or self.semantic_cache is None:
+            return await self.acreate()
+        # 先在语义缓存中查找相似的问题
+        fingerprint = prompt_fingerprint(self.prompt)
+        vector = await self._aembed(input_text)
+        answer = self.semantic_cache.get(fingerprint, vector)
+        if answer is not None:
+            return self._replay_answer(answer)
+        answer = await self.acreate()
+        self.semantic_cache.set(fingerprint, vector, answer)
+        return answer
+
+    def map(self, inputs: Sequence[str], **kwargs) -> List[MapResult]:
+        raise RuntimeError("AsyncWeeAgent 请使用 await agent.amap() ！")
+
+    async def amap(
+            self,
+            inputs: Sequence[str],
+            *,
+            concurrency: int = 8,
+            results_path: str = None,
+            progress: Callable[[int, int], None] = None
+    ) -> List[MapResult]:
+        """
+        map()的异步版本，在当前事件循环中由concurrency个协程同时处理输入。
+        :param inputs: 全部输入
+        :param concurrency: 同时处理的输入数
+        :param results_path: 结果文件路径，参见map()
+        :param progress: 每完成一个输入调用一次progress(已完成数, 总数)
+        :return: 按输入顺序排列的结果
+        """
+        log = ResultLog(inputs, results_path, progress)
+        pending = iter(log.pending())
+
+        async def worker():
+            for index in pending:  # 协程之间共享同一个迭代器，每个输入只会被处理一次
+                try:
+                    output = await self.new_session()._arespond(inputs[index])
+                    result = MapResult(index=index, input=inputs[index],
+                                       output=output)
+                except Exception as e:
+                    result = _map_error(index, inputs[index], e)
+                log.record(result)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        finally:
+            log.close()
+        return log.results
+
+    def create(self) -> str:
+        raise RuntimeError("AsyncWeeAgent 请使用 await agent.acreate() ！")
+
+    def stream_events(self, input_text: str = None) -> Iterator[StreamEvent]:
+        raise RuntimeError(
+            "AsyncWeeAgent 请使用 async for event in agent.astream_events() ！")
+
+    async def astream_events(
+            self,
+            input_text: str = None
+    ) -> AsyncIterator[StreamEvent]:
+        """
+        stream_events()的异步版本，使用 async for 迭代事件。
+        :param input_text: 用户输入的文本
+        :return: 事件异步生成器
+        """
+        if input_text:
+            self.user_input(input_text)
+        saved = self._stream_settings()
+        total_content = ''
+        try:
+            while True:
+                self._prepare_messages()
+                accumulator = StreamAccumulator()
+                async for event in self._arelay_stream_chunks(
+                        await self._acall_openai_api(), accumulator):
+                    yield event
+                response = accumulator.build()
+                if response.usage:
+                    yield Usage(**response.usage.model_dump(
+                        include={'prompt_tokens', 'completion_tokens',
+                                 'total_tokens'}),
+                                cached_tokens=cached_tokens_from_usage(
+                                    response.usage))
+
+                choice = self._accept_response(response)
+                if choice.finish_reason == "tool_calls":
+                    tool_calls = self.last_assistant_response.tool_calls
+                    for event in self._tool_call_events(tool_calls):
+                        yield event
+                    await self._arun_tool_calls(tool_calls)
+                    for event in self._tool_result_events(tool_calls):
+                        yield event
+                    continue
+
+                finished, total_content = self._settle_choice(choice,
+                                                              total_content)
+                if finished:
+                    yield Finish(finish_reason=choice.finish_reason,
+                                 content=total_content)
+                    return
+        finally:
+            self._stream_settings(saved)
+
+    async def _draw_image(
+            self,
+            description: str
+    ) -> str:
+        """
+        调用openAI的'dall-e-3'模型生成图片
+
+        :param: description: 要生成照片的描述
+        :return: 返回生成的图片文件名,如果生成失败则返回‘生成图片失败了！’
+        """
+        image_name = uuid.uuid4().hex + '.png'
+        try:
+            response = await self.open_ai_client.images.generate(
+                prompt=description,
+                model='dall-e-3',
+                n=1,
+                response_format="b64_json"
+            )
+            with open(image_name, 'wb') as f:
+                f.write(base64.b64decode(response.data[0].b64_json))
+            return f"{image_name}"
+        except Exception as e:
+            logging.error(f"生成图片失败: {e}")
+            return "生成图片失败了！"
+
+    async def _aembed(self, text: str) -> List[float]:
+        """
+        _embed的异步版本，自定义的向量化函数在线程池中运行
+        :param text: 文本
+        :return: 向量
+        """
+        if self.semantic_cache.embed is not None:
+            return await asyncio.to_thread(self.semantic_cache.embed, text)
+        response = await self.open_ai_client.embeddings.create(
+            model=self.semantic_cache.embedding_model, input=text)
+        return response.data[0].embedding
+
+    async def _acreate_completion(self, payload: dict,
+                                  client: AsyncOpenAI = None):
+        """
+        _create_completion的异步版本，等待限流器时不阻塞事件循环
+        :param payload: 发送给chat.completions.create的参数
+        :param client: 发送请求的客户端，默认为open_ai_client
+        :return: api的返回结果
+        """
+        if self.rate_limiter is not None:
+            tokens = self.window_tokens
+            await self.rate_limiter.aacquire(tokens)
+            self._reserve_rate_limit(tokens)
+        client = without_retries(client if client is not None else self.open_ai_client)
+        return await client.chat.completions.create(**payload)
+
+    async def _asend(self, payload: dict, client: AsyncOpenAI = None, key: str = None):
+        """
+        _send的异步版本
+        :param payload: 发送给chat.completions.create的参数
+        :param client: 发送请求的客户端，默认为open_ai_client
+        :param key: _lookup_cache()返回的缓存的键，为None时不写入缓存
+        :return: api的返回结果，stream模式下为trunk异步迭代器
+        """
+        if key is None:
+            return await self._acreate_completion(payload, client)
+        response = await self._acreate_completion(payload, client)
+        if payload.get("stream"):
+            return self.response_cache.arecord_stream(key, response)
+        self.response_cache.set(key, response)
+        return response
+
+    async def _acall_openai_api(self):
+        # _call_openai_api的异步版本
+        if self.router is None:
+            return await self._acall_model()
+        routes = self._route_models()
+        for route in routes[:-1]:
+            try:
+                response = await self._acall_model(route.model, fallback=True)
+            except Exception as e:
+                if not self.router.should_escalate(e):
+                    raise
+                self._escalate(route, f"调用失败：{e}")
+                continue
+            if self._response_valid(response):
+                self.router.record(route.model, escalated=False)
+                return response
+            # 没有通过校验的回复也消耗了token，修正预支后再调用下一个模型
+            self._settle_rate_limit(response.usage.total_tokens if response.usage else None)
+            self._escalate(route, "的回复没有通过校验")
+        self.router.record(routes[-1].model, escalated=False)
+        return await self._acall_model(routes[-1].model)
+
+    async def _acall_model(self, model: str = None, fallback: bool = False):
+        # 调用openAI接口，重试前的等待不阻塞事件循环
+        attempt = 0
+        failed = set()
+        while True:
+            payload = self._model_payload(model)
+            key, cached = self._lookup_cache(payload)
+            if cached is not None:
+                return _aiter_chunks(completion_to_chunks(cached)) if payload.get("stream") \
+                    else cached
+            endpoint, client = self._route(failed)
+            if not self._check_circuit(endpoint, failed):
+                continue
+            started = time.perf_counter()
+            try:
+                try:
+                    response = await self._asend(payload, client, key)
+                finally:
+                    self.retry_policy.release(endpoint)
+            except Exception as e:
+                self._release(endpoint)
+                self._settle_rate_limit(0)
+                if fallback and isinstance(e, openai.RateLimitError):
+                    raise
+                delay = self._retry_delay(endpoint, e, attempt)
+                if delay is not None:
+                    attempt += 1
+                    failed.add(endpoint)
+                    if not self._failover(failed):
+                        await asyncio.sleep(delay)
+                continue
+            self._release(endpoint, started)
+            self.retry_policy.on_success(endpoint)
+            return response
+
+    @staticmethod
+    async def _arelay_stream_chunks(
+            trunks: AsyncIterator[ChatCompletionChunk],
+            accumulator: StreamAccumulator
+    ) -> AsyncIterator[TextDelta]:
+        """
+        _relay_stream_chunks的异步版本。异步生成器不能有返回值，调用者通过accumulator获取合并后的回复。
+        :param trunks: stream模式下api返回的trunk
+        :param accumulator: 用于合并trunk的累加器
+        :return: 文本片段生成器
+        """
+        async for trunk in trunks:
+            text = accumulator.add(trunk)
+            if text:
+                yield TextDelta(content=text)
+
+    async def _amerge_and_display_stream_chunks(
+            self,
+            trunks: AsyncIterator[ChatCompletionChunk]) -> ChatCompletion:
+        # _merge_and_display_stream_chunks的异步版本
+        logging.info("stream 模式...")
+        accumulator = StreamAccumulator()
+        async for event in self._arelay_stream_chunks(trunks, accumulator):
+            print(f'{GREEN}{event.content}{RESET}', end='', flush=True)
+        response = accumulator.build()
+        if response.choices[0].message.content:
+            print()  # 输出换行
+        return response
+
+    async def _acall_method(
+            self,
+            method_name: str,
+            *args,
+            **kwargs
+    ) -> str:
+        """
+        调用指定的方法。协程方法直接await，普通方法放到线程池中运行，避免阻塞事件循环。
+        :param method_name: 需要运行函数的名称
+        :param args: 需要运行函数的位置参数
+        :param kwargs: 需要运行函数的指名参数
+        :return: 函数运行的结果
+        """
+        method = getattr(self, method_name)
+        try:
+            logging.info(f"执行了方法{method_name}({args},{kwargs})")
+            if inspect.iscoroutinefunction(method):
+                response = await method(*args, **kwargs)
             else:
-                logging.error(f"Error! Unknown finish_reason: ")
-                raise ValueError(f"Error! Unknown finish_reason: ")
+                response = await asyncio.to_thread(method, *args, **kwargs)
+                if inspect.isawaitable(response):  # 例如注册的AsyncWeeAgent子代理
+                    response = await response
+        except Exception as e:
+            logging.error(f"Error calling function: {e}")
+            raise AgentExecToolError(f"Error calling function: {e}")
+        return response
+
+    async def _arun_tool_calls(
+            self,
+            tool_calls: list
+    ) -> None:
+        """
+        _run_tool_calls的异步版本。tool_workers大于1时，使用asyncio任务并发执行，
+        同时运行的tool数量不超过tool_workers。结果按tool_calls中的顺序压入消息队列。
+        :param tool_calls: assistant回复中的tool_calls
+        :return: 无
+        """
+        logging.info(f"收到{len(tool_calls)}个函数调用")
+        if self.tool_workers > 1 and len(tool_calls) > 1:
+            semaphore = asyncio.Semaphore(self.tool_workers)
+
+            async def _limited(tool_call):
+                async with semaphore:
+                    return await self._acall_method(
+                        tool_call.function.name,
+                        **eval(tool_call.function.arguments))
+
+            results = await asyncio.gather(
+                *(_limited(tool_call) for tool_call in tool_calls))
+        else:
+            results = []
+            for _i, tool_call in enumerate(tool_calls, start=1):
+                logging.info(f"正在处理第{_i}个函数调用")
+                results.append(await self._acall_method(
+                    tool_call.function.name,
+                    **eval(tool_call.function.arguments)
+                ))
+        # 将返回值按原顺序加入消息列表
+        for tool_call, function_call_result in zip(tool_calls, results):
+            self._tool_input(function_call_result, tool_call.id)
+
+    async def acreate(
+            self
+    ) -> str:
+        """
+        create()的异步版本，处理流程与create()相同。
+        :return: 文本格式的openAI返回结果
+        """
+
+        total_content = ''  # 最终返回的对话内容
+
+        while True:
+            # 创建要发送到openAI的消息
+            self._prepare_messages()
+
+            # 调用openAI接口
+            response = await self._acall_openai_api()
+
+            # 处理返回结果，如果是stream方式，则需要合并生成的消息
+            if self.completion.stream:
+                response = await self._amerge_and_display_stream_chunks(
+                    response)
+
+            choice = self._accept_response(response)
+            if choice.finish_reason == "tool_calls":
+                await self._arun_tool_calls(
+                    self.last_assistant_response.tool_calls)
+                logging.debug("本地api调用处理完毕，重新调用openAI api..")
+                continue
+
+            finished, total_content = self._settle_choice(choice, total_content)
+            if finished:
+                return total_content
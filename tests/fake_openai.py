@@ -0,0 +1,142 @@
+"""测试用的假openAI客户端，按顺序返回预先设定好的ChatCompletion，不访问网络。"""
+import os
+import time
+
+import httpx
+import openai
+from openai.types.chat.chat_completion import ChatCompletion
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+
+def make_error(error_class: type, status_code: int, code: str = None,
+               headers: dict = None) -> openai.APIStatusError:
+    """构造api返回的错误，例如make_error(openai.RateLimitError, 429, headers={"retry-after": "2"})"""
+    request = httpx.Request("POST", "http://fake/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return error_class(f"error {status_code}", response=response,
+                       body={"code": code, "message": "error"})
+
+
+def make_completion(content: str = None, tool_calls: list = None,
+                    finish_reason: str = "stop", prompt_tokens: int = 10,
+                    completion_tokens: int = 5) -> ChatCompletion:
+    """
+    构造一个ChatCompletion
+    :param content: assistant回复的文本
+    :param tool_calls: [(id, name, arguments)]形式的tool调用列表
+    :param finish_reason: 结束原因
+    :param prompt_tokens: prompt消耗的token数
+    :param completion_tokens: 回复消耗的token数
+    :return: ChatCompletion
+    """
+    message = {"role": "assistant", "content": content}
+    if tool_calls:
+        message["tool_calls"] = [
+            {"id": _id, "type": "function",
+             "function": {"name": name, "arguments": arguments}}
+            for _id, name, arguments in tool_calls
+        ]
+        finish_reason = "tool_calls"
+    return ChatCompletion(
+        id="chatcmpl-test",
+        object="chat.completion",
+        created=int(time.time()),
+        model="gpt-4o",
+        choices=[{"index": 0, "message": message,
+                  "finish_reason": finish_reason}],
+        usage={"prompt_tokens": prompt_tokens,
+               "completion_tokens": completion_tokens,
+               "total_tokens": prompt_tokens + completion_tokens},
+    )
+
+
+def _chunk(delta: dict, finish_reason: str = None,
+           usage: dict = None, choices: bool = True) -> ChatCompletionChunk:
+    return ChatCompletionChunk(
+        id="chatcmpl-test",
+        object="chat.completion.chunk",
+        created=int(time.time()),
+        model="gpt-4o",
+        choices=[{"index": 0, "delta": delta,
+                  "finish_reason": finish_reason}] if choices else [],
+        usage=usage,
+    )
+
+
+def make_chunks(pieces: list = None, tool_calls: list = None,
+                prompt_tokens: int = 10) -> list:
+    """
+    构造stream模式下返回的一系列trunk，最后一个trunk只包含usage
+    :param pieces: assistant回复被拆分成的文本片段
+    :param tool_calls: [(id, name, [arguments片段...])]形式的tool调用列表，参数按片段拆分到多个trunk中
+    :param prompt_tokens: prompt消耗的token数
+    :return: trunk列表
+    """
+    pieces = pieces or []
+    chunks = [_chunk({"role": "assistant", "content": ""})]
+    chunks += [_chunk({"content": piece}) for piece in pieces]
+    for index, (_id, name, fragments) in enumerate(tool_calls or []):
+        chunks.append(_chunk({"tool_calls": [
+            {"index": index, "id": _id, "type": "function",
+             "function": {"name": name, "arguments": ""}}]}))
+        chunks += [_chunk({"tool_calls": [
+            {"index": index, "function": {"arguments": fragment}}]})
+            for fragment in fragments]
+    chunks.append(_chunk({}, "tool_calls" if tool_calls else "stop"))
+    completion_tokens = len(pieces) + 1
+    chunks.append(_chunk({}, usage={
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens}, choices=False))
+    return chunks
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+
+class _Completions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, **kwargs):
+        self.owner.requests.append(kwargs)
+        response = self.owner.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return iter(response) if isinstance(response, list) else response
+
+
+class _AsyncCompletions(_Completions):
+    async def create(self, **kwargs):
+        self.owner.requests.append(kwargs)
+        response = self.owner.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return _aiter(response) if isinstance(response, list) else response
+
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class FakeClient:
+    """同步假客户端，requests记录每次请求的参数"""
+
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.requests = []
+        self.base_url = "http://fake"
+        self.chat = _Chat(_Completions(self))
+
+
+class FakeAsyncClient(FakeClient):
+    """异步假客户端"""
+
+    def __init__(self, responses: list):
+        super().__init__(responses)
+        self.chat = _Chat(_AsyncCompletions(self))
@@ -0,0 +1,117 @@
+"""
+测试用的本地openAI服务，在后台线程中运行，支持chat.completions、files和batches接口：
+chat.completions回复"echo: 最后一条用户消息"，用户消息以"bad"开头时返回400；
+批处理任务在创建时立即执行，第一次查询时状态为in_progress，之后为completed。
+"""
+import email.parser
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fake_openai import make_completion
+
+
+def _chat(body: dict) -> tuple:
+    # 返回(状态码, 响应体)
+    text = [m for m in body["messages"] if m["role"] == "user"][-1]["content"]
+    if text.startswith("bad"):
+        return 400, {"error": {"message": "bad input", "type": "invalid_request_error",
+                               "code": "invalid_value"}}
+    return 200, make_completion(f"echo: {text}").model_dump()
+
+
+class FakeServer(ThreadingHTTPServer):
+    request_queue_size = 128  # 默认的5在大量并发连接时会溢出，客户端要等1秒后重发SYN
+
+    def __init__(self, delay: float = 0):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.delay = delay  # 每个chat请求的处理时间
+        self.chat_requests = 0
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, args=(0.05,),
+                         daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status: int, body):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        server = self.server
+        data = self._body()
+        if self.path == "/v1/chat/completions":
+            with server.lock:
+                server.chat_requests += 1
+            time.sleep(server.delay)
+            self._send(*_chat(json.loads(data)))
+        elif self.path == "/v1/files":
+            message = email.parser.BytesParser().parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode()
+                + b"\r\n\r\n" + data)
+            content = next(part.get_payload(decode=True)
+                           for part in message.get_payload()
+                           if part.get_param("name", header="content-disposition") == "file")
+            file_id = f"file-{uuid.uuid4().hex[:8]}"
+            server.files[file_id] = content
+            self._send(200, {"id": file_id, "object": "file", "bytes": len(content),
+                             "created_at": 0, "filename": "input.jsonl",
+                             "purpose": "batch", "status": "processed"})
+        elif self.path == "/v1/batches":
+            request = json.loads(data)
+            lines = []
+            for line in server.files[request["input_file_id"]].decode().splitlines():
+                item = json.loads(line)
+                status, body = _chat(item["body"])
+                lines.append(json.dumps({
+                    "id": f"req-{item['custom_id']}", "custom_id": item["custom_id"],
+                    "response": {"status_code": status, "body": body}, "error": None}))
+            output_id = f"file-{uuid.uuid4().hex[:8]}"
+            server.files[output_id] = ("\n".join(reversed(lines)) + "\n").encode()
+            batch = {"id": f"batch-{uuid.uuid4().hex[:8]}", "object": "batch",
+                     "endpoint": request["endpoint"], "input_file_id": request["input_file_id"],
+                     "completion_window": "24h", "created_at": 0, "status": "validating",
+                     "output_file_id": output_id}
+            server.batches[batch["id"]] = batch
+            self._send(200, batch)
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.strip("/").split("/")
+        if parts[1] == "batches":
+            batch = dict(server.batches[parts[2]])
+            if batch["status"] == "validating":
+                server.batches[parts[2]]["status"] = "completed"
+                batch["status"] = "in_progress"
+                batch.pop("output_file_id")
+            self._send(200, batch)
+        elif parts[1] == "files" and parts[-1] == "content":
+            self._send(200, server.files[parts[2]])
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,70 @@
+import asyncio
+import unittest
+
+from fake_openai import FakeAsyncClient, make_completion
+from wee_agent import AsyncWeeAgent, set_tool
+
+
+class SlowAgent(AsyncWeeAgent):
+
+    @set_tool
+    async def lookup(self, key: str) -> str:
+        """
+        查询指定的key
+        :param key: 要查询的key
+        :return: 查询结果
+        """
+        await asyncio.sleep(0.01)
+        return f"value of {key}"
+
+    @staticmethod
+    @set_tool
+    def plus(a: int, b: int) -> str:
+        """
+        计算两个数的和
+        :param a: 第一个数
+        :param b: 第二个数
+        :return: 两个数的和
+        """
+        return str(a + b)
+
+
+class MyTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_acall(self):
+        agent = AsyncWeeAgent()
+        agent.open_ai_client = FakeAsyncClient(
+            [make_completion("hello"), make_completion("again")])
+        self.assertEqual(await agent.acall("hi"), "hello")
+        self.assertEqual(await agent("hi"), "again")
+        self.assertEqual(len(agent.history_messages), 4)
+
+    async def test_tool_loop(self):
+        agent = SlowAgent()
+        agent.open_ai_client = FakeAsyncClient([
+            make_completion(tool_calls=[
+                ("call_1", "lookup", '{"key": "a"}'),
+                ("call_2", "plus", '{"a": 1, "b": 2}'),
+            ]),
+            make_completion("done"),
+        ])
+        self.assertEqual(await agent.acall("go"), "done")
+        tool_messages = [m for m in agent.history_messages if m.role == "tool"]
+        self.assertEqual([m.content for m in tool_messages],
+                         ["value of a", "3"])
+        self.assertEqual(agent.message_window_round_count, 1)
+
+    async def test_concurrent_conversations(self):
+        agents = [AsyncWeeAgent() for _ in range(20)]
+        for i, agent in enumerate(agents):
+            agent.open_ai_client = FakeAsyncClient([make_completion(str(i))])
+        results = await asyncio.gather(*(a.acall("hi") for a in agents))
+        self.assertEqual(results, [str(i) for i in range(20)])
+
+    def test_sync_create_is_rejected(self):
+        with self.assertRaises(RuntimeError):
+            AsyncWeeAgent().create()
+
+
+if __name__ == '__main__':
+    unittest.main()
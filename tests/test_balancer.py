@@ -0,0 +1,151 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from fake_server import FakeServer
+from wee_agent import AsyncWeeAgent, WeeAgent
+from wee_agent import client
+from wee_agent.balancer import EndpointPool
+from wee_agent.cache import CompletionCache
+from wee_agent.errors import CircuitOpenError
+from wee_agent.retry import RetryPolicy
+from wee_agent.session import AgentRuntime
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [FakeServer(), FakeServer()]
+        self.urls = [server.base_url for server in self.servers]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        client.close_clients()
+
+    def test_least_outstanding_and_latency(self):
+        pool = EndpointPool(["a", "b", "c"], sticky=False)
+        chosen = [pool.acquire() for _ in range(3)]
+        self.assertEqual(sorted(chosen), ["a", "b", "c"])
+        pool.release("a", 0.1)
+        self.assertEqual(pool.acquire(), "a")
+        self.assertEqual(pool.acquire(healthy=lambda url: url == "b"), "b")
+
+        pool = EndpointPool(["fast", "slow"], strategy="latency", sticky=False)
+        for url, latency in (("fast", 0.1), ("slow", 1.0)):
+            pool.release(pool.acquire(exclude=[u for u in ("fast", "slow") if u != url]),
+                         latency)
+        self.assertEqual(pool.acquire(), "fast")
+        stats = {item["base_url"]: item for item in pool.stats()}
+        self.assertEqual(stats["fast"]["outstanding"], 1)
+        self.assertEqual(stats["slow"]["latency"], 1.0)
+
+    def test_latency_scores_unknown_endpoints(self):
+        pool = EndpointPool(["known", "new", "broken"], strategy="latency",
+                            sticky=False)
+        pool.release(pool.acquire(exclude=["new", "broken"]), 0.5)
+        pool.release(pool.acquire(exclude=["known", "new"]))  # 失败，没有延迟数据
+        # 没有延迟数据的服务按平均延迟估计，失败过的服务估计值更高，不会被优先选择
+        chosen = [pool.acquire() for _ in range(2)]
+        self.assertEqual(sorted(chosen), ["known", "new"])
+        stats = {item["base_url"]: item for item in pool.stats()}
+        self.assertEqual(stats["broken"]["outstanding"], 0)
+
+    def test_sticky_routing(self):
+        pool = EndpointPool(["a", "b", "c"])
+        first = pool.acquire("session-1")
+        self.assertEqual([pool.acquire("session-1") for _ in range(5)],
+                         [first] * 5)
+        # 粘滞的服务不可用时换到其他服务，恢复后回到原来的服务
+        other = pool.acquire("session-1", healthy=lambda url: url != first)
+        self.assertNotEqual(other, first)
+        self.assertEqual(pool.acquire("session-1"), first)
+        self.assertEqual(len({pool.acquire(f"s{i}") for i in range(50)}), 3)
+
+    def test_agent_without_session_spreads_by_load(self):
+        agent = WeeAgent(endpoints=EndpointPool(["a", "b"]))
+        # 没有会话id时不做粘滞，正在进行的请求分散到两个服务
+        chosen = [agent._route(set())[0] for _ in range(4)]
+        self.assertEqual(sorted(chosen), ["a", "a", "b", "b"])
+        agent._release("a")
+        self.assertEqual(agent._route(set())[0], "a")
+
+    def test_sessions_stay_on_one_replica(self):
+        runtime = AgentRuntime(WeeAgent(endpoints=self.urls))
+        for session_id in ("alice", "bob", "carol", "dave"):
+            before = [server.chat_requests for server in self.servers]
+            for _ in range(3):
+                self.assertEqual(runtime(session_id, "hi"), "echo: hi")
+            counts = [server.chat_requests - count
+                      for server, count in zip(self.servers, before)]
+            self.assertEqual(sorted(counts), [0, 3])
+
+    def test_failover(self):
+        dead = self.servers.pop(0)
+        dead.stop()
+        policy = RetryPolicy(breaker_threshold=2, breaker_cooldown=60)
+        # 失败的服务不会记录延迟，按失败次数加罚后不再被选择，不需要等到熔断
+        agent = WeeAgent(endpoints=EndpointPool(self.urls, strategy="latency",
+                                                sticky=False),
+                         retry_policy=policy)
+        with mock.patch("time.sleep") as sleep:
+            for _ in range(4):
+                self.assertEqual(agent.new_session()("hi"), "echo: hi")
+        # 失败后立刻换到另一个服务，不等待
+        self.assertFalse([args for args, _ in sleep.call_args_list if args[0] > 0])
+        self.assertEqual(self.servers[0].chat_requests, 4)
+        self.assertEqual(policy.breaker(self.urls[0]).state, "closed")
+        stats = {item["base_url"]: item for item in agent.endpoints.stats()}
+        self.assertLessEqual(stats[self.urls[0]]["failures"], 1)
+        self.assertEqual(stats[self.urls[1]]["outstanding"], 0)
+
+    def test_circuit_open_fails_over(self):
+        policy = RetryPolicy()
+        agent = WeeAgent(endpoints=self.urls, retry_policy=policy)
+        session = agent.new_session(session_id="s1")
+        sticky = agent.endpoints.acquire("s1")
+        agent.endpoints.release(sticky)
+        # 冷却结束，但已经有一个试探请求在进行，熔断器不放行
+        breaker = policy.breaker(sticky)
+        breaker.opened_at, breaker._probing = time.monotonic() - 60, True
+        self.assertEqual(session("hi"), "echo: hi")
+        self.assertEqual([server.chat_requests for server in self.servers
+                          if server.base_url != sticky], [1])
+        for url in self.urls:  # 没有其他服务时才抛出错误
+            policy.breaker(url).opened_at = time.monotonic()
+        session.user_input("again")
+        with self.assertRaises(CircuitOpenError):
+            session.create()
+        self.assertEqual(sum(server.chat_requests for server in self.servers), 1)
+
+    def test_cache_hits_skip_routing(self):
+        policy = RetryPolicy()
+        agent = WeeAgent(endpoints=self.urls, retry_policy=policy,
+                         response_cache=CompletionCache())
+        agent.temperature = 0
+        self.assertEqual(agent.new_session()("hi"), "echo: hi")
+        before = agent.endpoints.stats()
+        with mock.patch.object(policy, "on_success") as on_success:
+            self.assertEqual(agent.new_session()("hi"), "echo: hi")
+        # 命中缓存的回复没有发往服务，不计入请求数、延迟和重试策略
+        self.assertEqual(agent.endpoints.stats(), before)
+        self.assertEqual(sum(server.chat_requests for server in self.servers), 1)
+        on_success.assert_not_called()
+
+    def test_async_failover(self):
+        self.servers[0].stop()
+        agent = AsyncWeeAgent(endpoints=self.urls,
+                              retry_policy=RetryPolicy(breaker_threshold=1))
+
+        async def run():
+            return await asyncio.gather(
+                *(agent.new_session().acall(f"q{i}") for i in range(4)))
+
+        self.assertEqual(asyncio.run(run()), [f"echo: q{i}" for i in range(4)])
+        self.assertEqual(self.servers[1].chat_requests, 4)
+        self.servers.pop(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
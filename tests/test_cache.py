@@ -0,0 +1,161 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from fake_openai import FakeAsyncClient, FakeClient, make_chunks, \
+    make_completion
+from wee_agent import AsyncWeeAgent, WeeAgent, set_tool
+from wee_agent.cache import CompletionCache, SemanticCache, \
+    completion_cache_key
+
+
+class CountingAgent(WeeAgent):
+    calls = 0
+
+    @set_tool
+    def count(self, step: int) -> str:
+        """
+        计算步长的两倍
+        :param step: 步长
+        :return: 步长的两倍
+        """
+        CountingAgent.calls += 1
+        return str(step * 2)
+
+
+def _tool_turn():
+    return [make_completion(tool_calls=[("call_1", "count", '{"step": 1}')]),
+            make_completion("counted")]
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_key_is_canonical(self):
+        a = {"model": "gpt-4o", "messages": [{"role": "user", "content": "x"}],
+             "temperature": 0}
+        b = {"temperature": 0, "stream": True, "model": "gpt-4o",
+             "messages": [{"content": "x", "role": "user"}]}
+        self.assertEqual(completion_cache_key(a), completion_cache_key(b))
+        self.assertNotEqual(completion_cache_key(a),
+                            completion_cache_key({**a, "temperature": 1}))
+
+    def test_memory_hit_and_lru(self):
+        cache = CompletionCache(max_entries=2)
+        for key in ("a", "b", "c"):
+            cache.set(key, make_completion(key))
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c").choices[0].message.content, "c")
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        cache = CompletionCache(ttl=0.05)
+        cache.set("a", make_completion("a"))
+        self.assertIsNotNone(cache.get("a"))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_disk_tier_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            writer = CompletionCache(path=path)
+            writer.set("a", make_completion("from disk"))
+            reader = CompletionCache(path=path)
+            self.assertEqual(reader.get("a").choices[0].message.content,
+                             "from disk")
+            self.assertEqual(reader.stats()["disk_hits"], 1)
+            reader.get("a")
+            self.assertEqual(reader.stats()["memory_hits"], 1)
+            writer.close()
+            reader.close()
+
+    def test_tool_calls_replay(self):
+        cache = CompletionCache()
+        CountingAgent.calls = 0
+        first = CountingAgent(response_cache=cache)
+        first.temperature = 0
+        first.open_ai_client = FakeClient(_tool_turn())
+        self.assertEqual(first("go"), "counted")
+
+        second = CountingAgent(response_cache=cache)
+        second.name = first.name
+        second.prompt = first.prompt
+        second.user_name = first.user_name
+        second.temperature = 0
+        second.open_ai_client = FakeClient([])
+        self.assertEqual(second("go"), "counted")
+        self.assertEqual(CountingAgent.calls, 2)  # tool在重放时再次执行
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(len(second.history_messages), 4)
+
+    def test_stream_and_async_share_entries(self):
+        cache = CompletionCache()
+        agent = WeeAgent(name="a", user_name="u", stream=True,
+                         response_cache=cache)
+        agent.open_ai_client = FakeClient([make_chunks(["he", "llo"])])
+        self.assertEqual(agent("hi"), "hello")
+
+        plain = WeeAgent(name="a", user_name="u", response_cache=cache)
+        plain.open_ai_client = FakeClient([])
+        self.assertEqual(plain("hi"), "hello")
+
+        async_agent = AsyncWeeAgent(name="a", user_name="u", stream=True,
+                                    response_cache=cache)
+        async_agent.open_ai_client = FakeAsyncClient([])
+        self.assertEqual(asyncio.run(async_agent.acall("hi")), "hello")
+        self.assertEqual(cache.stats()["hits"], 2)
+
+
+def _bag_of_words(text: str) -> list:
+    # 测试用的向量化函数：按单词哈希到固定维度
+    vector = [0.0] * 64
+    for word in text.lower().replace("?", "").split():
+        vector[hash(word) % 64] += 1.0
+    return vector
+
+
+class SemanticCacheTestCase(unittest.TestCase):
+
+    def test_similar_question_hits(self):
+        cache = SemanticCache(threshold=0.8, embed=_bag_of_words)
+        agent = WeeAgent(semantic_cache=cache)
+        agent.open_ai_client = FakeClient([make_completion("at 9 am")])
+        self.assertEqual(agent("when does the shop open"), "at 9 am")
+        self.assertEqual(agent("when does the shop open?"), "at 9 am")
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "entries": 1})
+        self.assertEqual([m.role for m in agent.history_messages],
+                         ["user", "assistant", "user", "assistant"])
+        self.assertEqual(agent.message_window_round_count, 2)
+
+    def test_different_prompt_or_question_misses(self):
+        cache = SemanticCache(threshold=0.8, embed=_bag_of_words)
+        agent = WeeAgent(semantic_cache=cache)
+        agent.open_ai_client = FakeClient(
+            [make_completion("at 9 am"), make_completion("no"),
+             make_completion("at 10 am")])
+        agent("when does the shop open")
+        self.assertEqual(agent("do you sell bread"), "no")
+        other = WeeAgent(prompt="another shop", semantic_cache=cache)
+        other.open_ai_client = agent.open_ai_client
+        self.assertEqual(other("when does the shop open"), "at 10 am")
+
+    def test_capacity(self):
+        cache = SemanticCache(threshold=0.99, max_entries=100)
+        for i in range(250):
+            vector = [0.0] * 256
+            vector[i] = 1.0
+            cache.set("p", vector, str(i))
+        self.assertEqual(cache.stats()["entries"], 100)
+        hit = [0.0] * 256
+        hit[249] = 1.0
+        self.assertEqual(cache.get("p", hit), "249")
+        hit = [0.0] * 256
+        hit[0] = 1.0
+        self.assertIsNone(cache.get("p", hit))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fake_openai import make_completion
+from wee_agent import AsyncWeeAgent, WeeAgent
+from wee_agent import client
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持keep-alive
+
+    def _reply(self, body: bytes):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._reply(json.dumps(
+            make_completion("pong").model_dump()).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class MyTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}/v1"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        client.close_clients()
+
+    def setUp(self):
+        client.close_clients()
+
+    def _stats(self, is_async: bool = False) -> dict:
+        return next(stats for stats in client.pool_stats()
+                    if stats["base_url"].startswith(self.base_url)
+                    and stats["async"] == is_async)
+
+    def test_agents_share_connection_pool(self):
+        first = WeeAgent(base_url=self.base_url)
+        second = WeeAgent(base_url=self.base_url, request_timeout=30)
+        self.assertIs(first.open_ai_client, client.get_client(self.base_url))
+        self.assertIsNot(second.open_ai_client, first.open_ai_client)
+        self.assertIs(second.open_ai_client._client,
+                      first.open_ai_client._client)
+        self.assertEqual(second.open_ai_client.timeout, 30)
+
+        self.assertEqual(first("ping"), "pong")
+        self.assertEqual(second("ping"), "pong")
+        stats = self._stats()
+        self.assertEqual((stats["requests"], stats["responses"]), (2, 2))
+        self.assertEqual(stats["connections"], 1)  # 第二个代理复用了连接
+        self.assertEqual(stats["idle_connections"], 1)
+
+    def test_warmup_connections(self):
+        client.configure_pool(max_keepalive_connections=4)
+        try:
+            self.assertEqual(client.warmup_connections(self.base_url,
+                                                       connections=3), 3)
+            self.assertEqual(self._stats()["connections"], 3)
+        finally:
+            client.configure_pool(max_keepalive_connections=100)
+
+    def test_async_client(self):
+        async def main():
+            agent = AsyncWeeAgent(base_url=self.base_url)
+            await client.awarmup_connections(self.base_url, connections=2)
+            answer = await agent.acall("ping")
+            await agent.open_ai_client.close()
+            return answer
+
+        self.assertEqual(asyncio.run(main()), "pong")
+        self.assertEqual(self._stats(is_async=True)["requests"], 3)
+
+    def test_async_client_across_event_loops(self):
+        agent = AsyncWeeAgent(base_url=self.base_url)
+        # 每次asyncio.run()都是新的事件循环，不能复用上一个事件循环中的连接
+        for _ in range(2):
+            self.assertEqual(asyncio.run(agent.acall("ping")), "pong")
+        self.assertEqual(self._stats(is_async=True)["requests"], 2)
+
+    def test_only_chat_calls_skip_sdk_retries(self):
+        shared = client.get_client(self.base_url)
+        self.assertEqual(shared.max_retries, 2)  # 向量等其他接口保留openai库的重试
+        chat = client.without_retries(shared)
+        self.assertEqual(chat.max_retries, 0)
+        self.assertIs(client.without_retries(shared), chat)
+        self.assertIs(chat._client, shared._client)
+
+    def test_unknown_setting(self):
+        with self.assertRaises(ValueError):
+            client.configure_pool(pool_size=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
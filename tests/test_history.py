@@ -0,0 +1,55 @@
+import unittest
+
+from fake_openai import FakeClient, make_completion
+from wee_agent import WeeAgent
+from wee_agent.history import MessageHistory
+from wee_agent.models import Completion
+
+
+def _chat(agent: WeeAgent, rounds: int) -> None:
+    agent.open_ai_client = FakeClient(
+        [make_completion(f"answer {i}") for i in range(rounds)])
+    for i in range(rounds):
+        agent(f"question {i}")
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_keep_everything_by_default(self):
+        agent = WeeAgent(max_round=2)
+        _chat(agent, 100)
+        self.assertEqual(len(agent.history_messages), 200)
+        self.assertEqual(agent.history.offset, 0)
+
+    def test_release_trimmed_messages(self):
+        agent = WeeAgent(max_round=2, history_retention=0)
+        _chat(agent, 500)
+        self.assertLessEqual(len(agent.history_messages), 70)
+        self.assertEqual(agent.history.offset + len(agent.history_messages),
+                         1000)
+        self.assertEqual([m["content"] for m in
+                          agent._build_payload()["messages"][1:]],
+                         [text for i in range(497, 500)
+                          for text in (f"question {i}", f"answer {i}")])
+        self.assertEqual(agent.window_tokens,
+                         agent.system_message_tokens + 3 + sum(
+                             agent.message_tokens[-6:]))
+        # 释放后仍然可以按轮次裁剪
+        agent.trim_history()
+        self.assertEqual(agent._build_payload()["messages"][1]["content"],
+                         "question 498")
+
+    def test_retention_keeps_recent_messages(self):
+        history = MessageHistory(retention=10)
+        for i in range(200):
+            history.append(Completion.UserMessage(role="user", content=str(i)),
+                           {}, 1)
+        self.assertEqual(history.release(150), 140)
+        self.assertEqual(history.offset, 140)
+        self.assertEqual(history.messages[0].content, "140")
+        self.assertEqual(history.token_sum(150, 200), 50)
+        self.assertEqual(list(history.round_starts), list(range(140, 200)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from fake_server import FakeServer
+from wee_agent import AsyncWeeAgent, WeeAgent
+from wee_agent.batch import download_batch_results, read_batch_results, \
+    submit_batch, write_batch_requests
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer(delay=0.05)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def test_map_is_concurrent_and_ordered(self):
+        agent = WeeAgent(base_url=self.server.base_url)
+        inputs = [f"q{i}" for i in range(16)] + ["bad input"]
+        progress = []
+        start = time.perf_counter()
+        results = agent.map(inputs, concurrency=8,
+                            progress=lambda done, total: progress.append(done))
+        self.assertLess(time.perf_counter() - start, 0.5)  # 串行需要0.85秒
+        self.assertEqual([r.output for r in results[:16]],
+                         [f"echo: q{i}" for i in range(16)])
+        self.assertIsNone(results[16].output)
+        self.assertIn("BadRequestError", results[16].error)
+        self.assertEqual(progress, list(range(1, 18)))
+        self.assertEqual(len(agent.history_messages), 0)  # 每个输入使用独立的会话
+
+    def test_map_resumes_from_results_file(self):
+        agent = WeeAgent(base_url=self.server.base_url)
+        path = os.path.join(self.directory.name, "results.jsonl")
+        inputs = ["a", "bad", "c"]
+        agent.map(inputs, results_path=path)
+        self.assertEqual(self.server.chat_requests, 3)
+
+        # 模拟中断：最后一行只写了一半
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"index": 2, "inp')
+        inputs.append("d")
+        results = agent.map(inputs, results_path=path)
+        # 只重新处理失败的和新增的输入
+        self.assertEqual(self.server.chat_requests, 5)
+        self.assertEqual([r.output for r in results],
+                         ["echo: a", None, "echo: c", "echo: d"])
+
+    def test_amap(self):
+        agent = AsyncWeeAgent(base_url=self.server.base_url)
+        inputs = [f"q{i}" for i in range(16)]
+
+        async def main():
+            start = time.perf_counter()
+            results = await agent.amap(inputs, concurrency=16)
+            await agent.open_ai_client.close()
+            return results, time.perf_counter() - start
+
+        results, elapsed = asyncio.run(main())
+        self.assertEqual([r.output for r in results],
+                         [f"echo: {text}" for text in inputs])
+        self.assertLess(elapsed, 0.4)
+
+    def test_batch_round_trip(self):
+        agent = WeeAgent(base_url=self.server.base_url, stream=True,
+                         user_name="bob")
+        inputs = ["x", "bad", "z"]
+        requests_path = os.path.join(self.directory.name, "requests.jsonl")
+        results_path = os.path.join(self.directory.name, "results.jsonl")
+        self.assertEqual(write_batch_requests(agent, inputs, requests_path), 3)
+        with open(requests_path, encoding="utf-8") as f:
+            first = json.loads(f.readline())
+        self.assertEqual(first["custom_id"], "0")
+        self.assertNotIn("stream", first["body"])
+        self.assertEqual(first["body"]["messages"][-1],
+                         {"role": "user", "content": "x", "name": "bob"})
+
+        client = agent.open_ai_client
+        batch_id = submit_batch(client, requests_path)
+        self.assertFalse(download_batch_results(client, batch_id, results_path))
+        self.assertTrue(download_batch_results(client, batch_id, results_path))
+        results = read_batch_results(results_path, inputs)
+        self.assertEqual([r.output for r in results], ["echo: x", None, "echo: z"])
+        self.assertIn("400", results[1].error)
+
+
+if __name__ == '__main__':
+    unittest.main()
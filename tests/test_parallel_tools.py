@@ -0,0 +1,83 @@
+import asyncio
+import time
+import unittest
+
+from fake_openai import FakeAsyncClient, FakeClient, make_completion
+from wee_agent import AsyncWeeAgent, WeeAgent, set_tool
+
+
+class SleepyAgent(WeeAgent):
+
+    @staticmethod
+    @set_tool
+    def sleep_for(seconds: float) -> str:
+        """
+        等待指定的秒数
+        :param seconds: 等待的秒数
+        :return: 等待的秒数
+        """
+        time.sleep(seconds)
+        return str(seconds)
+
+
+class AsyncSleepyAgent(AsyncWeeAgent):
+
+    @staticmethod
+    @set_tool
+    async def sleep_for(seconds: float) -> str:
+        """
+        等待指定的秒数
+        :param seconds: 等待的秒数
+        :return: 等待的秒数
+        """
+        await asyncio.sleep(seconds)
+        return str(seconds)
+
+
+def _tool_turn():
+    # 第一个调用最慢，检查结果是否仍按原顺序返回
+    return [
+        make_completion(tool_calls=[
+            ("call_1", "sleep_for", '{"seconds": 0.3}'),
+            ("call_2", "sleep_for", '{"seconds": 0.1}'),
+            ("call_3", "sleep_for", '{"seconds": 0.2}'),
+        ]),
+        make_completion("done"),
+    ]
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_parallel_tool_calls(self):
+        agent = SleepyAgent(tool_workers=3)
+        agent.open_ai_client = FakeClient(_tool_turn())
+        start = time.perf_counter()
+        self.assertEqual(agent("go"), "done")
+        self.assertLess(time.perf_counter() - start, 0.5)
+        tool_messages = [m for m in agent.history_messages if m.role == "tool"]
+        self.assertEqual([m.tool_call_id for m in tool_messages],
+                         ["call_1", "call_2", "call_3"])
+        self.assertEqual([m.content for m in tool_messages],
+                         ["0.3", "0.1", "0.2"])
+
+    def test_sequential_by_default(self):
+        agent = SleepyAgent()
+        agent.open_ai_client = FakeClient(_tool_turn())
+        start = time.perf_counter()
+        self.assertEqual(agent("go"), "done")
+        self.assertGreaterEqual(time.perf_counter() - start, 0.6)
+        self.assertIsNone(agent.tool_executor)
+
+    def test_async_parallel_tool_calls(self):
+        agent = AsyncSleepyAgent(tool_workers=3)
+        agent.open_ai_client = FakeAsyncClient(_tool_turn())
+        start = time.perf_counter()
+        self.assertEqual(asyncio.run(agent.acall("go")), "done")
+        self.assertLess(time.perf_counter() - start, 0.5)
+        tool_messages = [m for m in agent.history_messages if m.role == "tool"]
+        self.assertEqual([m.content for m in tool_messages],
+                         ["0.3", "0.1", "0.2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
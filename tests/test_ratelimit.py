@@ -0,0 +1,125 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+import openai
+
+from fake_openai import FakeAsyncClient, FakeClient, make_completion, make_error
+from wee_agent import AsyncWeeAgent, WeeAgent
+from wee_agent.cache import CompletionCache
+from wee_agent.errors import RateLimitExceededError
+from wee_agent.ratelimit import RateLimiter
+from wee_agent.retry import RetryPolicy
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_requests_are_paced(self):
+        limiter = RateLimiter(rpm=120)
+        waits = [limiter.reserve() for _ in range(122)]
+        self.assertEqual(waits[:120], [0.0] * 120)
+        # 之后每个请求在前一个的基础上多等待0.5秒
+        self.assertAlmostEqual(waits[120], 0.5, delta=0.05)
+        self.assertAlmostEqual(waits[121], 1.0, delta=0.05)
+        self.assertEqual(limiter.stats()["admitted"], 122)
+
+    def test_fast_rejection(self):
+        limiter = RateLimiter(tpm=600, max_wait=0)
+        self.assertEqual(limiter.reserve(500), 0)
+        with self.assertRaises(RateLimitExceededError):
+            limiter.reserve(500)
+        # 被拒绝的请求不扣除令牌
+        self.assertEqual(limiter.reserve(90), 0)
+        stats = limiter.stats()
+        self.assertEqual((stats["admitted"], stats["rejected"]), (2, 1))
+
+    def test_reconcile(self):
+        limiter = RateLimiter(tpm=60000)
+        limiter.reserve(1000)
+        limiter.reconcile(1000, 3000)
+        self.assertAlmostEqual(limiter.stats()["tokens_available"], 57000,
+                               delta=10)
+        limiter.reconcile(3000, 0)
+        self.assertAlmostEqual(limiter.stats()["tokens_available"], 60000,
+                               delta=1)
+
+    def test_shared_through_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "limits.sqlite")
+            first = RateLimiter(rpm=60, path=path, name="key-1")
+            second = RateLimiter(rpm=60, path=path, name="key-1")
+            other = RateLimiter(rpm=60, path=path, name="key-2")
+            for _ in range(30):
+                first.reserve()
+                second.reserve()
+            self.assertAlmostEqual(first.reserve(), 1.0, delta=0.05)
+            self.assertEqual(other.reserve(), 0)
+            for limiter in (first, second, other):
+                limiter.close()
+
+    def test_agent_reserves_and_reconciles(self):
+        limiter = RateLimiter(rpm=60, tpm=6000)
+        agent = WeeAgent(rate_limiter=limiter,
+                         response_cache=CompletionCache())
+        agent.open_ai_client = FakeClient(
+            [make_completion("a", prompt_tokens=100, completion_tokens=50)])
+        agent.temperature = 0
+        agent("hi")
+        stats = limiter.stats()
+        self.assertEqual(stats["admitted"], 1)
+        self.assertAlmostEqual(stats["tokens_available"], 5850, delta=5)
+
+        # 命中缓存的请求不经过限流器
+        session = agent.new_session()
+        session("hi")
+        self.assertEqual(limiter.stats()["admitted"], 1)
+
+    def test_failed_attempts_refund_tokens(self):
+        limiter = RateLimiter(rpm=60, tpm=6000)
+        agent = WeeAgent(rate_limiter=limiter,
+                         retry_policy=RetryPolicy(base_delay=0, max_delay=0))
+        agent.open_ai_client = FakeClient(
+            [make_error(openai.InternalServerError, 503),
+             make_error(openai.InternalServerError, 503),
+             make_completion("a", prompt_tokens=100, completion_tokens=50)])
+        self.assertEqual(agent("hi"), "a")
+        stats = limiter.stats()
+        # 每次尝试都占用一个请求，但只扣除成功的那次实际消耗的token
+        self.assertEqual(stats["admitted"], 3)
+        self.assertAlmostEqual(stats["tokens_available"], 5850, delta=5)
+        self.assertIsNone(agent._reserved_tokens)
+
+    def test_rejected_call_is_not_refunded(self):
+        limiter = RateLimiter(tpm=6000, max_wait=0)
+        agent = WeeAgent(rate_limiter=limiter)
+        agent.open_ai_client = FakeClient([make_completion("a")])
+        limiter.reserve(5990)
+        agent.user_input("hi")
+        with self.assertRaises(RateLimitExceededError):
+            agent.create()
+        # 被拒绝的请求没有扣除令牌，也不能退还，否则每次拒绝都会抬高限额
+        self.assertLess(limiter.stats()["tokens_available"], 20)
+        self.assertIsNone(agent._reserved_tokens)
+
+    def test_async_agent_waits_without_blocking(self):
+        limiter = RateLimiter(rpm=600)
+        agent = AsyncWeeAgent(rate_limiter=limiter)
+        agent.open_ai_client = FakeAsyncClient([make_completion("a")])
+        for _ in range(600):  # 创建代理之后再耗尽令牌，避免创建代理期间补充令牌
+            limiter.reserve()
+
+        async def main():
+            start = time.perf_counter()
+            answer, _ = await asyncio.gather(agent.acall("hi"),
+                                             asyncio.sleep(0.01))
+            return answer, time.perf_counter() - start
+
+        answer, elapsed = asyncio.run(main())
+        self.assertEqual(answer, "a")
+        self.assertGreaterEqual(elapsed, 0.09)
+
+
+if __name__ == '__main__':
+    unittest.main()
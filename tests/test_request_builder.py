@@ -0,0 +1,57 @@
+import unittest
+
+from fake_openai import FakeClient, make_completion
+from wee_agent import WeeAgent, set_tool
+
+
+class EchoAgent(WeeAgent):
+
+    @staticmethod
+    @set_tool
+    def echo(text: str) -> str:
+        """
+        原样返回输入的文本
+        :param text: 输入的文本
+        :return: 输入的文本
+        """
+        return text
+
+
+def _legacy_payload(agent: WeeAgent) -> dict:
+    # 原来的构造方式：赋值后整体序列化
+    agent.completion.messages = agent._create_messages()
+    return agent.completion.model_dump(exclude_defaults=True,
+                                       exclude_none=True)
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_payload_matches_legacy(self):
+        agent = EchoAgent(max_round=0)
+        agent.temperature = 0.2
+        agent.response_format = "json_object"
+        agent.open_ai_client = FakeClient([
+            make_completion(tool_calls=[("call_1", "echo", '{"text": "a"}')]),
+            make_completion("done"),
+            make_completion("again"),
+        ])
+        agent("go")
+        agent.user_input("hi", name="user")  # 默认值会被省略
+        agent.user_image_input(img_url="https://example.com/a.png",
+                               text="what is it")
+        agent()
+        agent.trim_history()
+        self.assertEqual(agent._build_payload(), _legacy_payload(agent))
+
+    def test_history_is_not_revalidated(self):
+        agent = WeeAgent(max_round=0, user_name="bob")
+        agent.open_ai_client = FakeClient([make_completion("a")])
+        agent("hi")
+        # 请求参数直接来自缓存的序列化结果，completion.messages不再随每轮对话赋值
+        self.assertEqual(agent.completion.messages, [])
+        self.assertEqual(agent.open_ai_client.requests[0]["messages"][1],
+                         {"role": "user", "content": "hi", "name": "bob"})
+
+
+if __name__ == '__main__':
+    unittest.main()
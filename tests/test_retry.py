@@ -0,0 +1,166 @@
+import asyncio
+import email.utils
+import time
+import unittest
+from unittest import mock
+
+import httpx
+import openai
+
+from fake_openai import FakeAsyncClient, FakeClient, make_completion, \
+    make_error
+from wee_agent import AsyncWeeAgent, WeeAgent
+from wee_agent.errors import CircuitOpenError, RateLimitExceededError
+from wee_agent.ratelimit import RateLimiter
+from wee_agent.retry import CircuitBreaker, RetryBudget, RetryPolicy
+
+
+def _timeout():
+    return openai.APITimeoutError(
+        request=httpx.Request("POST", "http://fake/chat/completions"))
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_full_jitter_and_retry_after(self):
+        policy = RetryPolicy(base_delay=1, max_delay=8)
+        for attempt in range(6):
+            delay = policy.delay(attempt)
+            self.assertTrue(0 <= delay <= min(8, 2 ** attempt))
+        error = make_error(openai.RateLimitError, 429,
+                           headers={"retry-after": "7"})
+        self.assertEqual(policy.delay(0, error), 7)
+        error = make_error(openai.RateLimitError, 429,
+                           headers={"retry-after-ms": "250"})
+        self.assertEqual(policy.delay(0, error), 0.25)
+        date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        error = make_error(openai.RateLimitError, 429,
+                           headers={"retry-after": date})
+        self.assertTrue(25 < policy.delay(0, error) <= 30)
+        error = make_error(openai.RateLimitError, 429,
+                           headers={"retry-after": "3600"})
+        self.assertEqual(policy.delay(0, error), policy.max_retry_after)
+
+    def test_budget(self):
+        budget = RetryBudget(max_tokens=4, token_ratio=0.5)
+        self.assertTrue(budget.record_failure())  # 3 > 2
+        self.assertFalse(budget.record_failure())  # 2
+        budget.record_success()
+        self.assertTrue(budget.tokens > 2)
+
+        policy = RetryPolicy(budget=RetryBudget(max_tokens=2))
+        self.assertIsNone(policy.on_failure("x", _timeout(), 0))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())  # 试探请求
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+    def test_agent_retries_with_server_hint(self):
+        agent = WeeAgent(retry_policy=RetryPolicy())
+        agent.open_ai_client = FakeClient([
+            make_error(openai.RateLimitError, 429,
+                       headers={"retry-after": "2"}),
+            _timeout(),
+            make_completion("ok"),
+        ])
+        with mock.patch("wee_agent.wee_agent.time.sleep") as sleep:
+            self.assertEqual(agent.create(), "ok")
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(sleep.call_args_list[0].args, (2.0,))
+        self.assertLessEqual(sleep.call_args_list[1].args[0], 2)
+
+    def test_bad_request_is_not_retried(self):
+        agent = WeeAgent(retry_policy=RetryPolicy())
+        agent.open_ai_client = FakeClient(
+            [make_error(openai.BadRequestError, 400, code="invalid_value")])
+        agent.user_input("hi")
+        with self.assertRaises(openai.BadRequestError):
+            agent.create()
+        self.assertEqual(len(agent.open_ai_client.requests), 1)
+
+    def test_context_length_trims_until_last_round(self):
+        agent = WeeAgent(retry_policy=RetryPolicy(), max_round=0)
+        too_long = make_error(openai.BadRequestError, 400,
+                              code="context_length_exceeded")
+        agent.open_ai_client = FakeClient(
+            [make_completion("a"), too_long, make_completion("b"), too_long,
+             too_long])
+        agent("first")
+        self.assertEqual(agent("second"), "b")
+        self.assertEqual(
+            [m["content"] for m in
+             agent.open_ai_client.requests[2]["messages"][1:]], ["second"])
+        agent.user_input("third")
+        with self.assertRaises(openai.BadRequestError):
+            agent.create()  # 裁剪一轮后仍然超长，且只剩最后一轮
+        self.assertEqual(len(agent.open_ai_client.requests), 5)
+
+    def test_circuit_open_fails_fast(self):
+        policy = RetryPolicy(max_attempts=1, breaker_threshold=2)
+        agent = WeeAgent(retry_policy=policy)
+        agent.open_ai_client = FakeClient([_timeout(), _timeout()])
+        agent.user_input("hi")
+        for _ in range(2):
+            with self.assertRaises(openai.APITimeoutError):
+                agent.create()
+        with self.assertRaises(CircuitOpenError):
+            agent.create()
+        self.assertEqual(len(agent.open_ai_client.requests), 2)
+
+    def test_probe_without_verdict_releases_slot(self):
+        policy = RetryPolicy(max_attempts=1, breaker_threshold=1, breaker_cooldown=0.01)
+        limiter = RateLimiter(rpm=1, max_wait=0)
+        agent = WeeAgent(retry_policy=policy, rate_limiter=limiter)
+        agent.open_ai_client = FakeClient([_timeout(), make_completion("ok")])
+        endpoint = str(agent.open_ai_client.base_url)
+        agent.user_input("hi")
+        with self.assertRaises(openai.APITimeoutError):
+            agent.create()
+        time.sleep(0.02)  # 冷却结束，下一个请求是试探请求
+        # 试探请求被客户端限流拒绝，没有得到结论，之后的请求仍然可以试探
+        with self.assertRaises(RateLimitExceededError):
+            agent.create()
+        self.assertTrue(policy.breaker(endpoint).allow())
+        policy.breaker(endpoint).release()
+        agent.rate_limiter = None
+        self.assertEqual(agent.create(), "ok")
+        self.assertEqual(policy.breaker(endpoint).state, "closed")
+
+    def test_async_wait_does_not_block(self):
+        agent = AsyncWeeAgent(
+            retry_policy=RetryPolicy(base_delay=0.2, max_delay=0.2))
+        agent.open_ai_client = FakeAsyncClient([
+            make_error(openai.InternalServerError, 503,
+                       headers={"retry-after": "0.2"}),
+            make_completion("ok"),
+        ])
+        ticks = []
+
+        async def ticker():
+            for _ in range(5):
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.02)
+
+        async def main():
+            answer, _ = await asyncio.gather(agent.acall("hi"), ticker())
+            return answer
+
+        self.assertEqual(asyncio.run(main()), "ok")
+        self.assertEqual(len(ticks), 5)
+        self.assertLess(ticks[-1] - ticks[0], 0.15)
+
+
+if __name__ == '__main__':
+    unittest.main()
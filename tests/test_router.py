@@ -0,0 +1,97 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import openai
+
+from fake_openai import FakeAsyncClient, FakeClient, make_completion, \
+    make_error
+from wee_agent import AsyncWeeAgent, WeeAgent
+from wee_agent.retry import RetryPolicy
+from wee_agent.router import ModelRoute, ModelRouter
+
+
+def _router(**kwargs) -> ModelRouter:
+    return ModelRouter([ModelRoute("gpt-4o-mini", max_prompt_tokens=200),
+                        ModelRoute("gpt-4o", vision=True)], **kwargs)
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_rules(self):
+        router = ModelRouter([ModelRoute("small", context_length=1000, tools=False),
+                              ModelRoute("gpt-4o", vision=True)])
+        self.assertEqual(router.routes[0].max_prompt_tokens, 900)
+        text = {"messages": [{"role": "user", "content": "hi"}]}
+        image = {"messages": [{"role": "user", "content": [
+            {"type": "image_url", "image_url": {"url": "x", "detail": "low"}}]}]}
+        tools = dict(text, tools=[{"type": "function"}])
+        models = lambda payload, tokens: [route.model for route in
+                                          router.candidates(payload, tokens)]
+        self.assertEqual(models(text, 100), ["small", "gpt-4o"])
+        self.assertEqual(models(text, 5000), ["gpt-4o"])
+        self.assertEqual(models(tools, 100), ["gpt-4o"])
+        self.assertEqual(models(image, 100), ["gpt-4o"])
+        self.assertEqual(models(text, 10 ** 6), ["gpt-4o"])  # 都不能处理时使用最后一个
+        with self.assertRaises(ValueError):
+            ModelRoute("unknown-model")
+
+    def test_model_name_is_not_rewritten(self):
+        agent = WeeAgent()
+        agent.model = "gpt-4o-mini"
+        self.assertEqual(agent.model, "gpt-4o-mini")
+        agent.model = "gpt-4-custom"
+        self.assertEqual(agent.model, "gpt-4-custom")
+
+    def test_cheap_model_first(self):
+        agent = WeeAgent(router=_router())
+        agent.open_ai_client = FakeClient([make_completion("short"),
+                                           make_completion("long")])
+        self.assertEqual(agent("hi"), "short")
+        self.assertEqual(agent("x" * 4000), "long")  # prompt太长，跳过小模型
+        self.assertEqual([r["model"] for r in agent.open_ai_client.requests],
+                         ["gpt-4o-mini", "gpt-4o"])
+        self.assertEqual(agent.router.stats()[0]["requests"], 1)
+
+    def test_escalate_on_invalid_json_and_rate_limit(self):
+        agent = WeeAgent(router=_router())
+        agent.response_format = "json_object"
+        agent.open_ai_client = FakeClient([make_completion("not json"),
+                                           make_completion('{"ok": true}')])
+        self.assertEqual(agent("hi"), '{"ok": true}')
+
+        session = agent.new_session()
+        session.open_ai_client = FakeClient([
+            make_error(openai.RateLimitError, 429, headers={"retry-after": "30"}),
+            make_completion('{"ok": 1}')])
+        with mock.patch("time.sleep") as sleep:
+            self.assertEqual(session("hi"), '{"ok": 1}')
+        sleep.assert_not_called()  # 不等待限流，直接换下一个模型
+        self.assertEqual([r["model"] for r in session.open_ai_client.requests],
+                         ["gpt-4o-mini", "gpt-4o"])
+        self.assertEqual([item["escalations"] for item in agent.router.stats()],
+                         [2, 0])
+
+    def test_escalation_can_be_disabled(self):
+        agent = WeeAgent(router=_router(escalate_on_error=False),
+                         retry_policy=RetryPolicy(max_attempts=1))
+        agent.open_ai_client = FakeClient([
+            make_error(openai.InternalServerError, 500)])
+        with self.assertRaises(openai.InternalServerError):
+            agent._respond("hi")
+        self.assertEqual(len(agent.open_ai_client.requests), 1)
+
+    def test_async_cascade(self):
+        agent = AsyncWeeAgent(router=_router(validate=lambda text: "sure" in text))
+        agent.open_ai_client = FakeAsyncClient([make_completion("maybe"),
+                                                make_completion("sure")])
+        self.assertEqual(asyncio.run(agent.acall("hi")), "sure")
+        self.assertEqual([r["model"] for r in agent.open_ai_client.requests],
+                         ["gpt-4o-mini", "gpt-4o"])
+        # 被拒绝的回复不进入对话历史
+        self.assertEqual([m.content for m in agent.history_messages],
+                         ["hi", "sure"])
+
+
+if __name__ == '__main__':
+    unittest.main()
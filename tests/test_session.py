@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from fake_openai import FakeAsyncClient, FakeClient, make_completion
+from wee_agent import AsyncWeeAgent, WeeAgent, set_tool
+from wee_agent.session import AgentRuntime
+
+
+class EchoAgent(WeeAgent):
+
+    @set_tool
+    def whoami(self) -> str:
+        """
+        返回当前会话的用户名称
+        :return: 用户名称
+        """
+        return self.user_name
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_sessions_keep_separate_history(self):
+        agent = EchoAgent(user_name="template")
+        agent.open_ai_client = FakeClient(
+            [make_completion(tool_calls=[("call_1", "whoami", "{}")]),
+             make_completion("hi alice"), make_completion("hi bob")])
+        runtime = AgentRuntime(agent)
+        alice = runtime.session("a", user_name="alice")
+        self.assertEqual(alice("hello"), "hi alice")
+        self.assertEqual(runtime("b", "hello"), "hi bob")
+
+        # 两个会话共享客户端和tools，但历史消息各自独立
+        self.assertIs(runtime.get("b").open_ai_client, agent.open_ai_client)
+        self.assertIs(runtime.get("b").tool_list, agent.tool_list)
+        self.assertEqual(len(alice.history_messages), 4)
+        self.assertEqual(alice.history_messages[2].content, "alice")
+        self.assertEqual(len(runtime.get("b").history_messages), 2)
+        self.assertEqual(len(agent.history_messages), 0)
+        requests = agent.open_ai_client.requests
+        self.assertEqual(requests[2]["messages"][1]["name"], "template")
+        self.assertEqual(len(requests[2]["messages"]), 2)
+
+    def test_session_settings_do_not_leak(self):
+        agent = WeeAgent()
+        session = agent.new_session()
+        # 会话只保存对话状态，配置从模板读取；第一次修改completion的参数时才拷贝
+        self.assertNotIn("tool_list", session.__dict__)
+        self.assertIs(session.completion, agent.completion)
+        session.temperature = 0
+        session.stream_options = True
+        self.assertEqual(session.completion.temperature, 0)
+        self.assertEqual(agent.completion.temperature, 1)
+        self.assertFalse(agent.stream_options)
+        session.response_format = "json_object"
+        self.assertEqual(agent.response_format, "text")
+        nested = session.new_session()
+        self.assertEqual((nested.temperature, nested.response_format), (0, "json_object"))
+        self.assertEqual(len(nested.history_messages), 0)
+
+    def test_eviction(self):
+        runtime = AgentRuntime(WeeAgent(), max_sessions=2, idle_timeout=0.05)
+        first = runtime.session("1")
+        runtime.session("2")
+        self.assertIs(runtime.session("1"), first)
+        runtime.session("3")
+        self.assertNotIn("2", runtime)
+        self.assertEqual(len(runtime), 2)
+        time.sleep(0.06)
+        self.assertIsNone(runtime.get("1"))
+        self.assertEqual(runtime.stats(),
+                         {"sessions": 0, "created": 3, "resumed": 0,
+                          "evictions": 3})
+        self.assertFalse(runtime.end_session("1"))
+
+    def test_session_loads_outside_lock(self):
+        agent = WeeAgent()
+        runtime = AgentRuntime(agent)
+        loading, loaded = threading.Event(), threading.Event()
+        new_session = agent.new_session
+
+        def slow_new_session(**kwargs):
+            if kwargs["session_id"] == "slow":  # 模拟从会话存储恢复时的磁盘读取
+                loading.set()
+                loaded.wait(5)
+            return new_session(**kwargs)
+
+        results = []
+        with mock.patch.object(agent, "new_session", side_effect=slow_new_session):
+            threads = [threading.Thread(target=lambda: results.append(runtime.session("slow")))
+                       for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            loading.wait(5)
+            # 恢复会话时不持有锁，其他会话不被阻塞
+            other = threading.Thread(target=runtime.session, args=("fast",))
+            other.start()
+            other.join(1)
+            self.assertFalse(other.is_alive())
+            loaded.set()
+            for thread in threads:
+                thread.join(5)
+        # 同时创建同一个会话时只保留一个
+        self.assertIs(results[0], results[1])
+        self.assertIs(runtime.get("slow"), results[0])
+        self.assertEqual(runtime.stats()["created"], 2)
+
+    def test_async_runtime(self):
+        agent = AsyncWeeAgent()
+        agent.open_ai_client = FakeAsyncClient(
+            [make_completion("one"), make_completion("two")])
+        runtime = AgentRuntime(agent)
+
+        async def main():
+            return await asyncio.gather(runtime.acall("x", "q1"),
+                                        runtime.acall("y", "q2"))
+
+        self.assertEqual(sorted(asyncio.run(main())), ["one", "two"])
+        self.assertEqual(len(runtime.get("x").history_messages), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+from fake_openai import FakeClient, make_completion
+from wee_agent import WeeAgent, set_tool
+from wee_agent.errors import SnapshotFormatError
+
+
+class MyAgent(WeeAgent):
+
+    @staticmethod
+    @set_tool
+    def plus(a: int, b: int) -> str:
+        """
+        计算两个数的和
+        :param a: 第一个数
+        :param b: 第二个数
+        :return: 两个数的和
+        """
+        return str(a + b)
+
+
+class MyTestCase(unittest.TestCase):
+
+    def _agent(self, rounds: int = 6) -> WeeAgent:
+        agent = MyAgent(name="bot", prompt="be brief", max_round=3)
+        agent.open_ai_client = FakeClient(
+            [make_completion(f"answer {i}", prompt_tokens=10 + i) for i in range(rounds)])
+        agent.temperature = 0.2
+        agent.response_format = "json_object"
+        agent.session_id = "user-1"
+        for i in range(rounds):
+            agent(f"question {i}")
+        return agent
+
+    def test_round_trip(self):
+        agent = self._agent()
+        data = agent.snapshot()
+        self.assertEqual(data[:4], b"WEEA")
+        restored = MyAgent.restore(data)
+        self.assertEqual(restored._create_messages(), agent._create_messages())
+        self.assertEqual(restored.history_messages, agent.history_messages)
+        self.assertEqual(list(restored.message_tokens), list(agent.message_tokens))
+        self.assertEqual(list(restored.history.round_starts),
+                         list(agent.history.round_starts))
+        self.assertEqual(restored.message_windows, agent.message_windows)
+        self.assertEqual(restored.window_tokens, agent.window_tokens)
+        for key in ("message_window_round_count", "last_prompt_tokens",
+                    "prompt_tokens_total", "session_id", "name", "prompt",
+                    "temperature"):
+            self.assertEqual(getattr(restored, key), getattr(agent, key), key)
+        self.assertEqual(restored.completion.response_format.type, "json_object")
+        self.assertEqual(restored.completion.tools, agent.completion.tools)
+
+    def test_restore_from_template_and_continue(self):
+        agent = self._agent()
+        template = MyAgent(name="bot", prompt="other")
+        template.open_ai_client = FakeClient([make_completion('{"a": 1}')])
+        session = MyAgent.restore(agent.snapshot(window_only=True, compress=False),
+                                  template=template)
+        self.assertEqual(session.history.offset, agent.message_windows["head"])
+        self.assertEqual(session.prompt, "be brief")
+        self.assertEqual(template.prompt, "other")
+        session("question 6")
+        sent = template.open_ai_client.requests[-1]
+        self.assertEqual(sent["messages"][0]["content"], "be brief")
+        self.assertEqual(sent["messages"][1]["content"], "question 2")
+        self.assertEqual(sent["temperature"], 0.2)
+
+    def test_invalid_snapshots(self):
+        data = self._agent(2).snapshot()
+        for broken in (b"", b"XXXX" + data[4:], data[:4] + b"\x63" + data[5:],
+                       data[:-3] + b"abc"):
+            with self.assertRaises(SnapshotFormatError):
+                WeeAgent.restore(broken)
+
+
+if __name__ == '__main__':
+    unittest.main()
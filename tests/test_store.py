@@ -0,0 +1,120 @@
+import os
+import tempfile
+import time
+import unittest
+
+from fake_openai import FakeClient, make_completion
+from wee_agent import WeeAgent
+from wee_agent.session import AgentRuntime
+from wee_agent.store import JsonlSessionStore, SqliteSessionStore
+
+
+def _fill(store, session_id: str, turns: int, head: int) -> None:
+    # 直接写入turns轮对话，消息窗口从第head条消息开始
+    for i in range(turns):
+        for role, content in (("user", f"question {i}"), ("assistant", f"answer {i}")):
+            position = 2 * i + (role == "assistant")
+            store.append(session_id, position, {"role": role, "content": content},
+                         5, {"head": head, "summary": "earlier"})
+    store.flush()
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _stores(self):
+        return [JsonlSessionStore(os.path.join(self.directory.name, "jsonl")),
+                SqliteSessionStore(os.path.join(self.directory.name, "s.sqlite"))]
+
+    def test_resume_across_agents(self):
+        for store in self._stores():
+            with self.subTest(store=type(store).__name__):
+                agent = WeeAgent(name="bot", max_round=2, session_store=store)
+                agent.open_ai_client = FakeClient(
+                    [make_completion(f"answer {i}") for i in range(5)])
+                session = agent.new_session(session_id="user-1")
+                for i in range(5):
+                    session(f"question {i}")
+                expected = session._create_messages()
+                store.close()
+
+                # 模拟新进程：新的存储对象和代理
+                store = type(store)(store.path if isinstance(store, SqliteSessionStore)
+                                    else store.directory)
+                agent = WeeAgent(name="bot", max_round=2, session_store=store)
+                agent.open_ai_client = FakeClient([make_completion("answer 5")])
+                resumed = agent.new_session(session_id="user-1")
+                self.assertEqual(resumed._create_messages(), expected)
+                self.assertEqual(resumed.message_windows, session.message_windows)
+                self.assertEqual(resumed.window_tokens, session.window_tokens)
+                self.assertEqual(resumed.message_window_round_count, 3)
+                # 窗口之前的消息没有被读取
+                self.assertEqual(resumed.history.offset, session.message_windows["head"])
+
+                resumed("question 5")
+                sent = agent.open_ai_client.requests[-1]["messages"]
+                self.assertEqual(sent[-1]["content"], "question 5")
+                self.assertEqual(sent[1], expected[1].model_dump(exclude_defaults=True,
+                                                                 exclude_none=True))
+                store.close()
+
+    def test_writes_are_batched(self):
+        store = SqliteSessionStore(os.path.join(self.directory.name, "s.sqlite"),
+                                   batch_size=1000, flush_interval=60)
+        store.append("a", 0, {"role": "user", "content": "hi"}, 3, {"head": 0})
+        with store._db_lock:
+            count = store._db.execute("SELECT COUNT(*) FROM session_messages").fetchone()
+        self.assertEqual(count[0], 0)
+        self.assertIsNotNone(store.load("a"))  # 读取前先写入缓冲
+        store.delete("a")
+        self.assertIsNone(store.load("a"))
+        store.close()
+
+    def test_resume_long_session_loads_window_only(self):
+        for store in self._stores():
+            with self.subTest(store=type(store).__name__):
+                _fill(store, "long", 5000, head=9980)
+                agent = WeeAgent(session_store=store)
+                start = time.perf_counter()
+                session = agent.new_session(session_id="long")
+                elapsed = time.perf_counter() - start
+                self.assertEqual(len(session.history.messages), 20)
+                self.assertEqual(session.message_windows, {"head": 9980, "tail": 10000})
+                self.assertEqual(session.history_messages[0].content, "question 4990")
+                self.assertEqual(session.summary, "earlier")
+                self.assertLess(elapsed, 0.1)
+                if isinstance(store, JsonlSessionStore):  # 从窗口起点所在的字节位置开始读取
+                    self.assertGreater(store.load("long")[0]["offset"], 0)
+                store.close()
+
+    def test_jsonl_ignores_torn_tail(self):
+        store = JsonlSessionStore(self.directory.name)
+        _fill(store, "torn", 3, head=2)
+        with open(os.path.join(self.directory.name, "torn.jsonl"), "ab") as f:
+            f.write(b'{"p": 6, "m": {"role"')
+        _, messages = store.load("torn")
+        self.assertEqual([position for position, _, _ in messages], [2, 3, 4, 5])
+        store.append("torn", 6, {"role": "user", "content": "again"}, 3, {"head": 2})
+        _, messages = store.load("torn")
+        self.assertEqual(messages[-1], (6, {"role": "user", "content": "again"}, 3))
+        store.close()
+
+    def test_runtime_resumes_evicted_session(self):
+        store = JsonlSessionStore(self.directory.name, flush_interval=0.01)
+        agent = WeeAgent(session_store=store)
+        agent.open_ai_client = FakeClient([make_completion("a"), make_completion("b")])
+        runtime = AgentRuntime(agent, max_sessions=1)
+        runtime("user-1", "hi")
+        runtime("user-2", "hello")  # 淘汰user-1
+        self.assertNotIn("user-1", runtime)
+        session = runtime.session("user-1")
+        self.assertEqual([m.content for m in session.history_messages], ["hi", "a"])
+        self.assertEqual(runtime.stats()["resumed"], 1)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from fake_openai import FakeClient, make_chunks
+from wee_agent import WeeAgent
+from wee_agent.stream import StreamAccumulator
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_text(self):
+        accumulator = StreamAccumulator()
+        texts = [accumulator.add(chunk) for chunk in make_chunks(["a", "b"])]
+        self.assertEqual([t for t in texts if t], ["a", "b"])
+        response = accumulator.build()
+        self.assertEqual(response.choices[0].message.content, "ab")
+        self.assertEqual(response.choices[0].finish_reason, "stop")
+        self.assertEqual(response.usage.prompt_tokens, 10)
+
+    def test_interleaved_tool_calls(self):
+        chunks = make_chunks(tool_calls=[
+            ("call_a", "f", ['{"x"', ': 1}']),
+            ("call_b", "g", ['{"y": ', '2}']),
+        ])
+        # 将两个tool调用的参数片段交错发送
+        head, tail = chunks[:1], chunks[-2:]
+        a, b = chunks[1:4], chunks[4:7]
+        interleaved = head + [a[0], b[0], a[1], b[1], a[2], b[2]] + tail
+        accumulator = StreamAccumulator()
+        for chunk in interleaved:
+            accumulator.add(chunk)
+        message = accumulator.build().choices[0].message
+        self.assertIsNone(message.content)
+        self.assertEqual(
+            [(t.id, t.function.name, t.function.arguments)
+             for t in message.tool_calls],
+            [("call_a", "f", '{"x": 1}'), ("call_b", "g", '{"y": 2}')])
+
+    def test_stream_mode_history(self):
+        agent = WeeAgent(stream=True)
+        agent.open_ai_client = FakeClient([make_chunks(["x", "y"])])
+        self.assertEqual(agent("hi"), "xy")
+        self.assertEqual(agent.history_messages[-1].content, "xy")
+        self.assertEqual(agent.last_total_tokens, 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+
+from fake_openai import FakeAsyncClient, FakeClient, make_chunks
+from wee_agent import AsyncWeeAgent, WeeAgent, set_tool
+
+
+class EchoAgent(WeeAgent):
+
+    @staticmethod
+    @set_tool
+    def echo(text: str) -> str:
+        """
+        原样返回输入的文本
+        :param text: 输入的文本
+        :return: 输入的文本
+        """
+        return text
+
+
+class AsyncEchoAgent(AsyncWeeAgent):
+
+    @staticmethod
+    @set_tool
+    async def echo(text: str) -> str:
+        """
+        原样返回输入的文本
+        :param text: 输入的文本
+        :return: 输入的文本
+        """
+        return text
+
+
+def _responses():
+    return [
+        make_chunks(tool_calls=[("call_1", "echo", ['{"text"', ': "ping"}'])]),
+        make_chunks(["Hel", "lo"]),
+    ]
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_stream_events(self):
+        agent = EchoAgent()
+        agent.open_ai_client = FakeClient(_responses())
+        events = list(agent.stream_events("hi"))
+        self.assertEqual([e.type for e in events],
+                         ["usage", "tool_call_started", "tool_result",
+                          "text_delta", "text_delta", "usage", "finish"])
+        self.assertEqual(events[1].arguments, '{"text": "ping"}')
+        self.assertEqual(events[2].content, "ping")
+        self.assertEqual(events[-1].content, "Hello")
+        self.assertEqual(agent.history_messages[-1].content, "Hello")
+        # 请求使用stream模式，结束后恢复原来的设置
+        self.assertTrue(agent.open_ai_client.requests[0]["stream"])
+        self.assertFalse(agent.stream)
+
+    def test_first_event_arrives_before_completion(self):
+        agent = WeeAgent()
+        agent.open_ai_client = FakeClient([make_chunks(["a", "b", "c"])])
+        events = agent.stream_events("hi")
+        self.assertEqual(next(events).content, "a")
+        self.assertEqual(len(agent.history_messages), 1)  # 回复尚未合并
+        self.assertEqual(list(events)[-1].content, "abc")
+
+    def test_astream_events(self):
+        agent = AsyncEchoAgent()
+        agent.open_ai_client = FakeAsyncClient(_responses())
+
+        async def collect():
+            return [e async for e in agent.astream_events("hi")]
+
+        events = asyncio.run(collect())
+        self.assertEqual(events[2].content, "ping")
+        self.assertEqual(events[-1].finish_reason, "stop")
+        self.assertEqual(events[-1].content, "Hello")
+
+
+if __name__ == '__main__':
+    unittest.main()
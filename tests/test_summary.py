@@ -0,0 +1,75 @@
+import threading
+import unittest
+
+from fake_openai import FakeClient, make_completion
+from wee_agent import WeeAgent
+from wee_agent.summary import Summarizer
+from wee_agent.utils import num_tokens_from_messages
+
+
+class _GatedClient(FakeClient):
+    """生成摘要前等待gate，用于模拟很慢的摘要模型"""
+
+    def __init__(self, responses: list):
+        super().__init__(responses)
+        self.gate = threading.Event()
+        create = self.chat.completions.create
+
+        def gated_create(**kwargs):
+            self.gate.wait(5)
+            return create(**kwargs)
+
+        self.chat.completions.create = gated_create
+
+
+class MyTestCase(unittest.TestCase):
+
+    def _agent(self, client: FakeClient, rounds: int) -> WeeAgent:
+        agent = WeeAgent(max_round=2, summarizer=Summarizer(client=client))
+        agent.open_ai_client = FakeClient(
+            [make_completion(f"answer {i}") for i in range(rounds)])
+        return agent
+
+    def test_evicted_rounds_are_summarized(self):
+        client = FakeClient([make_completion("user is Bob"),
+                             make_completion("user is Bob, likes tea")])
+        agent = self._agent(client, 6)
+        for i in range(4):
+            agent(f"question {i}")
+        agent._summary_future.result()  # 等待后台的摘要完成
+        agent("question 4")
+        sent = agent.open_ai_client.requests[-1]["messages"]
+        self.assertEqual(sent[1]["name"], "summary")
+        self.assertTrue(sent[1]["content"].endswith("user is Bob"))
+        self.assertIn("question 0", client.requests[0]["messages"][1]["content"])
+        self.assertEqual(client.requests[0]["model"], "gpt-4o-mini")
+        # 窗口的token数包括摘要
+        self.assertEqual(agent.window_tokens,
+                         num_tokens_from_messages(agent._create_messages(),
+                                                  agent.model))
+
+        agent._summary_future.result()
+        agent("question 5")
+        self.assertIn("user is Bob",
+                      client.requests[1]["messages"][1]["content"])
+        self.assertTrue(agent.summary.endswith("likes tea"))
+        agent.trim_history(reset=True)
+        self.assertEqual(agent.summary, "")
+
+    def test_turns_do_not_wait_for_summary(self):
+        client = _GatedClient([make_completion("S1")])
+        agent = self._agent(client, 5)
+        for i in range(5):
+            self.assertEqual(agent(f"question {i}"), f"answer {i}")
+        # 摘要还没有完成，对话照常进行，离开窗口的消息在等待下一次提交
+        self.assertEqual(len(client.requests), 0)
+        self.assertTrue(agent._summary_backlog)
+        self.assertNotIn("summary", [m.get("name") for m in
+                                     agent.open_ai_client.requests[-1]["messages"]])
+        client.gate.set()
+        self.assertEqual(agent._summary_future.result(), "S1")
+        agent.summarizer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+
+from fake_openai import FakeClient, make_completion
+from wee_agent import WeeAgent
+from wee_agent.utils import num_tokens_from_messages
+
+
+class MyTestCase(unittest.TestCase):
+
+    def _agent(self, rounds: int) -> WeeAgent:
+        agent = WeeAgent(max_round=0)
+        agent.open_ai_client = FakeClient(
+            [make_completion(f"answer {i} " * 20) for i in range(rounds)])
+        for i in range(rounds):
+            agent(f"question {i} " * 10)
+        return agent
+
+    def test_window_tokens_match_full_count(self):
+        agent = self._agent(5)
+        self.assertEqual(agent.window_tokens,
+                         num_tokens_from_messages(agent._create_messages(),
+                                                  agent.model))
+
+    def test_window_tokens_follow_trim(self):
+        agent = self._agent(5)
+        before = agent.window_tokens
+        agent.trim_history()
+        self.assertEqual(agent.window_tokens,
+                         before - sum(agent.message_tokens[:2]))
+        self.assertEqual(agent.window_tokens,
+                         num_tokens_from_messages(agent._create_messages(),
+                                                  agent.model))
+        agent.trim_history(reset=True)
+        self.assertEqual(agent.window_tokens,
+                         agent.system_message_tokens + 3)
+
+
+class TrimTestCase(unittest.TestCase):
+
+    def _agent(self, rounds: int) -> WeeAgent:
+        agent = WeeAgent(max_round=0)
+        agent.open_ai_client = FakeClient(
+            [make_completion(f"answer {i} " * 20) for i in range(rounds + 1)])
+        for i in range(rounds):
+            agent(f"question {i} " * 10)
+        return agent
+
+    def test_trim_history_number(self):
+        agent = self._agent(5)
+        agent.trim_history(number=3)
+        self.assertEqual(agent.message_windows["head"], 6)
+        self.assertEqual(agent.message_window_round_count, 2)
+        agent.trim_history(number=5)
+        self.assertEqual(agent.message_windows["head"],
+                         agent.message_windows["tail"])
+
+    def test_trim_history_by_token(self):
+        agent = self._agent(5)
+        round_tokens = sum(agent.message_tokens[:2])
+        budget = agent.window_tokens - 2 * round_tokens - 1
+        agent.trim_history_by_token(budget)
+        self.assertLessEqual(agent.window_tokens, budget)
+        # 只裁剪了必要的轮次
+        self.assertEqual(agent.message_windows["head"], 6)
+
+    def test_window_fits_before_sending(self):
+        agent = self._agent(5)
+        agent.max_input_token = agent.window_tokens
+        agent("question 5 " * 10)
+        sent = agent.open_ai_client.requests[-1]["messages"]
+        self.assertEqual(sent[1]["content"], "question 1 " * 10)
+        self.assertLessEqual(num_tokens_from_messages(sent, agent.model),
+                             agent.max_input_token)
+
+
+class PrefixStableTestCase(unittest.TestCase):
+
+    def _run(self, window_mode: str, rounds: int = 12) -> list:
+        # 返回每次请求中系统消息之后的第一条消息，即请求前缀的起点
+        agent = WeeAgent(max_round=4, window_mode=window_mode)
+        agent.open_ai_client = FakeClient(
+            [make_completion(f"answer {i}") for i in range(rounds)])
+        for i in range(rounds):
+            agent(f"question {i}")
+        return [request["messages"][1]["content"]
+                for request in agent.open_ai_client.requests]
+
+    def test_halving_keeps_prefix_stable(self):
+        sliding = self._run("sliding")
+        halving = self._run("halving")
+        changes = lambda heads: sum(a != b for a, b in zip(heads, heads[1:]))
+        self.assertEqual(changes(sliding), 6)  # 超过4轮后每轮都移动
+        self.assertEqual(changes(halving), 2)  # 每3轮裁剪一次
+        self.assertEqual(halving[6:], ["question 3"] * 3 + ["question 6"] * 3)
+
+    def test_halving_by_token(self):
+        agent = WeeAgent(max_round=0, window_mode="halving")
+        agent.open_ai_client = FakeClient(
+            [make_completion(f"answer {i} " * 20) for i in range(6)])
+        for i in range(6):
+            agent(f"question {i} " * 10)
+        budget = agent.window_tokens - 1
+        agent.trim_history_by_token(budget)
+        self.assertLessEqual(agent.window_tokens, budget // 2)
+        self.assertEqual(agent.message_window_round_count, 2)
+
+    def test_cached_token_metrics(self):
+        agent = WeeAgent()
+        first = make_completion("a", prompt_tokens=100)
+        second = make_completion("b", prompt_tokens=100).model_copy(update={
+            "usage": first.usage.model_copy(
+                update={"prompt_tokens_details": {"cached_tokens": 80}})})
+        agent.open_ai_client = FakeClient([first, second])
+        agent("x")
+        agent("y")
+        self.assertEqual(agent.last_cached_tokens, 80)
+        self.assertEqual(agent.prompt_cache_hit_rate, 0.4)
+        with self.assertRaises(ValueError):
+            WeeAgent(window_mode="fifo")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from wee_agent import tokenizer
+from wee_agent.utils import num_tokens_from_text
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tokenizer._encodings.clear()
+        tokenizer._failed.clear()
+
+    def tearDown(self):
+        tokenizer.set_bpe_dir(None)
+        tokenizer._encodings.clear()
+        tokenizer._failed.clear()
+
+    def test_encoding_loaded_once(self):
+        sentinel = object()
+        with mock.patch.object(tokenizer, "_load",
+                               return_value=sentinel) as load:
+            self.assertIs(tokenizer.get_encoding("gpt-4"), sentinel)
+            self.assertIs(tokenizer.get_encoding("gpt-3.5-turbo"), sentinel)
+            self.assertEqual(load.call_count, 1)  # 两个模型使用同一个编码
+
+    def test_failure_is_remembered_until_warmup(self):
+        with mock.patch.object(tokenizer, "_load",
+                               side_effect=OSError("offline")) as load:
+            self.assertIsNone(tokenizer.get_encoding("gpt-4o"))
+            self.assertIsNone(tokenizer.get_encoding("gpt-4o"))
+            self.assertEqual(load.call_count, 1)
+            self.assertEqual(tokenizer.warmup(["gpt-4o"]), {"gpt-4o": False})
+            self.assertEqual(load.call_count, 2)
+
+    def test_exported_bpe_dir_is_loaded_offline(self):
+        # 每个字节一个token的小编码，代替需要下载的真实编码
+        spec = {"pat_str": r"\S+|\s+", "special_tokens": {"<|end|>": 256},
+                "mergeable_ranks": {bytes([i]): i for i in range(256)}}
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(tokenizer.ENCODING_CONSTRUCTORS, {"o200k_base": lambda: spec}), \
+                mock.patch.dict(os.environ, {}, clear=False), \
+                mock.patch("tiktoken.get_encoding", side_effect=OSError("offline")):
+            os.environ.pop("TIKTOKEN_CACHE_DIR", None)
+            tokenizer.export_bpe(directory, ["o200k_base"])
+            self.assertEqual(tokenizer.warmup(["gpt-4o"], bpe_dir=directory),
+                             {"gpt-4o": True})
+            self.assertNotIn("TIKTOKEN_CACHE_DIR", os.environ)  # 不修改环境变量
+            encoding = tokenizer.get_encoding("gpt-4o")
+            self.assertEqual(encoding.encode("ab c"), [97, 98, 32, 99])
+
+    def test_estimate_without_encoding(self):
+        self.assertEqual(num_tokens_from_text("abcdefgh", None), 2)
+        self.assertEqual(num_tokens_from_text("你好", None), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
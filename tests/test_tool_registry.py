@@ -0,0 +1,96 @@
+import unittest
+
+from wee_agent import WeeAgent, set_tool
+
+
+class BaseToolAgent(WeeAgent):
+
+    @staticmethod
+    @set_tool
+    def add(a: int, b: int) -> int:
+        """
+        计算两个数的和
+        :param a: 第一个数
+        :param b: 第二个数
+        :return: 两个数的和
+        """
+        return a + b
+
+    @set_tool
+    def greet(self, name: str) -> str:
+        """
+        向用户问好
+        :param name: 用户的名称
+        :return: 问候语
+        """
+        return f"hello {name}"
+
+    @property
+    def expensive(self):
+        raise AssertionError("初始化时不应读取property")
+
+
+class ChildToolAgent(BaseToolAgent):
+
+    @classmethod
+    @set_tool
+    def version(cls) -> str:
+        """
+        返回版本号
+        :return: 版本号
+        """
+        return "1"
+
+    def greet(self, name: str) -> str:
+        # 覆盖后不再是tool
+        return name
+
+
+def _names(tools: list) -> list:
+    return [tool["function"]["name"] for tool in tools]
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_schemas_collected_once_per_class(self):
+        self.assertEqual(_names(BaseToolAgent._class_tools), ["add", "greet"])
+        self.assertEqual(_names(ChildToolAgent._class_tools),
+                         ["add", "version"])
+        self.assertEqual(WeeAgent._class_tools, ())
+
+        first, second = BaseToolAgent(), BaseToolAgent()
+        self.assertIs(first.tool_list, BaseToolAgent._class_tools)
+        self.assertIs(first.completion.tools, second.completion.tools)
+        self.assertEqual(first._build_payload()["tools"],
+                         BaseToolAgent._class_tools)
+
+    def test_register_tool_does_not_touch_shared_list(self):
+        first, second = BaseToolAgent(), BaseToolAgent()
+
+        def shout(text: str) -> str:
+            """
+            大声说话
+            :param text: 文本
+            :return: 大写的文本
+            """
+            return text.upper()
+
+        first.register_tool(name="shout", tool=shout)
+        self.assertEqual(_names(first.completion.tools),
+                         ["add", "greet", "shout"])
+        self.assertEqual(_names(second.tool_list), ["add", "greet"])
+        self.assertEqual(_names(BaseToolAgent._class_tools), ["add", "greet"])
+        # 共享的schema是元组，不能原地修改
+        with self.assertRaises(AttributeError):
+            second.tool_list.append({})
+
+    def test_builtin_tools(self):
+        agent = ChildToolAgent(need_user_input=True)
+        self.assertEqual(_names(agent.tool_list),
+                         ["add", "version", "_ask_user"])
+        self.assertIs(agent.tool_list[-1],
+                      ChildToolAgent(need_user_input=True).tool_list[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from fake_openai import FakeClient
+from wee_agent import WeeAgent
+from wee_agent.errors import StoreClosedError
+from wee_agent.vectors import VectorStore, recall_tool
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.vectors = np.random.default_rng(0).standard_normal((3000, 16)).astype(np.float32)
+
+    def _store(self, **kwargs) -> VectorStore:
+        store = VectorStore(self.directory.name, block_size=512, **kwargs)
+        store.add(self.vectors[:1000], [{"text": f"t{i}"} for i in range(1000)])
+        store.add(self.vectors[1000:], [{"text": f"t{i}"} for i in range(1000, 3000)])
+        return store
+
+    def _exact(self, queries, k):
+        normalized = self.vectors / np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        return np.argsort(-(queries @ normalized.T), axis=1)[:, :k]
+
+    def test_search_matches_brute_force(self):
+        store = self._store()
+        queries = self.vectors[[3, 1500, 2999]] + 0.1
+        ids, scores = store.search_batch(queries, k=10)
+        np.testing.assert_array_equal(ids, self._exact(queries, 10))
+        self.assertTrue(np.all(np.diff(scores, axis=1) <= 0))
+        hits = store.search(self.vectors[42], k=3)
+        self.assertEqual(hits[0][0], 42)
+        self.assertAlmostEqual(hits[0][1], 1.0, places=5)
+        self.assertEqual(hits[0][2], {"text": "t42"})
+        self.assertEqual(len(store), 3000)
+
+    def test_delete_and_compact(self):
+        store = self._store(compact_ratio=0.5)
+        self.assertEqual(store.delete([42, 42, 5000]), 1)
+        self.assertNotIn(42, [id_ for id_, _, _ in store.search(self.vectors[42], k=5)])
+        self.assertIsNone(store.get(42))
+        self.assertFalse(store.maybe_compact())
+        self.assertEqual(store.delete(list(range(1000, 2600))), 1600)
+        self.assertEqual((store.count, store.deleted, store.generation), (3000, 1601, 0))
+        self.assertTrue(store.maybe_compact())  # 超过一半才整理
+        self.assertEqual((store.count, store.deleted, store.generation), (1399, 0, 1))
+        self.assertEqual(store.get(2999), {"text": "t2999"})
+        self.assertEqual(store.search(self.vectors[2700], k=1)[0][0], 2700)
+        self.assertEqual(store.add(self.vectors[:1]), [3000])  # id不会复用
+
+    def test_reopen(self):
+        store = self._store()
+        store.delete([7])
+        store.close()
+        reopened = VectorStore(self.directory.name)
+        self.assertEqual((len(reopened), reopened.dimension), (2999, 16))
+        self.assertIsInstance(reopened._arrays["vectors"], np.memmap)
+        self.assertEqual(reopened.search(self.vectors[9], k=1)[0][:1], (9,))
+        self.assertIsNone(reopened.get(7))
+        with self.assertRaises(ValueError):
+            VectorStore(self.directory.name, dimension=8)
+
+    def test_closed_store(self):
+        store = self._store()
+        store.close()
+        store.close()
+        for call in (lambda: store.add(self.vectors[:1]), lambda: store.search(self.vectors[0]),
+                     lambda: store.get(0), lambda: store.delete([0]), store.maybe_compact):
+            with self.assertRaises(StoreClosedError):
+                call()
+
+    def test_fewer_results_than_k(self):
+        store = VectorStore(self.directory.name)
+        store.add(self.vectors[:2])
+        ids, scores = store.search_batch(self.vectors[0], k=4)
+        self.assertEqual(ids[0].tolist()[2:], [-1, -1])
+        self.assertEqual(len(store.search(self.vectors[0], k=4)), 2)
+
+    def test_recall_tool(self):
+        store = self._store()
+        recall = recall_tool(store, lambda text: self.vectors[int(text)], k=2)
+        agent = WeeAgent()
+        agent.open_ai_client = FakeClient([])
+        agent.register_tool(name="recall", tool=recall)
+        self.assertEqual(agent.tool_list[-1]["function"]["name"], "recall")
+        self.assertIn("query", agent.tool_list[-1]["function"]["parameters"]["properties"])
+        self.assertTrue(agent.recall("5").startswith("- (1.00) t5\n"))
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        rng = np.random.default_rng(1)
+        # 聚成簇的数据，接近真实的embedding分布
+        centers = rng.standard_normal((50, 32)).astype(np.float32)
+        self.vectors = (centers[rng.integers(0, 50, 20000)]
+                        + 0.3 * rng.standard_normal((20000, 32))).astype(np.float32)
+        self.queries = self.vectors[rng.integers(0, 20000, 50)] + 0.1
+
+    def _recall(self, store, **kwargs) -> float:
+        exact, _ = store.search_batch(self.queries, k=10, exact=True)
+        approximate, _ = store.search_batch(self.queries, k=10, **kwargs)
+        return np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approximate, exact)])
+
+    def test_index_recall(self):
+        store = VectorStore(self.directory.name, block_size=4096)
+        store.add(self.vectors)
+        for quantization in ("int8", "float16"):
+            with self.subTest(quantization=quantization):
+                store.build_index(nlist=100, quantization=quantization, nprobe=8)
+                self.assertEqual(store.index.nlist, 100)
+                self.assertEqual(store.index.codes.dtype, np.dtype(quantization))
+                self.assertGreaterEqual(self._recall(store), 0.9)
+                self.assertEqual(self._recall(store, nprobe=100, rerank=100), 1.0)
+
+    def test_index_on_small_store(self):
+        store = VectorStore(self.directory.name)
+        store.add(self.vectors[:5])
+        store.build_index(nlist=100)
+        self.assertEqual(store.index.nlist, 5)
+        self.assertEqual(store.search(self.vectors[3], k=1)[0][0], 3)
+        store.add(self.vectors[5:500])
+        store.build_index(nlist=100, sample=20)
+        self.assertEqual(store.index.nlist, 20)
+        self.assertEqual(store.search(self.vectors[300], k=1)[0][0], 300)
+
+    def test_index_sees_appends_and_deletes(self):
+        store = VectorStore(self.directory.name)
+        store.add(self.vectors[:10000])
+        store.build_index(nlist=50)
+        ids = store.add(self.vectors[10000:10010])
+        self.assertEqual(store.search(self.vectors[10005], k=1)[0][0], ids[5])
+        store.delete([ids[5]])
+        self.assertNotEqual(store.search(self.vectors[10005], k=1)[0][0], ids[5])
+        store.close()
+
+        reopened = VectorStore(self.directory.name)
+        self.assertIsInstance(reopened.index.codes, np.memmap)
+        self.assertEqual(reopened.search(self.vectors[123], k=1)[0][0], 123)
+        reopened.delete(list(range(6000)))
+        self.assertEqual(reopened.index_settings["serial"], 0)  # 删除时不整理，也不重建索引
+        self.assertNotIn(9, [id_ for id_, _, _ in reopened.search(self.vectors[9], k=5)])
+        self.assertTrue(reopened.maybe_compact())  # 整理后重新建立索引
+        self.assertEqual((reopened.index.count, reopened.index_settings["serial"]), (4009, 1))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "ivf.0.codes.npy")))
+        self.assertEqual(reopened.search(self.vectors[9000], k=1)[0][0], 9000)
+        reopened.drop_index()
+        self.assertIsNone(VectorStore(self.directory.name).index)
+
+
+if __name__ == '__main__':
+    unittest.main()